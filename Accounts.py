@@ -0,0 +1,147 @@
+from typing import Dict
+
+from Archive import Archive
+from Attachments import AttachmentCache
+from Cache import DedupCache, MessageStore
+from Capture import GatewayRecorder
+from Metrics import MetricsServer, registry
+from Notifier import create_notifier
+from PushTextProcessor import PushTextProcessor
+from QQPush import QQPush
+
+
+class GuildOwners:
+    """
+    Server归属登记
+
+    多个账号同在一个Server中时，该Server的事件仅由首个取得归属的账号处理，其余账号收到的同一事件直接丢弃。
+    账号断开连接或离开Server时释放归属，由其他账号在收到该Server的下一个事件时接管。
+    """
+
+    def __init__(self):
+        self.owners: Dict[int, object] = dict()
+
+    def claim(self, guild_id: int, client) -> bool:
+        """
+        取得Server的归属，Server无归属时归属于client
+
+        :param guild_id: Server ID
+        :param client: DiscordMonitor
+        :return: Server是否归属于client
+        """
+        owner = self.owners.get(guild_id)
+        if owner is None:
+            self.owners[guild_id] = client
+            return True
+        return owner is client
+
+    def release(self, guild_id: int, client):
+        """
+        释放client对Server的归属
+
+        :param guild_id: Server ID
+        :param client: DiscordMonitor
+        :return:
+        """
+        if self.owners.get(guild_id) is client:
+            del self.owners[guild_id]
+
+    def release_all(self, client):
+        """
+        释放client的所有Server归属
+
+        :param client: DiscordMonitor
+        :return:
+        """
+        for guild_id in [guild_id for guild_id, owner in self.owners.items() if owner is client]:
+            del self.owners[guild_id]
+
+    def count(self, client) -> int:
+        return sum(1 for owner in self.owners.values() if owner is client)
+
+
+class SharedPipeline:
+    """
+    同一进程中多个账号共用的推送及去重组件
+
+    包括推送模板、QQ推送队列、用户动态及消息动态去重缓存、被监听消息缓存、Server归属登记、用户名字典、附件缓存、系统通知、动态存档、gateway事件录制及运行状态指标。
+    """
+
+    def __init__(self, config):
+        """
+        :param config: Config
+        """
+        self.push_text_processor = PushTextProcessor(config.push_content)
+        self.qq_push = QQPush(self.push_text_processor.render_digest)
+        # 用户动态去重缓存，账号与用户同在多个Server中时同一动态仅推送一次
+        self.event_cache = DedupCache(config.user_dynamic_monitor.dedup_ttl, config.user_dynamic_monitor.dedup_max_size)
+        # 消息动态去重缓存，以消息ID为key，Server归属转移期间同一消息仅推送一次
+        self.message_cache = DedupCache(config.message_monitor.dedup_ttl, config.message_monitor.dedup_max_size)
+        self.guild_owners = GuildOwners()
+        # 被监听消息缓存，代替discord.py的全局消息缓存处理消息编辑及删除
+        self.message_store = MessageStore(config.message_monitor.cache_size, config.message_monitor.cache_age)
+        # 由首个账号从快照文件读取
+        self.username_dict = None
+        self.monitors = []
+        self.metrics_server = None
+        if config.metrics.enable:
+            self.metrics_server = MetricsServer(config.metrics.host, config.metrics.port, config.metrics.lag_interval)
+        registry.gauge('discord_monitor_dedup_cache_entries', 'Entries in the user dynamic dedup cache.',
+                       lambda: len(self.event_cache))
+        registry.gauge('discord_monitor_username_dict_entries', 'Monitored users with a known username.',
+                       lambda: len(self.username_dict or ()))
+        registry.gauge('discord_monitor_push_queue_messages', 'Messages waiting in QQ push queues.',
+                       lambda: sum(queue.qsize() for queue in self.qq_push.queues.values()))
+        registry.gauge('discord_monitor_message_store_entries', 'Monitored messages kept for edits and deletes.',
+                       lambda: len(self.message_store))
+        registry.gauge('discord_monitor_owned_guilds', 'Guilds with an owning account.',
+                       lambda: len(self.guild_owners.owners))
+        # 附件缓存，下载使用首个账号的代理
+        self.attachment_cache = None
+        attachment = config.attachment_cache
+        if attachment.enable:
+            self.attachment_cache = AttachmentCache(attachment.path, attachment.max_bytes, attachment.max_file_size,
+                                                    attachment.concurrency, attachment.timeout, attachment.delivery,
+                                                    config.proxy)
+            registry.gauge('discord_monitor_attachment_cache_bytes', 'Bytes stored in the attachment cache.',
+                           lambda: self.attachment_cache.total)
+        # 系统通知，未启用时为None
+        self.notifier = create_notifier(config)
+        # 被监听动态存档
+        self.archive = None
+        if config.archive.enable:
+            self.archive = Archive(config.archive.path, config.archive.commit_interval, config.archive.queue_size)
+        # gateway事件录制
+        self.recorder = None
+        if config.capture.enable:
+            self.recorder = GatewayRecorder(config.capture.path, config.capture.queue_size)
+            self.recorder.start()
+
+    async def start(self):
+        """
+        连接cqhttp应用并启动运行状态指标服务
+
+        :return:
+        """
+        await self.qq_push.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+    async def close(self):
+        """
+        关闭推送队列、运行状态指标服务、gateway事件录制、附件下载、系统通知、动态存档及正则表达式sandbox
+
+        :return:
+        """
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.attachment_cache is not None:
+            await self.attachment_cache.close()
+        if self.notifier is not None:
+            self.notifier.close()
+        if self.archive is not None:
+            await self.archive.close()
+        await self.qq_push.close()
+        self.push_text_processor.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+被监听动态的SQLite存档及查询，查询用法：python Archive.py [--db archive.db] [text] [options]
+
+存档由config.json中archive设置生成，消息正文建有全文索引，可按正文、用户、频道、Server、动态类型及时间查询。
+"""
+import argparse
+import asyncio
+import datetime
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from Cache import as_utc
+from Log import add_log
+
+columns = ('time', 'type', 'user_id', 'user_name', 'server_id', 'server_name', 'channel_id', 'channel_name',
+           'message_id', 'content', 'category', 'attachments', 'before', 'after')
+insert_sql = 'INSERT INTO events (%s) VALUES (%s)' % (', '.join(columns), ', '.join('?' * len(columns)))
+
+
+def open_archive(path: str) -> sqlite3.Connection:
+    """
+    打开存档数据库，不存在时创建表、索引及全文索引
+
+    :param path: 数据库文件路径
+    :return:
+    """
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                 'id INTEGER PRIMARY KEY, '
+                 'time REAL NOT NULL, '
+                 'type TEXT NOT NULL, '
+                 'user_id INTEGER NOT NULL, '
+                 'user_name TEXT, '
+                 'server_id INTEGER, '
+                 'server_name TEXT, '
+                 'channel_id INTEGER, '
+                 'channel_name TEXT, '
+                 'message_id INTEGER, '
+                 'content TEXT, '
+                 'category TEXT, '
+                 'attachments TEXT, '
+                 'before TEXT, '
+                 'after TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS events_user ON events (user_id, time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS events_channel ON events (channel_id, time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS events_time ON events (time)')
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_fts'").fetchone()
+    if exists is None:
+        # trigram分词支持中文等无空格文本的子串查询，SQLite低于3.34时退回按空格及标点分词
+        try:
+            conn.execute("CREATE VIRTUAL TABLE events_fts USING fts5(content, content='events', content_rowid='id', "
+                         "tokenize='trigram')")
+        except sqlite3.OperationalError:
+            conn.execute("CREATE VIRTUAL TABLE events_fts USING fts5(content, content='events', content_rowid='id')")
+        conn.execute('CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events '
+                     'WHEN new.content IS NOT NULL '
+                     'BEGIN INSERT INTO events_fts (rowid, content) VALUES (new.id, new.content); END')
+    conn.commit()
+    return conn
+
+
+class Archive:
+    """
+    被监听动态存档
+
+    动态于事件循环中整理为行后暂存，每commit_interval秒由独立线程批量写入并提交一次，数据库以WAL模式运行。
+    暂存的行数达到上限时丢弃并计数，写入缓慢不会阻塞事件循环。
+    """
+
+    def __init__(self, path: str, commit_interval: float = 1.0, queue_size: int = 10000):
+        """
+        :param path: 数据库文件路径
+        :param commit_interval: 批量写入的间隔，单位为秒
+        :param queue_size: 暂存行数上限
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Archive')
+        self.conn = None
+        self.pending: List[Tuple] = []
+        self.flush_task = None
+        self.archived = 0
+        self.dropped = 0
+        # 单线程执行器按提交顺序执行，首批写入前数据库已打开
+        self.executor.submit(self._open)
+
+    def _open(self):
+        try:
+            self.conn = open_archive(self.path)
+        except Exception as e:
+            add_log(2, 'Archive', 'Failed to open archive %s. Reason: %r' % (self.path, e))
+
+    def _add(self, row: Tuple):
+        if len(self.pending) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.pending.append(row)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self._flush())
+
+    def record_message(self, status: str, message, category: Optional[str] = None):
+        """
+        存档消息动态，发送消息以消息的发送时间、编辑消息以编辑时间记录，删除及标注事件不含时间，以收到事件的时间记录
+
+        :param status: 动态类型
+        :param message: Message
+        :param category: 正文类别
+        :return:
+        """
+        attachments = [attachment.url for attachment in message.attachments]
+        attachments.extend(embed.image.proxy_url for embed in message.embeds if embed.image.proxy_url)
+        author = message.author
+        if status == '发送消息':
+            event_time = as_utc(message.created_at).timestamp()
+        elif status == '编辑消息' and message.edited_at is not None:
+            event_time = as_utc(message.edited_at).timestamp()
+        else:
+            event_time = time.time()
+        self._add((event_time, status, author.id, author.name + '#' + author.discriminator, message.guild.id,
+                   message.guild.name, message.channel.id, message.channel.name, message.id, message.content,
+                   category or None, ' ; '.join(attachments) or None, None, None))
+
+    def record_user_update(self, status: str, user, before, after):
+        """
+        存档用户动态
+
+        :param status: 动态类型
+        :param user: Member
+        :param before: 变更前
+        :param after: 变更后
+        :return:
+        """
+        self._add((time.time(), status, user.id, user.name + '#' + user.discriminator, user.guild.id, user.guild.name,
+                   None, None, None, None, None, None, str(before), str(after)))
+
+    async def _flush(self):
+        await asyncio.sleep(self.commit_interval)
+        while self.pending:
+            rows, self.pending = self.pending, []
+            try:
+                await asyncio.get_event_loop().run_in_executor(self.executor, self._commit, rows)
+            except Exception as e:
+                add_log(2, 'Archive', 'Failed to write %d events to archive. Reason: %r' % (len(rows), e))
+                continue
+            self.archived += len(rows)
+
+    def _commit(self, rows: List[Tuple]):
+        if self.conn is None:
+            raise sqlite3.OperationalError('archive is not open')
+        self.conn.executemany(insert_sql, rows)
+        self.conn.commit()
+
+    async def close(self):
+        """
+        写入剩余的动态并关闭数据库
+
+        :return:
+        """
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        rows, self.pending = self.pending, []
+        loop = asyncio.get_event_loop()
+        if rows:
+            try:
+                await loop.run_in_executor(self.executor, self._commit, rows)
+            except Exception as e:
+                add_log(2, 'Archive', 'Failed to write %d events to archive. Reason: %r' % (len(rows), e))
+        if self.conn is not None:
+            await loop.run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=False)
+        if self.dropped:
+            add_log(1, 'Archive', '%d events were not archived, queue was full' % self.dropped)
+
+
+def parse_date(text: str) -> float:
+    """
+    将本地时间的日期或日期时间转换为时间戳
+
+    :param text: 如2026-01-01或2026-01-01 12:00
+    :return:
+    """
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def query(conn: sqlite3.Connection, args, count: bool = False) -> list:
+    """
+    按命令行参数查询存档
+
+    :param conn: 存档数据库
+    :param args: 命令行参数
+    :param count: 是否仅查询数量
+    :return: 按时间由新到旧排列的行，count为True时为[(数量,)]
+    """
+    conditions = []
+    params = []
+    source = 'events'
+    if args.text and len(args.text) < 3:
+        # trigram全文索引无法查询少于3个字符的文本
+        conditions.append("events.content LIKE ? ESCAPE '\\'")
+        params.append('%%%s%%' % args.text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+    elif args.text:
+        source = 'events JOIN events_fts ON events_fts.rowid = events.id'
+        conditions.append('events_fts MATCH ?')
+        # 作为短语查询，避免正文中的引号及运算符被解释为FTS5语法
+        params.append('"%s"' % args.text.replace('"', '""'))
+    for column, value in (('user_id', args.user), ('channel_id', args.channel), ('server_id', args.server),
+                          ('type', args.type)):
+        if value is not None:
+            conditions.append('events.%s = ?' % column)
+            params.append(value)
+    if args.since:
+        conditions.append('events.time >= ?')
+        params.append(parse_date(args.since))
+    if args.until:
+        conditions.append('events.time < ?')
+        params.append(parse_date(args.until))
+    sql = 'SELECT %s FROM %s' % ('COUNT(*)' if count else 'events.*', source)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if not count:
+        sql += ' ORDER BY events.time DESC LIMIT ?'
+        params.append(args.limit)
+    return conn.execute(sql, params).fetchall()
+
+
+def format_row(row: sqlite3.Row) -> str:
+    when = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(row['time']))
+    if row['content'] is None and row['message_id'] is None:
+        return '[%s] %s %s (%d) @ %s: %s -> %s' % (when, row['type'], row['user_name'], row['user_id'],
+                                                   row['server_name'], row['before'], row['after'])
+    text = '[%s] %s %s (%d) @ %s #%s: %s' % (when, row['type'], row['user_name'], row['user_id'], row['server_name'],
+                                             row['channel_name'], row['content'])
+    if row['attachments']:
+        text += ' [%s]' % row['attachments']
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the Discord Monitor event archive')
+    parser.add_argument('text', nargs='?', help='text to search for in message content')
+    parser.add_argument('--db', default='archive.db', help='archive database, defaults to archive.db')
+    parser.add_argument('--user', type=int, help='user ID')
+    parser.add_argument('--channel', type=int, help='channel ID')
+    parser.add_argument('--server', type=int, help='server ID')
+    parser.add_argument('--type', help='event type, e.g. 发送消息')
+    parser.add_argument('--since', help='local date or time, e.g. 2026-01-01')
+    parser.add_argument('--until', help='local date or time, exclusive')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--count', action='store_true', help='only print the number of matching events')
+    args = parser.parse_args()
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro' % args.db, uri=True)
+    except sqlite3.OperationalError as e:
+        print('Failed to open %s: %s' % (args.db, e))
+        return 1
+    conn.row_factory = sqlite3.Row
+    start = time.perf_counter()
+    try:
+        rows = query(conn, args, args.count)
+    except sqlite3.OperationalError as e:
+        print('Query failed: %s' % e)
+        return 1
+    elapsed = time.perf_counter() - start
+    if args.count:
+        print('%d events in %.1f ms' % (rows[0][0], elapsed * 1000))
+        return 0
+    for row in reversed(rows):
+        print(format_row(row))
+    print('%d events in %.1f ms' % (len(rows), elapsed * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
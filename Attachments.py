@@ -0,0 +1,273 @@
+import asyncio
+import base64
+import hashlib
+import os
+import pathlib
+import posixpath
+import re
+from collections import OrderedDict
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import aiohttp
+
+from Log import add_log
+
+# CQ码参数中需转义的字符
+param_escape_table = str.maketrans({'&': '&amp;', '[': '&#91;', ']': '&#93;', ',': '&#44;'})
+# 推送本地文件并附带原链接的图片CQ码
+local_image_pattern = re.compile(r'\[CQ:image,file=(file://[^,\]]*),url=([^,\]]*)')
+
+
+def url_key(url: str) -> str:
+    """
+    去除URL中的查询参数，discord CDN链接过期后重新签名的同一附件对应同一key
+
+    :param url: 附件URL
+    :return:
+    """
+    parts = urlsplit(url)
+    return '%s://%s%s' % (parts.scheme, parts.netloc, parts.path)
+
+
+def image_cqcode(url: str, file: Optional[str] = None) -> str:
+    """
+    生成图片CQ码，推送本地文件时以url参数附带原链接
+
+    :param url: 附件URL
+    :param file: AttachmentCache.fetch的返回值，为None时推送原链接
+    :return:
+    """
+    if file is None:
+        return '[CQ:image,file=%s,timeout=5]' % url
+    if file.startswith('file://'):
+        return '[CQ:image,file=%s,url=%s,timeout=5]' % (file, url.translate(param_escape_table))
+    return '[CQ:image,file=%s,timeout=5]' % file
+
+
+def restore_missing_files(message: str) -> str:
+    """
+    将推送文本中已被淘汰或删除的本地图片文件替换为原链接，于推送前调用
+
+    排队或存于发件箱中的推送所引用的文件可能在推送前被缓存淘汰，此时改为由cqhttp应用下载原链接
+
+    :param message: 推送文本
+    :return:
+    """
+    if 'file://' not in message:
+        return message
+
+    def replace(match) -> str:
+        if os.path.exists(url2pathname(urlsplit(match.group(1)).path)):
+            return match.group(0)
+        return '[CQ:image,file=' + match.group(2)
+
+    return local_image_pattern.sub(replace, message)
+
+
+class AttachmentCache:
+    """
+    以内容哈希寻址的附件磁盘缓存
+
+    经配置的代理下载图片附件，以sha256命名存储于缓存目录，同一URL或相同内容仅下载及存储一次，超出容量上限时淘汰最久未使用的文件。
+    推送时以base64或本地文件路径代替discord链接，同一附件在各推送对象及消息编辑间复用。
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_file_size: int, concurrency: int = 4, timeout: float = 15.0,
+                 delivery: str = 'base64', proxy: Optional[str] = None, max_urls: int = 10000):
+        """
+        :param path: 缓存目录
+        :param max_bytes: 缓存总大小上限，单位为字节
+        :param max_file_size: 单个附件大小上限，单位为字节，超出则不下载
+        :param concurrency: 同时下载数量上限
+        :param timeout: 单个附件下载超时时间，单位为秒
+        :param delivery: 'base64'为推送base64编码的图片，推送文本随图片增大；'file'为推送本地文件路径，需与cqhttp应用位于同一主机，
+                         文件在推送前被淘汰时推送原链接
+        :param proxy: 下载使用的代理
+        :param max_urls: URL至内容哈希索引的条目上限
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.timeout = timeout
+        self.delivery = delivery
+        self.proxy = proxy or None
+        self.max_urls = max_urls
+        # 内容哈希至(文件名, 大小)，按最近使用时间排列
+        self.entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self.urls: 'OrderedDict[str, str]' = OrderedDict()
+        self.fetching: Dict[str, asyncio.Future] = dict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.session = None
+        self._loaded = None
+
+    def _scan(self):
+        """
+        读取缓存目录中已有的文件，按修改时间排列，于线程池中调用
+
+        :return:
+        """
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        return files
+
+    async def _populate(self):
+        files = await asyncio.get_event_loop().run_in_executor(None, self._scan)
+        for _, name, size in files:
+            digest = name.split('.', 1)[0]
+            self.entries[digest] = (name, size)
+            self.total += size
+        self._evict()
+
+    async def _load(self):
+        if self._loaded is None:
+            self._loaded = asyncio.ensure_future(self._populate())
+        await asyncio.shield(self._loaded)
+
+    async def fetch(self, url: str, size: Optional[int] = None) -> Optional[str]:
+        """
+        取得附件的CQ码file参数
+
+        :param url: 附件URL
+        :param size: 附件大小，未知时为None
+        :return: base64://或file://开头的字符串，下载失败或超出大小上限时为None
+        """
+        if size is not None and size > self.max_file_size:
+            return None
+        await self._load()
+        key = url_key(url)
+        digest = self.urls.get(key)
+        if digest is None or digest not in self.entries:
+            self.misses += 1
+            task = self.fetching.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._download(url, key))
+                self.fetching[key] = task
+                task.add_done_callback(lambda _: self.fetching.pop(key, None))
+            # 多条消息等待同一下载时，其中一条被取消不影响其余
+            digest = await asyncio.shield(task)
+            if digest is None or digest not in self.entries:
+                return None
+        else:
+            self.hits += 1
+            self.urls.move_to_end(key)
+        self.entries.move_to_end(digest)
+        return await self._deliver(digest)
+
+    async def _download(self, url: str, key: str) -> Optional[str]:
+        """
+        下载附件并存入缓存
+
+        :param url: 附件URL
+        :param key: url_key的返回值
+        :return: 内容哈希，失败时为None
+        """
+        async with self.semaphore:
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            try:
+                data = await asyncio.wait_for(self._read(url), self.timeout)
+            except Exception as e:
+                add_log(1, 'Attachment', 'Failed to download attachment %s. Reason: %r' % (url, e))
+                return None
+        if data is None:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.entries:
+            extension = posixpath.splitext(urlsplit(url).path)[1][:10]
+            name = digest + extension
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, self._write, name, data)
+            except OSError as e:
+                add_log(1, 'Attachment', 'Failed to cache attachment %s. Reason: %r' % (url, e))
+                return None
+            self.entries[digest] = (name, len(data))
+            self.total += len(data)
+            self._evict()
+        self.urls[key] = digest
+        if len(self.urls) > self.max_urls:
+            self.urls.popitem(last=False)
+        return digest
+
+    async def _read(self, url: str) -> Optional[bytes]:
+        async with self.session.get(url, proxy=self.proxy) as response:
+            if response.status != 200:
+                add_log(1, 'Attachment', 'Failed to download attachment %s. Response: %d' % (url, response.status))
+                return None
+            if response.content_length is not None and response.content_length > self.max_file_size:
+                return None
+            chunks = []
+            received = 0
+            async for chunk in response.content.iter_chunked(65536):
+                received += len(chunk)
+                if received > self.max_file_size:
+                    return None
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+    def _write(self, name: str, data: bytes):
+        path = os.path.join(self.path, name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _evict(self):
+        """
+        淘汰最久未使用的文件直至总大小不超过上限，最近加入的文件保留
+
+        :return:
+        """
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            _, (name, size) = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    async def _deliver(self, digest: str) -> Optional[str]:
+        name, _ = self.entries[digest]
+        path = os.path.join(self.path, name)
+        if self.delivery == 'file':
+            return pathlib.Path(os.path.abspath(path)).as_uri()
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, self._read_file, path)
+        except OSError:
+            # 文件被外部删除
+            entry = self.entries.pop(digest, None)
+            if entry is not None:
+                self.total -= entry[1]
+            return None
+        return 'base64://' + data
+
+    @staticmethod
+    def _read_file(path: str) -> str:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 更新修改时间，重启后仍按最近使用时间淘汰
+        os.utime(path)
+        return base64.b64encode(data).decode('ascii')
+
+    async def close(self):
+        """
+        关闭下载使用的连接
+
+        :return:
+        """
+        for task in list(self.fetching.values()):
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
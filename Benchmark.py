@@ -0,0 +1,839 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+性能基准测试，用法：python Benchmark.py <benchmark> [options]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+
+from Cache import DedupCache
+from Router import MonitorRouter
+from TextMatcher import CategoryClassifier, ReplaceEngine
+
+words = ['lol', 'gg', 'stream', 'tonight', 'new', 'song', 'cover', 'thanks', 'everyone', 'see', 'you', 'soon',
+         'omg', 'art', 'collab', 'announcement', 'members', 'only', 'schedule', 'week', 'live', 'at', 'pm']
+
+
+def percentile(values, p):
+    """
+    计算百分位数
+
+    :param values: 已排序的数值列表
+    :param p: 百分位，0~100
+    :return:
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def write_config(directory, **sections):
+    """
+    于临时目录中生成基准测试用的配置文件，并通过环境变量指定给Config模块
+
+    :param directory: 临时目录
+    :param sections: 覆盖默认配置的项
+    :return: 配置文件路径
+    """
+    data = {
+        'token': '',
+        'is_bot': True,
+        'coolq_url': 'http://127.0.0.1:5700',
+        'coolq_token': '',
+        'proxy': '',
+        'toast': False,
+        'log': {'path': os.path.join(directory, 'benchmark.log'), 'echo': False, 'rotate': 'none'},
+        'message_monitor': {'user_id': {}, 'channel': [], 'channel_name': []},
+        'user_dynamic_monitor': {'user_id': {}, 'server': []},
+        'push': {'QQ_group': [], 'QQ_user': []},
+        'push_text': {'message_format': '<content>', 'user_dynamic_format': '<after>', 'category': {},
+                      'replace': {}},
+    }
+    data.update(sections)
+    # 缓存文件写入临时目录
+    data['push_text'].setdefault('compile_cache', os.path.join(directory, 'compile_cache.json'))
+    data['user_dynamic_monitor'].setdefault('username_snapshot', os.path.join(directory, 'usernames.json'))
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.environ['DISCORD_MONITOR_CONFIG'] = path
+    return path
+
+
+class FakeOneBot:
+    """
+    本地模拟的onebot /send_msg接口及正向WebSocket接口，记录每条消息的接收时间
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0, drop_every=0):
+        """
+        :param latency: 响应延迟，单位为秒
+        :param failure_rate: HTTP接口返回500的概率
+        :param seed: 随机数种子
+        :param drop_every: WebSocket连接每收到若干条调用后断开，0表示不断开
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rand = random.Random(seed)
+        self.drop_every = drop_every
+        self.received = []
+        self.failures = 0
+        self.duplicates = 0
+        self.drops = 0
+        self.echoes = set()
+        self.runner = None
+        self.url = None
+        self.ws_url = None
+
+    async def send_msg(self, request):
+        from aiohttp import web
+        data = json.loads(await request.text())
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.rand.random() < self.failure_rate:
+            self.failures += 1
+            return web.Response(status=500)
+        self.received.append((time.monotonic(), data))
+        return web.json_response({'status': 'ok', 'retcode': 0, 'data': {'message_id': len(self.received)}})
+
+    async def websocket(self, request):
+        from aiohttp import web, WSMsgType
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        count = 0
+
+        async def respond(call):
+            if self.latency > 0:
+                await asyncio.sleep(self.latency)
+            if not ws.closed:
+                await ws.send_str(json.dumps({'status': 'ok', 'retcode': 0, 'data': {'message_id': len(self.received)},
+                                              'echo': call['echo']}))
+
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            call = json.loads(msg.data)
+            count += 1
+            if self.drop_every and count > self.drop_every:
+                # 断开连接，未响应的调用应在重连后重新发送
+                self.drops += 1
+                await ws.close()
+                break
+            if call['echo'] in self.echoes:
+                self.duplicates += 1
+            else:
+                self.echoes.add(call['echo'])
+                self.received.append((time.monotonic(), call['params']))
+            asyncio.ensure_future(respond(call))
+        return ws
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post('/send_msg', self.send_msg)
+        app.router.add_get('/', self.websocket)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:%d' % port
+        self.ws_url = 'ws://127.0.0.1:%d' % port
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def legacy_is_monitored_object(monitor, user, channel, server, user_dynamic=False):
+    """
+    旧版DiscordMonitor.is_monitored_object，作为路由基准测试的对照
+    """
+    if user_dynamic:
+        if len(monitor.user_dynamic_user) == 0:
+            return False
+        elif str(user.id) in monitor.user_dynamic_user and \
+                (server.id in monitor.user_dynamic_server or len(monitor.user_dynamic_server) == 0):
+            return True
+    else:
+        if len(monitor.message_user) == 0 or str(user.id) in monitor.message_user:
+            if (len(monitor.message_channel) == 0 or channel.id in monitor.message_channel or
+                    (server.name in monitor.message_channel_name and channel.name in monitor.message_channel_name[server.name])):
+                return True
+    return False
+
+
+def bench_routing(args):
+    """
+    比较旧版is_monitored_object与MonitorRouter的单次事件判断耗时
+    """
+    rand = random.Random(args.seed)
+    guilds = [SimpleNamespace(id=10 ** 17 + i, name='Server %d' % i, channels=[]) for i in range(args.guilds)]
+    for guild in guilds:
+        guild.channels = [SimpleNamespace(id=guild.id * 100 + j, name='channel-%d' % j, guild=guild)
+                          for j in range(args.channels)]
+    all_channels = [channel for guild in guilds for channel in guild.channels]
+    users = [SimpleNamespace(id=2 * 10 ** 17 + i) for i in range(args.users)]
+    monitored_users = rand.sample(users, args.monitored_users)
+    monitored_channels = rand.sample(all_channels, args.monitored_channels)
+    named_guilds = rand.sample(guilds, min(len(guilds), 5))
+    message_monitor = SimpleNamespace(
+        users={str(u.id): 'user %d' % u.id for u in monitored_users},
+        channel_ids=[c.id for c in monitored_channels],
+        channel_names={g.name: {g.channels[0].name, g.channels[1 % len(g.channels)].name} for g in named_guilds})
+    user_dynamic_monitor = SimpleNamespace(users=message_monitor.users, servers={g.id for g in guilds[:10]})
+    legacy = SimpleNamespace(message_user=message_monitor.users, message_channel=message_monitor.channel_ids,
+                             message_channel_name=message_monitor.channel_names,
+                             user_dynamic_user=user_dynamic_monitor.users,
+                             user_dynamic_server=user_dynamic_monitor.servers)
+    router = MonitorRouter(message_monitor, user_dynamic_monitor)
+    for guild in guilds:
+        router.resolve_guild(guild)
+
+    events = []
+    for _ in range(args.events):
+        channel = rand.choice(all_channels)
+        user = rand.choice(monitored_users) if rand.random() < args.hit_rate else rand.choice(users)
+        events.append((user, channel, channel.guild))
+    # 确认二者结果一致
+    for user, channel, guild in events:
+        assert legacy_is_monitored_object(legacy, user, channel, guild) == \
+            router.is_monitored_message(user.id, channel.id)
+        assert legacy_is_monitored_object(legacy, user, None, guild, True) == \
+            router.is_monitored_user_dynamic(user.id, guild.id)
+
+    def run_legacy():
+        for user, channel, guild in events:
+            legacy_is_monitored_object(legacy, user, channel, guild)
+            legacy_is_monitored_object(legacy, user, None, guild, True)
+
+    def run_router():
+        is_monitored_message = router.is_monitored_message
+        is_monitored_user_dynamic = router.is_monitored_user_dynamic
+        for user, channel, guild in events:
+            is_monitored_message(user.id, channel.id)
+            is_monitored_user_dynamic(user.id, guild.id)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat))
+    router_time = min(timeit.repeat(run_router, number=1, repeat=args.repeat))
+    checks = 2 * len(events)
+    print('legacy: %.1f ns/check' % (legacy_time / checks * 1e9))
+    print('router: %.1f ns/check' % (router_time / checks * 1e9))
+    print('speedup: %.2fx' % (legacy_time / router_time))
+
+
+def make_corpus(rand: random.Random, count: int, emoji_names, aliases):
+    """
+    生成含自定义表情、提及、链接及别名的模拟消息正文
+    """
+    corpus = []
+    for _ in range(count):
+        tokens = []
+        for _ in range(rand.randint(3, 40)):
+            r = rand.random()
+            if r < 0.12:
+                tokens.append('<%s:%s:%d>' % (rand.choice(['', 'a']), rand.choice(emoji_names),
+                                              rand.randint(10 ** 17, 10 ** 18)))
+            elif r < 0.16:
+                tokens.append('<@!%d>' % rand.randint(10 ** 17, 10 ** 18))
+            elif r < 0.18:
+                tokens.append('https://www.youtube.com/watch?v=%08x' % rand.getrandbits(32))
+            elif r < 0.24:
+                tokens.append(rand.choice(aliases))
+            else:
+                tokens.append(rand.choice(words))
+        corpus.append(' '.join(tokens))
+    return corpus
+
+
+def legacy_sub(replace_dict, content):
+    """
+    旧版PushTextProcessor.sub，作为替换基准测试的对照
+    """
+    for pattern in replace_dict:
+        content = re.sub(pattern, replace_dict[pattern], content)
+    return content
+
+
+def bench_replace(args):
+    """
+    比较逐条re.sub与ReplaceEngine单次扫描替换的耗时
+    """
+    rand = random.Random(args.seed)
+    emoji_names = ['Emote%d' % i for i in range(args.emojis)]
+    aliases = ['nick%d' % i for i in range(args.aliases)]
+    replace = dict()
+    for name in emoji_names:
+        replace['<a?:%s:\\d+>' % name] = '[表情%s]' % name[5:]
+    for alias in aliases:
+        replace['\\b%s\\b' % alias] = '别名%s' % alias[4:]
+    # 兜底的自定义表情及提及
+    replace['<a?:(\\w+):\\d+>'] = '[\\1]'
+    replace['<@!?(\\d+)>'] = '@\\1'
+    corpus = make_corpus(rand, args.messages, emoji_names + ['Unknown%d' % i for i in range(20)], aliases)
+    compiled = {re.compile(k): v for k, v in replace.items()}
+    engine = ReplaceEngine(replace)
+    for content in corpus:
+        assert legacy_sub(compiled, content) == engine.sub(content)
+
+    def run_legacy():
+        for content in corpus:
+            legacy_sub(compiled, content)
+
+    def run_engine():
+        sub = engine.sub
+        for content in corpus:
+            sub(content)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat))
+    engine_time = min(timeit.repeat(run_engine, number=1, repeat=args.repeat))
+    print('patterns: %d, stages: %d, messages: %d' % (len(replace), len(engine.stages), len(corpus)))
+    print('legacy: %.1f us/message' % (legacy_time / len(corpus) * 1e6))
+    print('engine: %.1f us/message' % (engine_time / len(corpus) * 1e6))
+    print('speedup: %.2fx' % (legacy_time / engine_time))
+
+
+def legacy_get_content_cat(content_cat_dict, content):
+    """
+    旧版PushTextProcessor.get_content_cat，作为类别匹配基准测试的对照
+    """
+    for pattern in content_cat_dict:
+        if re.search(pattern, content):
+            return content_cat_dict[pattern]
+    return None
+
+
+def bench_category(args):
+    """
+    比较逐条re.search与CategoryClassifier的类别匹配耗时
+    """
+    rand = random.Random(args.seed)
+    keywords = ['keyword%04d' % i for i in range(args.keywords)]
+    categories = dict()
+    for i, keyword in enumerate(keywords):
+        categories[keyword] = 'Category %d' % (i % 20)
+    for i in range(args.regexes):
+        categories['(?:cover|song)\\s*#%d\\b' % i] = 'Music'
+    categories['https?://(?:www\\.)?youtube\\.com/watch'] = 'Video'
+    if not args.no_fallback:
+        categories[''] = 'Others'
+    corpus = make_corpus(rand, args.messages, ['Sadge', 'Pog'], keywords[-50:] + ['nick'])
+    compiled = {re.compile(k): v for k, v in categories.items()}
+    classifier = CategoryClassifier(categories)
+    for content in corpus:
+        assert legacy_get_content_cat(compiled, content) == classifier.classify(content)
+
+    def run_legacy():
+        for content in corpus:
+            legacy_get_content_cat(compiled, content)
+
+    def run_classifier():
+        classify = classifier.classify
+        for content in corpus:
+            classify(content)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat))
+    classifier_time = min(timeit.repeat(run_classifier, number=1, repeat=args.repeat))
+    print('patterns: %d, messages: %d' % (len(categories), len(corpus)))
+    print('legacy: %.1f us/message' % (legacy_time / len(corpus) * 1e6))
+    print('classifier: %.1f us/message' % (classifier_time / len(corpus) * 1e6))
+    print('speedup: %.2fx' % (legacy_time / classifier_time))
+    hits = sorted(classifier.hit_counts().items(), key=lambda item: item[1], reverse=True)
+    print('top hits: %s' % ', '.join('%r: %d' % item for item in hits[:5]))
+
+
+async def _bench_dedup(args):
+    rand = random.Random(args.seed)
+    statuses = ['online', 'idle', 'dnd', 'offline']
+    events = []
+    for i in range(args.updates):
+        user_id = rand.randrange(args.users)
+        before, after = rand.sample(statuses, 2)
+        # 眼与用户同在多个Server中，同一动态被接收多次
+        events.extend([(user_id, before, after)] * args.servers)
+    loop = asyncio.get_event_loop()
+
+    event_set = set()
+    start = time.perf_counter()
+    for user_id, before, after in events:
+        event = str(user_id) + before + after
+        if event not in event_set:
+            event_set.add(event)
+            loop.call_later(5, event_set.discard, event)
+    legacy_time = time.perf_counter() - start
+    timers = len(loop._scheduled)
+
+    cache = DedupCache(ttl=5, max_size=args.max_size)
+    start = time.perf_counter()
+    for user_id, before, after in events:
+        cache.check((user_id, 'status', before, after))
+    cache_time = time.perf_counter() - start
+    print('events: %d, unique: %d' % (len(events), cache.misses))
+    print('legacy: %.2f us/event, pending timers: %d' % (legacy_time / len(events) * 1e6, timers))
+    print('cache: %.2f us/event, entries: %d, hits: %d, evictions: %d' %
+          (cache_time / len(events) * 1e6, len(cache), cache.hits, cache.evictions))
+    for handle in loop._scheduled:
+        handle.cancel()
+
+
+def bench_dedup(args):
+    """
+    比较set加逐事件定时器与DedupCache的用户动态去重耗时
+    """
+    asyncio.run(_bench_dedup(args))
+
+
+async def _bench_prefilter(args):
+    import discord
+    from Prefilter import GatewayPrefilter
+    rand = random.Random(args.seed)
+    # 成员缓存随状态更新增减，与启用presences及members intents的bot一致
+    client = discord.Client(intents=discord.Intents.all(), max_messages=None)
+    state = client._connection
+    guild_id = 10 ** 17
+    guild = discord.Guild(data={'id': guild_id, 'name': 'Server', 'member_count': args.users}, state=state)
+    state._add_guild(guild)
+    monitored = set(2 * 10 ** 17 + i for i in range(args.monitored_users))
+    statuses = ['online', 'idle', 'dnd', 'offline']
+    payloads = []
+    for i in range(args.updates):
+        user_id = 2 * 10 ** 17 + rand.randrange(args.users)
+        user = {'id': str(user_id), 'username': 'user%d' % user_id, 'discriminator': '0001', 'avatar': None}
+        if rand.random() < 0.8:
+            activities = [{'name': rand.choice(words), 'type': 0}] if rand.random() < 0.5 else []
+            payloads.append(('PRESENCE_UPDATE', {'guild_id': str(guild_id), 'user': user, 'roles': [],
+                                                 'activities': activities, 'status': rand.choice(statuses),
+                                                 'client_status': {}}))
+        else:
+            payloads.append(('GUILD_MEMBER_UPDATE', {'guild_id': str(guild_id), 'user': user, 'roles': [],
+                                                     'nick': rand.choice(words), 'joined_at': None}))
+    parsers = state.parsers
+    start = time.perf_counter()
+    for event, data in payloads:
+        parsers[event](data)
+    plain_time = time.perf_counter() - start
+    plain_members = len(guild._members)
+    guild._members.clear()
+    prefilter = GatewayPrefilter(client, lambda user_id, server_id: user_id in monitored)
+    prefilter.install()
+    start = time.perf_counter()
+    for event, data in payloads:
+        parsers[event](data)
+    prefilter_time = time.perf_counter() - start
+    passed = sum(1 for _, data in payloads if int(data['user']['id']) in monitored)
+    print('updates: %d, users: %d, monitored: %d, passed: %d' %
+          (len(payloads), args.users, args.monitored_users, passed))
+    print('discord.py: %.2f us/update, cached members: %d' % (plain_time / len(payloads) * 1e6, plain_members))
+    print('prefilter: %.2f us/update, cached members: %d' %
+          (prefilter_time / len(payloads) * 1e6, len(guild._members)))
+    print('speedup: %.1fx' % (plain_time / prefilter_time))
+    await client.close()
+
+
+def bench_prefilter(args):
+    """
+    比较discord.py直接解析与经gateway预过滤后解析成员更新事件的耗时
+    """
+    asyncio.run(_bench_prefilter(args))
+
+
+async def _bench_push(args, directory):
+    server = FakeOneBot(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed,
+                        drop_every=args.drop_every)
+    await server.start()
+    push = {'QQ_group': [[10000 + i, True, True] for i in range(args.targets)], 'QQ_user': [],
+            'workers': args.workers, 'connection_limit': args.workers, 'target_rate': args.target_rate,
+            'target_burst': args.target_burst, 'global_rate': args.global_rate, 'global_burst': args.global_burst,
+            'retry_base': 0.05, 'retry_max_delay': 0.5,
+            'outbox': {'enable': args.outbox, 'path': os.path.join(directory, 'outbox.db')},
+            'coalesce': {'enable': args.coalesce > 0, 'window': args.coalesce}}
+    write_config(directory, coolq_url=server.url, coolq_transport=args.transport, coolq_ws_url=server.ws_url,
+                 coolq_ws_fallback=not args.no_fallback, push=push)
+    import Log
+    from Config import config
+    from PushTextProcessor import PushTextProcessor
+    from QQPush import QQPush
+    Log.init_log(config.log)
+    qq_push = QQPush(PushTextProcessor().render_digest)
+    await qq_push.start()
+    if args.transport == 'websocket':
+        await asyncio.wait_for(qq_push.transport.connected.wait(), 5)
+    expected = args.messages * args.targets
+    start = time.monotonic()
+    for i in range(args.messages):
+        asyncio.ensure_future(qq_push.push_message('bench %d %.6f' % (i, time.monotonic()), 1))
+        if args.interval > 0:
+            await asyncio.sleep(args.interval)
+    # 合并推送中包含多条消息，按消息中的发送时间戳统计
+    stamp = re.compile(r'bench \d+ ([\d.]+)')
+    latencies = []
+    while len(latencies) < expected and time.monotonic() - start < args.timeout:
+        await asyncio.sleep(0.01)
+        latencies = [t - float(sent) for t, data in server.received for sent in stamp.findall(data['message'])]
+    elapsed = time.monotonic() - start
+    await qq_push.close()
+    await server.stop()
+    Log.close_log()
+    latencies.sort()
+    print('delivered: %d/%d in %d requests, server errors: %d' %
+          (len(latencies), expected, len(server.received), server.failures))
+    if args.transport == 'websocket':
+        print('websocket drops: %d, resent duplicates: %d' % (server.drops, server.duplicates))
+    print('throughput: %.1f msg/s' % (len(latencies) / elapsed))
+    print('latency p50: %.1f ms, p99: %.1f ms, max: %.1f ms' %
+          (percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, percentile(latencies, 100) * 1000))
+    # 连接断开时已被接收但未响应的消息会被重新推送，至少送达一次即可
+    return 0 if len(latencies) >= expected else 1
+
+
+def resource_usage():
+    """
+    取得进程CPU时间及峰值内存
+
+    :return: (CPU时间（秒）, 峰值RSS（MB），不支持时为None)
+    """
+    cpu = time.process_time()
+    try:
+        import resource
+    except ImportError:
+        return cpu, None
+    # Linux下ru_maxrss单位为KB，macOS下为字节
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return cpu, maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def make_workload(args, rand: random.Random):
+    """
+    生成端到端基准测试的Server、用户及事件序列
+
+    :return: (监听配置, 事件列表, 预期推送数量)
+    """
+    from LiteModels import LiteActivity, LiteAttachment, LiteChannel, LiteGuild, LiteMember, LiteMessage, LiteUser
+    guilds = []
+    for i in range(args.guilds):
+        guild = LiteGuild(10 ** 17 + i, 'Server %d' % i)
+        guild.channels = [LiteChannel(guild.id * 100 + j, 'channel-%d' % j, guild) for j in range(args.channels)]
+        guilds.append(guild)
+    all_channels = [channel for guild in guilds for channel in guild.channels]
+    users = [LiteUser(2 * 10 ** 17 + i, 'user%d' % i, '%04d' % (i % 10000)) for i in range(args.users)]
+    monitored_users = rand.sample(users, args.monitored_users)
+    monitored_channels = rand.sample(all_channels, args.monitored_channels)
+    monitored_user_ids = {user.id for user in monitored_users}
+    monitored_channel_ids = {channel.id for channel in monitored_channels}
+    sections = {
+        'message_monitor': {'user_id': {str(user.id): user.name for user in monitored_users},
+                            'channel': sorted(monitored_channel_ids), 'channel_name': []},
+        'user_dynamic_monitor': {'user_id': {str(user.id): user.name for user in monitored_users},
+                                 'server': [guild.id for guild in guilds[:args.dynamic_servers]]},
+    }
+    dynamic_servers = {guild.id for guild in guilds[:args.dynamic_servers]}
+    emoji_names = ['Emote%d' % i for i in range(args.emojis)]
+    corpus = make_corpus(rand, 500, emoji_names + ['Unknown%d' % i for i in range(20)], ['nick%d' % i for i in range(20)])
+    kinds = ['message', 'edit', 'delete', 'member']
+    weights = [args.messages, args.edits, args.deletes, args.members]
+    events = []
+    expected = 0
+    for seq in range(args.events):
+        kind = rand.choices(kinds, weights)[0]
+        stamp = 'e2e %d' % seq
+        if kind == 'member':
+            guild = rand.choice(guilds)
+            user = rand.choice(monitored_users) if rand.random() < args.hit_rate else rand.choice(users)
+            before = LiteMember(user, guild, nick='before', status='online', activity=LiteActivity('game'))
+            after = before.copy(nick=stamp)
+            events.append((seq, 'on_member_update', (before, after)))
+            if user.id in monitored_user_ids and guild.id in dynamic_servers:
+                expected += 1
+            continue
+        if rand.random() < args.hit_rate:
+            user, channel = rand.choice(monitored_users), rand.choice(monitored_channels)
+        else:
+            user, channel = rand.choice(users), rand.choice(all_channels)
+        attachments = []
+        if rand.random() < 0.1:
+            attachments.append(LiteAttachment(seq, 'https://cdn.example.com/%d.png' % seq, '%d.png' % seq, 'image/png'))
+        content = '%s %s' % (stamp, rand.choice(corpus))
+        message = LiteMessage(seq, content, user, channel, attachments)
+        if kind == 'message':
+            events.append((seq, 'on_message', (message,)))
+        elif kind == 'edit':
+            events.append((seq, 'on_message_edit', (message.copy(content='old'), message)))
+        else:
+            events.append((seq, 'on_message_delete', (message,)))
+        if user.id in monitored_user_ids and channel.id in monitored_channel_ids:
+            expected += 1
+    return sections, events, expected
+
+
+async def _bench_e2e(args, directory):
+    rand = random.Random(args.seed)
+    server = FakeOneBot(latency=args.latency, seed=args.seed)
+    await server.start()
+    sections, events, expected = make_workload(args, rand)
+    replace = {'<a?:Emote%d:\\d+>' % i: '[表情%d]' % i for i in range(args.emojis)}
+    replace['<a?:(\\w+):\\d+>'] = '[\\1]'
+    replace['<@!?(\\d+)>'] = '@\\1'
+    category = {'keyword%04d' % i: 'Category %d' % i for i in range(args.categories)}
+    category['https?://(?:www\\.)?youtube\\.com/watch'] = 'Video'
+    category[''] = 'Others'
+    push = {'QQ_group': [[10000 + i, True, True] for i in range(args.targets)], 'QQ_user': [],
+            'workers': args.workers, 'connection_limit': args.workers, 'target_rate': 0, 'global_rate': 0,
+            'queue_size': max(1000, args.events)}
+    push_text = {'message_format': '<type> <user_display_name> #<channel_name>: <content> <attachment> <time>',
+                 'user_dynamic_format': '<type> <user_display_name>: <before> -> <after>',
+                 'category': category, 'replace': replace}
+    write_config(directory, coolq_url=server.url, push=push, push_text=push_text,
+                 user_dynamic_monitor=sections['user_dynamic_monitor'], message_monitor=sections['message_monitor'])
+    import Log
+    from Config import config
+    Log.init_log(config.log)
+    from DiscordMonitor import DiscordMonitor
+    monitor = DiscordMonitor(loop=asyncio.get_event_loop())
+    await monitor.qq_push.start()
+
+    stamp = re.compile(r'e2e (\d+)')
+    sent = [0.0] * len(events)
+    cpu_start, _ = resource_usage()
+    start = time.monotonic()
+    interval = 1 / args.rate if args.rate > 0 else 0
+    for i, (seq, handler, handler_args) in enumerate(events):
+        if interval:
+            delay = start + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent[seq] = time.monotonic()
+        await getattr(monitor, handler)(*handler_args)
+        if not interval and i % 256 == 0:
+            # 让出事件循环，使推送任务得以执行
+            await asyncio.sleep(0)
+    ingest_time = time.monotonic() - start
+    received = 0
+    while received < expected * args.targets and time.monotonic() - start < args.timeout:
+        await asyncio.sleep(0.01)
+        received = len(server.received)
+    elapsed = time.monotonic() - start
+    cpu_end, maxrss = resource_usage()
+    latencies = sorted(t - sent[int(seq)] for t, data in server.received
+                       for seq in stamp.findall(data['message'])[:1])
+    await monitor.close()
+    await server.stop()
+    Log.close_log()
+
+    rate = len(events) / ingest_time
+    p99 = percentile(latencies, 99) * 1000
+    print('events: %d, monitored: %d, targets: %d' % (len(events), expected, args.targets))
+    print('pushes delivered: %d/%d' % (len(latencies), expected * args.targets))
+    print('ingest: %.0f events/s, end to end: %.0f events/s' % (rate, len(events) / elapsed))
+    print('latency p50: %.1f ms, p90: %.1f ms, p99: %.1f ms, max: %.1f ms' %
+          (percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000, p99,
+           percentile(latencies, 100) * 1000))
+    print('cpu time: %.2f s, peak rss: %s' % (cpu_end - cpu_start, '%.1f MB' % maxrss if maxrss else 'n/a'))
+    failed = False
+    if len(latencies) < expected * args.targets:
+        print('FAIL: %d pushes were not delivered' % (expected * args.targets - len(latencies)))
+        failed = True
+    if args.min_rate > 0 and rate < args.min_rate:
+        print('FAIL: ingest rate %.0f events/s is below --min-rate %.0f' % (rate, args.min_rate))
+        failed = True
+    if args.max_p99 > 0 and p99 > args.max_p99:
+        print('FAIL: p99 latency %.1f ms is above --max-p99 %.1f' % (p99, args.max_p99))
+        failed = True
+    return 1 if failed else 0
+
+
+def bench_e2e(args):
+    """
+    将模拟的gateway事件送入DiscordMonitor各事件处理方法，推送至本地模拟的onebot服务，统计端到端吞吐量、延迟及资源占用
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        return asyncio.run(_bench_e2e(args, directory))
+
+
+def bench_push(args):
+    """
+    向本地模拟的onebot服务推送消息，统计QQPush的吞吐量及延迟
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        return asyncio.run(_bench_push(args, directory))
+
+
+# 启动耗时测试的子进程，输出各阶段耗时及已导入的可选依赖
+startup_child = """
+import time
+start = time.perf_counter()
+import asyncio, json, sys
+import DiscordMonitor
+imported = time.perf_counter()
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+monitor = DiscordMonitor.DiscordMonitor(loop=loop)
+constructed = time.perf_counter()
+loop.run_until_complete(monitor.qq_push.close())
+print(json.dumps({'import': imported - start, 'construct': constructed - imported,
+                  'plyer': 'plyer' in sys.modules, 'pytz': 'pytz' in sys.modules}))
+"""
+
+
+def bench_startup(args):
+    """
+    以无交互模式启动子进程，比较有无编译缓存时导入模块及构造DiscordMonitor的耗时
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        replace = dict()
+        for i in range(args.emojis):
+            replace['<a?:Emote%d:\\d+>' % i] = '[表情%d]' % i
+        for i in range(args.aliases):
+            replace['\\bnick%d\\b' % i] = '别名%d' % i
+        replace['<a?:(\\w+):\\d+>'] = '[\\1]'
+        category = {'keyword%04d' % i: 'Category %d' % (i % 20) for i in range(args.keywords)}
+        for i in range(args.regexes):
+            category['(?:cover|song)\\s*#%d\\b' % i] = 'Music'
+        push_text = {'message_format': '<type> <user_display_name> #<channel_name>: <content> <time>',
+                     'user_dynamic_format': '<type> <user_display_name>: <before> -> <after>',
+                     'category': category, 'replace': replace}
+        path = write_config(directory, push_text=push_text)
+        cache_path = push_text['compile_cache']
+        env = dict(os.environ, DISCORD_MONITOR_CONFIG=path, DISCORD_MONITOR_HEADLESS='1',
+                   PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        results = {'cold': [], 'warm': []}
+        for i in range(args.repeat):
+            for mode in ('cold', 'warm'):
+                if mode == 'cold' and os.path.exists(cache_path):
+                    os.remove(cache_path)
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', startup_child], env=env, cwd=directory,
+                                        stdin=subprocess.DEVNULL, capture_output=True, text=True)
+                wall = time.perf_counter() - start
+                if output.returncode != 0:
+                    print(output.stderr)
+                    return 1
+                result = json.loads(output.stdout.strip().splitlines()[-1])
+                result['wall'] = wall
+                results[mode].append(result)
+        print('patterns: replace %d, category %d, runs: %d' % (len(replace), len(category), args.repeat))
+        for mode, runs in results.items():
+            median = {key: sorted(run[key] for run in runs)[len(runs) // 2] for key in ('wall', 'import', 'construct')}
+            print('%s: process %.1f ms, import %.1f ms, construct %.1f ms' %
+                  (mode, median['wall'] * 1e3, median['import'] * 1e3, median['construct'] * 1e3))
+        print('imported plyer: %s, pytz: %s' % (results['warm'][0]['plyer'], results['warm'][0]['pytz']))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Discord Monitor benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    routing = subparsers.add_parser('routing', help='is_monitored_object vs MonitorRouter')
+    routing.add_argument('--guilds', type=int, default=200)
+    routing.add_argument('--channels', type=int, default=50)
+    routing.add_argument('--users', type=int, default=10000)
+    routing.add_argument('--monitored-users', type=int, default=20)
+    routing.add_argument('--monitored-channels', type=int, default=30)
+    routing.add_argument('--hit-rate', type=float, default=0.01)
+    routing.add_argument('--events', type=int, default=100000)
+    routing.add_argument('--repeat', type=int, default=5)
+    routing.add_argument('--seed', type=int, default=0)
+    routing.set_defaults(func=bench_routing)
+
+    replace = subparsers.add_parser('replace', help='sequential re.sub vs ReplaceEngine')
+    replace.add_argument('--emojis', type=int, default=300)
+    replace.add_argument('--aliases', type=int, default=100)
+    replace.add_argument('--messages', type=int, default=2000)
+    replace.add_argument('--repeat', type=int, default=3)
+    replace.add_argument('--seed', type=int, default=0)
+    replace.set_defaults(func=bench_replace)
+
+    category = subparsers.add_parser('category', help='sequential re.search vs CategoryClassifier')
+    category.add_argument('--keywords', type=int, default=500)
+    category.add_argument('--regexes', type=int, default=10)
+    category.add_argument('--messages', type=int, default=2000)
+    category.add_argument('--no-fallback', action='store_true', help='do not append the "" catch-all category')
+    category.add_argument('--repeat', type=int, default=3)
+    category.add_argument('--seed', type=int, default=0)
+    category.set_defaults(func=bench_category)
+
+    dedup = subparsers.add_parser('dedup', help='event_set with call_later vs DedupCache')
+    dedup.add_argument('--updates', type=int, default=20000)
+    dedup.add_argument('--users', type=int, default=2000)
+    dedup.add_argument('--servers', type=int, default=10, help='servers shared by the monitor and each user')
+    dedup.add_argument('--max-size', type=int, default=10000)
+    dedup.add_argument('--seed', type=int, default=0)
+    dedup.set_defaults(func=bench_dedup)
+
+    prefilter = subparsers.add_parser('prefilter', help='discord.py member update parsing with and without the prefilter')
+    prefilter.add_argument('--updates', type=int, default=50000)
+    prefilter.add_argument('--users', type=int, default=20000)
+    prefilter.add_argument('--monitored-users', type=int, default=20)
+    prefilter.add_argument('--seed', type=int, default=0)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    e2e = subparsers.add_parser('e2e', help='synthetic gateway events through DiscordMonitor to a fake onebot server')
+    e2e.add_argument('--events', type=int, default=20000)
+    e2e.add_argument('--rate', type=float, default=0, help='events/s, 0 for as fast as possible')
+    e2e.add_argument('--guilds', type=int, default=100)
+    e2e.add_argument('--channels', type=int, default=20)
+    e2e.add_argument('--users', type=int, default=5000)
+    e2e.add_argument('--monitored-users', type=int, default=20)
+    e2e.add_argument('--monitored-channels', type=int, default=30)
+    e2e.add_argument('--dynamic-servers', type=int, default=10, help='servers watched for user dynamics')
+    e2e.add_argument('--hit-rate', type=float, default=0.05, help='share of events from monitored users')
+    e2e.add_argument('--messages', type=float, default=6, help='relative weight of MESSAGE_CREATE')
+    e2e.add_argument('--edits', type=float, default=1, help='relative weight of MESSAGE_UPDATE')
+    e2e.add_argument('--deletes', type=float, default=1, help='relative weight of MESSAGE_DELETE')
+    e2e.add_argument('--members', type=float, default=2, help='relative weight of member updates')
+    e2e.add_argument('--emojis', type=int, default=200, help='emoji replace patterns')
+    e2e.add_argument('--categories', type=int, default=200, help='keyword category patterns')
+    e2e.add_argument('--targets', type=int, default=2)
+    e2e.add_argument('--workers', type=int, default=16)
+    e2e.add_argument('--latency', type=float, default=0.002, help='fake server response latency in seconds')
+    e2e.add_argument('--min-rate', type=float, default=0, help='fail if ingest events/s is below this')
+    e2e.add_argument('--max-p99', type=float, default=0, help='fail if p99 latency in ms is above this')
+    e2e.add_argument('--timeout', type=float, default=120.0)
+    e2e.add_argument('--seed', type=int, default=0)
+    e2e.set_defaults(func=bench_e2e)
+
+    push = subparsers.add_parser('push', help='QQPush load test against a fake onebot server')
+    push.add_argument('--messages', type=int, default=200)
+    push.add_argument('--targets', type=int, default=10)
+    push.add_argument('--interval', type=float, default=0.0, help='seconds between two push_message calls')
+    push.add_argument('--workers', type=int, default=8)
+    push.add_argument('--target-rate', type=float, default=0, help='per-target messages/s, 0 for unlimited')
+    push.add_argument('--target-burst', type=int, default=3)
+    push.add_argument('--global-rate', type=float, default=0, help='global messages/s, 0 for unlimited')
+    push.add_argument('--global-burst', type=int, default=10)
+    push.add_argument('--latency', type=float, default=0.01, help='fake server response latency in seconds')
+    push.add_argument('--failure-rate', type=float, default=0.0)
+    push.add_argument('--outbox', action='store_true', help='commit pushes to the on-disk outbox')
+    push.add_argument('--transport', choices=['http', 'websocket'], default='http')
+    push.add_argument('--drop-every', type=int, default=0,
+                      help='close the websocket after this many actions to exercise reconnect, 0 to disable')
+    push.add_argument('--no-fallback', action='store_true', help='do not fall back to http while reconnecting')
+    push.add_argument('--coalesce', type=float, default=0.0, help='coalescing window in seconds, 0 to disable')
+    push.add_argument('--timeout', type=float, default=60.0)
+    push.add_argument('--seed', type=int, default=0)
+    push.set_defaults(func=bench_push)
+
+    startup = subparsers.add_parser('startup', help='headless process start with and without the compile cache')
+    startup.add_argument('--emojis', type=int, default=300)
+    startup.add_argument('--aliases', type=int, default=100)
+    startup.add_argument('--keywords', type=int, default=500)
+    startup.add_argument('--regexes', type=int, default=10)
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
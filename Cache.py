@@ -0,0 +1,332 @@
+import datetime
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Set
+
+from LiteModels import LiteMessage
+
+
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    """
+    将discord.py使用的不含时区的UTC时间转换为含时区的时间
+
+    :param value: datetime
+    :return:
+    """
+    return value.replace(tzinfo=datetime.timezone.utc) if value.tzinfo is None else value
+
+
+class DedupCache:
+    """
+    有容量上限的定时去重缓存
+
+    所有键的存活时间相同，插入顺序即过期顺序，因此过期的键总位于OrderedDict头部，每次查询时顺带清理，无需为每个键设置定时器。
+    超出容量上限时淘汰最早插入的键。
+    """
+
+    def __init__(self, ttl: float = 5.0, max_size: int = 10000):
+        """
+        :param ttl: 键的存活时间，单位为秒
+        :param max_size: 键数量上限
+        """
+        self.ttl = ttl
+        self.max_size = max(max_size, 1)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 最早插入的键的过期时间，未到此时间无需清理
+        self._oldest = float('inf')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable):
+        expiry = self.entries.get(key)
+        return expiry is not None and expiry > time.monotonic()
+
+    def _expire(self, now: float):
+        entries = self.entries
+        while entries:
+            key = next(iter(entries))
+            expiry = entries[key]
+            if expiry > now:
+                self._oldest = expiry
+                return
+            del entries[key]
+        self._oldest = float('inf')
+
+    def check(self, key: Hashable) -> bool:
+        """
+        检查键是否已在缓存中，不在则加入缓存
+
+        :param key: 事件键
+        :return: 键为新键时返回True，重复时返回False
+        """
+        now = time.monotonic()
+        if now >= self._oldest:
+            self._expire(now)
+        if key in self.entries:
+            self.hits += 1
+            return False
+        self.misses += 1
+        if not self.entries:
+            self._oldest = now + self.ttl
+        self.entries[key] = now + self.ttl
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def configure(self, ttl: float, max_size: int):
+        """
+        修改存活时间及数量上限，重新加载配置时调用
+
+        已有键的过期时间随存活时间的变化平移，插入顺序仍为过期顺序；超出新上限的最早的键立即淘汰。
+
+        :param ttl: 键的存活时间，单位为秒
+        :param max_size: 键数量上限
+        :return:
+        """
+        delta = ttl - self.ttl
+        self.ttl = ttl
+        self.max_size = max(max_size, 1)
+        if delta:
+            for key in self.entries:
+                self.entries[key] += delta
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self._oldest = next(iter(self.entries.values()), float('inf'))
+
+    def clear(self):
+        """
+        清空缓存
+
+        :return:
+        """
+        self.entries.clear()
+        self._oldest = float('inf')
+
+
+class PinState:
+    """
+    单个频道的标注消息状态
+    """
+
+    __slots__ = ('ids', 'last_pin', 'loaded')
+
+    def __init__(self):
+        # 已知被标注的消息ID
+        self.ids: Set[int] = set()
+        # 最近一次标注的时间
+        self.last_pin: Optional[datetime.datetime] = None
+        # ids是否已由完整的标注列表初始化
+        self.loaded = False
+
+
+class PinCache:
+    """
+    各频道的标注消息缓存
+
+    由频道标注更新事件中的最新标注时间区分标注与取消标注，取消标注时无需请求标注列表；
+    标注时请求标注列表并与缓存比较得出新标注的消息。缓存在首次收到事件时创建，并随消息编辑事件中的标注状态更新。
+    """
+
+    def __init__(self, recent: float = 60.0):
+        """
+        :param recent: 未缓存的频道中，最新标注时间距今不超过此时间（秒）时视为标注
+        """
+        self.recent = datetime.timedelta(seconds=recent)
+        self.channels: Dict[int, PinState] = dict()
+
+    def get(self, channel_id: int) -> PinState:
+        """
+        取得频道的标注状态，不存在时创建
+
+        :param channel_id: 频道ID
+        :return:
+        """
+        state = self.channels.get(channel_id)
+        if state is None:
+            state = PinState()
+            self.channels[channel_id] = state
+        return state
+
+    def is_new_pin(self, channel_id: int, last_pin: Optional[datetime.datetime]) -> bool:
+        """
+        判断频道标注更新事件是否为新标注，并记录最新标注时间
+
+        :param channel_id: 频道ID
+        :param last_pin: 事件中的最新标注时间，为None表示频道中已无标注消息
+        :return:
+        """
+        state = self.get(channel_id)
+        if last_pin is None:
+            state.ids.clear()
+            state.loaded = True
+            state.last_pin = None
+            return False
+        if state.last_pin is None:
+            is_new = datetime.datetime.now(datetime.timezone.utc) - as_utc(last_pin) <= self.recent
+        else:
+            is_new = as_utc(last_pin) > as_utc(state.last_pin)
+        if is_new or state.last_pin is None:
+            state.last_pin = last_pin
+        return is_new
+
+    def update(self, channel_id: int, ids) -> Set[int]:
+        """
+        以完整的标注列表更新缓存
+
+        :param channel_id: 频道ID
+        :param ids: 按标注时间由新到旧排列的消息ID
+        :return: 缓存中没有的消息ID；缓存未初始化时仅包含最新标注的消息
+        """
+        state = self.get(channel_id)
+        ids = list(ids)
+        if state.loaded:
+            new_ids = set(ids) - state.ids
+        else:
+            new_ids = set(ids[:1]) - state.ids
+        state.ids = set(ids)
+        state.loaded = True
+        return new_ids
+
+    def set_pinned(self, channel_id: int, message_id: int, pinned: bool) -> bool:
+        """
+        由消息编辑事件更新消息的标注状态
+
+        :param channel_id: 频道ID
+        :param message_id: 消息ID
+        :param pinned: 是否被标注
+        :return: 状态是否改变
+        """
+        state = self.get(channel_id)
+        if pinned:
+            if message_id in state.ids:
+                return False
+            state.ids.add(message_id)
+            return True
+        if message_id not in state.ids:
+            return False
+        state.ids.discard(message_id)
+        return True
+
+
+class MessageStore:
+    """
+    被监听消息缓存
+
+    仅缓存通过监听过滤的消息，以LiteMessage紧凑记录保存，各频道分别限制数量及存活时间，用于处理消息编辑及删除的原始事件。
+    收到消息的频道在加入时清理，其余频道每sweep_interval秒于读写时统一清理一次，不再收到消息的频道中的过期消息亦会被移除。
+    """
+
+    def __init__(self, max_per_channel: int = 1000, max_age: float = 604800, sweep_interval: float = 60.0):
+        """
+        :param max_per_channel: 每个频道缓存的消息数量上限
+        :param max_age: 消息的存活时间，以消息发送时间计，单位为秒，不大于0表示不限
+        :param sweep_interval: 清理所有频道中过期消息的间隔，单位为秒
+        """
+        self.channels: Dict[int, 'OrderedDict[int, LiteMessage]'] = dict()
+        self.count = 0
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.configure(max_per_channel, max_age)
+
+    def __len__(self):
+        return self.count
+
+    def configure(self, max_per_channel: int, max_age: float):
+        """
+        修改数量上限及存活时间，重新加载配置时调用，超出新限制的消息立即移除
+
+        :param max_per_channel: 每个频道缓存的消息数量上限
+        :param max_age: 消息的存活时间，单位为秒，不大于0表示不限
+        :return:
+        """
+        self.max_per_channel = max(max_per_channel, 1)
+        self.max_age = datetime.timedelta(seconds=max_age) if max_age > 0 else None
+        self.sweep()
+
+    def add(self, message) -> LiteMessage:
+        """
+        缓存消息，同一ID的消息被替换
+
+        :param message: Message或LiteMessage
+        :return: 缓存的记录
+        """
+        self._maybe_sweep()
+        record = LiteMessage.from_message(message)
+        channel_id = record.channel.id
+        messages = self.channels.get(channel_id)
+        if messages is None:
+            messages = OrderedDict()
+            self.channels[channel_id] = messages
+        if record.id not in messages:
+            self.count += 1
+        # 编辑后的消息保持原有位置，各频道的消息按发送顺序排列
+        messages[record.id] = record
+        self._trim(messages, self._cutoff())
+        return record
+
+    def _cutoff(self) -> Optional[datetime.datetime]:
+        if self.max_age is None:
+            return None
+        return datetime.datetime.now(datetime.timezone.utc) - self.max_age
+
+    def _trim(self, messages: 'OrderedDict[int, LiteMessage]', cutoff: Optional[datetime.datetime]):
+        while len(messages) > self.max_per_channel:
+            messages.popitem(last=False)
+            self.count -= 1
+        if cutoff is not None:
+            while messages:
+                oldest = next(iter(messages.values()))
+                if as_utc(oldest.created_at) >= cutoff:
+                    break
+                messages.popitem(last=False)
+                self.count -= 1
+
+    def _maybe_sweep(self):
+        if time.monotonic() >= self._next_sweep:
+            self.sweep()
+
+    def sweep(self):
+        """
+        清理所有频道中超出数量上限或过期的消息，移除已无消息的频道
+
+        :return:
+        """
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        cutoff = self._cutoff()
+        for channel_id in list(self.channels):
+            messages = self.channels[channel_id]
+            self._trim(messages, cutoff)
+            if not messages:
+                del self.channels[channel_id]
+
+    def get(self, channel_id: int, message_id: int) -> Optional[LiteMessage]:
+        self._maybe_sweep()
+        messages = self.channels.get(channel_id)
+        if messages is None:
+            return None
+        return messages.get(message_id)
+
+    def pop(self, channel_id: int, message_id: int) -> Optional[LiteMessage]:
+        """
+        移除并返回缓存的消息
+
+        :param channel_id: 频道ID
+        :param message_id: 消息ID
+        :return: 未缓存时为None
+        """
+        self._maybe_sweep()
+        messages = self.channels.get(channel_id)
+        if messages is None:
+            return None
+        record = messages.pop(message_id, None)
+        if record is not None:
+            self.count -= 1
+            if not messages:
+                del self.channels[channel_id]
+        return record
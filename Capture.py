@@ -0,0 +1,146 @@
+import gzip
+import json
+import queue
+import threading
+import time
+import traceback
+from typing import Iterator
+
+from Log import add_log
+
+# 录制的gateway事件类型
+recorded_events = frozenset(['MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'PRESENCE_UPDATE',
+                             'GUILD_MEMBER_UPDATE', 'CHANNEL_PINS_UPDATE'])
+
+
+class GatewayRecorder:
+    """
+    gateway事件录制器
+
+    将与监听相关的原始dispatch事件连同接收时间、Server名及频道名写入gzip压缩的JSON Lines文件。
+    事件于事件循环中序列化后放入有界队列，由后台线程压缩写入，队列满时丢弃并计数。
+    """
+
+    def __init__(self, path: str, queue_size: int = 10000):
+        """
+        :param path: 录制文件路径
+        :param queue_size: 队列长度上限
+        """
+        self.path = path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.recorded = 0
+        self._thread = None
+
+    def start(self):
+        """
+        启动后台写入线程
+
+        :return:
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='GatewayRecorder', daemon=True)
+            self._thread.start()
+            add_log(0, 'Capture', 'Recording gateway events to %s' % self.path)
+
+    def record(self, msg: dict, client=None):
+        """
+        录制一条gateway消息，非dispatch消息及无关事件被忽略
+
+        :param msg: on_socket_response收到的gateway消息
+        :param client: discord.Client，用于标注Server名及频道名
+        :return:
+        """
+        event_type = msg.get('t')
+        if event_type not in recorded_events or self._thread is None:
+            return
+        data = msg.get('d') or dict()
+        record = {'time': time.time(), 'type': event_type, 'd': data}
+        if client is not None:
+            guild_id = data.get('guild_id')
+            channel_id = data.get('channel_id')
+            if guild_id is not None:
+                guild = client.get_guild(int(guild_id))
+                if guild is not None:
+                    record['guild_name'] = guild.name
+            if channel_id is not None:
+                channel = client.get_channel(int(channel_id))
+                if channel is not None and hasattr(channel, 'name'):
+                    record['channel_name'] = channel.name
+        try:
+            self.queue.put_nowait(json.dumps(record, ensure_ascii=False))
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0):
+        """
+        写入剩余事件并关闭文件
+
+        :param timeout: 等待时间，单位为秒
+        :return:
+        """
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+        log = 'Recorded %d gateway events to %s' % (self.recorded, self.path)
+        if self.dropped:
+            log += ', %d dropped' % self.dropped
+        add_log(0, 'Capture', log)
+
+    def _run(self):
+        try:
+            with gzip.open(self.path, 'at', encoding='utf8') as f:
+                closing = False
+                last_flush = time.monotonic()
+                while not closing:
+                    try:
+                        lines = [self.queue.get(timeout=1.0)]
+                    except queue.Empty:
+                        lines = []
+                    while True:
+                        try:
+                            lines.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    if None in lines:
+                        closing = True
+                        lines = [line for line in lines if line is not None]
+                    if lines:
+                        f.write('\n'.join(lines))
+                        f.write('\n')
+                    # 每秒至多刷新一次，异常退出时仅丢失最后一秒的事件
+                    if time.monotonic() - last_flush >= 1.0:
+                        f.flush()
+                        last_flush = time.monotonic()
+        except Exception:
+            traceback.print_exc()
+
+
+def read_capture(path: str) -> Iterator[dict]:
+    """
+    逐行读取录制文件，无需将整个文件读入内存
+
+    :param path: 录制文件路径，以.gz结尾时按gzip解压
+    :return: 录制的事件
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf8') as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 录制中断时最后一行可能不完整
+                    continue
+        except EOFError:
+            # 录制进程异常退出时gzip文件末尾不完整
+            return
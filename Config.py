@@ -1,21 +1,61 @@
+import argparse
 import json
 import os
 import platform
 import sys
 
 
+def resolve_path(path: str, directory: str) -> str:
+    """
+    将相对路径解析为相对于配置文件所在目录的路径，空字符串表示不使用该文件
+
+    :param path: 配置中的路径
+    :param directory: 配置文件所在目录
+    :return:
+    """
+    if not path:
+        return path
+    return os.path.join(directory, path)
+
+
 class Config:
-    def __init__(self, data: dict):
+    def __init__(self, data: dict, directory: str = ''):
+        """
+        :param data: 配置文件内容
+        :param directory: 配置文件所在目录，用户名快照及编译缓存的相对路径以此为基准
+        """
+        # 原始配置，重新加载时用于比较需重启方可生效的项
+        self.data = data
         self.token = data['token']
         self.bot = data['is_bot']
         self.cqhttp_url = data['coolq_url'].rstrip('/')
         self.cqhttp_token = data['coolq_token']
+        self.cqhttp_transport = data.get('coolq_transport', 'http')
+        self.cqhttp_ws_url = data.get('coolq_ws_url', 'ws://localhost:6700').rstrip('/')
+        self.cqhttp_ws_fallback = data.get('coolq_ws_fallback', True)
         self.proxy = data['proxy']
+        # 首个账号为token及is_bot指定的账号，其余账号于accounts中指定，共用推送队列及去重缓存
+        self.accounts = [Config.Account({'token': self.token, 'is_bot': self.bot}, self.proxy)]
+        self.accounts.extend(Config.Account(account, self.proxy) for account in data.get('accounts', []))
         self.toast = data['toast']
+        self.notifier = Config.Notifier(data.get('notifier', dict()))
+        self.archive = Config.Archive(data.get('archive', dict()))
         self.message_monitor = Config.MessageMonitor(data['message_monitor'])
-        self.user_dynamic_monitor = Config.UserDynamicMonitor(data['user_dynamic_monitor'])
+        self.user_dynamic_monitor = Config.UserDynamicMonitor(data['user_dynamic_monitor'], directory)
         self.push = Config.Push(data['push'])
-        self.push_content = Config.PushContent(data['push_text'])
+        self.push_content = Config.PushContent(data['push_text'], directory)
+        self.log = Config.Log(data.get('log', dict()))
+        self.subscription = Config.Subscription(data.get('subscription', dict()))
+        self.metrics = Config.Metrics(data.get('metrics', dict()))
+        self.capture = Config.Capture(data.get('capture', dict()))
+        self.reload = Config.Reload(data.get('reload', dict()))
+        self.attachment_cache = Config.AttachmentCache(data.get('attachment_cache', dict()))
+
+    class Account:
+        def __init__(self, data: dict, proxy: str):
+            self.token = data['token']
+            self.bot = data['is_bot']
+            self.proxy = data.get('proxy', proxy)
 
     class MessageMonitor:
         def __init__(self, data: dict):
@@ -29,41 +69,207 @@ class Config:
                     self.channel_names[guilds[0]] = channels
                 for i in range(1, len(guilds)):
                     channels.add(guilds[i])
+            self.pin_debounce = data.get('pin_debounce', 1.0)
+            self.dedup_ttl = data.get('dedup_ttl', 30.0)
+            self.dedup_max_size = data.get('dedup_max_size', 10000)
+            self.cache_size = data.get('cache_size', 1000)
+            self.cache_age = data.get('cache_age', 604800)
 
     class UserDynamicMonitor:
-        def __init__(self, data: dict):
+        def __init__(self, data: dict, directory: str = ''):
             self.users = data['user_id']
             self.servers = set(data['server'])
+            self.dedup_ttl = data.get('dedup_ttl', 5.0)
+            self.dedup_max_size = data.get('dedup_max_size', 10000)
+            self.username_snapshot = resolve_path(data.get('username_snapshot', 'username_snapshot.json'), directory)
+            self.fetch_concurrency = data.get('fetch_concurrency', 4)
+            self.fetch_rate = data.get('fetch_rate', 5.0)
+            self.prefilter = data.get('prefilter', False)
 
     class Push:
         def __init__(self, data: dict):
             self.groups = data['QQ_group']
             self.users = data['QQ_user']
+            self.workers = data.get('workers', 4)
+            self.connection_limit = data.get('connection_limit', 8)
+            self.queue_size = data.get('queue_size', 1000)
+            self.target_rate = data.get('target_rate', 1.0)
+            self.target_burst = data.get('target_burst', 3)
+            self.global_rate = data.get('global_rate', 5.0)
+            self.global_burst = data.get('global_burst', 10)
+            self.max_retries = data.get('max_retries', 5)
+            self.retry_base = data.get('retry_base', 1.0)
+            self.retry_max_delay = data.get('retry_max_delay', 30.0)
+            self.outbox = Config.Outbox(data.get('outbox', dict()))
+            self.coalesce = Config.Coalesce(data.get('coalesce', dict()))
 
-    class PushContent:
+    class Outbox:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.path = data.get('path', 'push_outbox.db')
+            self.max_messages = data.get('max_messages', 10000)
+            self.commit_interval = data.get('commit_interval', 0.05)
+            self.retry_interval = data.get('retry_interval', 60)
+
+    class Coalesce:
         def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.window = data.get('window', 3.0)
+            self.max_messages = data.get('max_messages', 10)
+            self.max_length = data.get('max_length', 3000)
+            self.priority_categories = data.get('priority_categories', [])
+
+    class PushContent:
+        def __init__(self, data: dict, directory: str = ''):
             self.categories = data["category"]
             self.message_format = data["message_format"]
             self.user_dynamic_format = data["user_dynamic_format"]
             self.replace = data["replace"]
+            self.digest_format = data.get("digest_format", "【<count>条动态】\n<messages>")
+            self.digest_separator = data.get("digest_separator", "\n\n")
+            self.compile_cache = resolve_path(data.get("compile_cache", "compile_cache.json"), directory)
+            self.sandbox = Config.Sandbox(data.get("sandbox", dict()))
+
+    class Sandbox:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.workers = data.get('workers', 2)
+            self.budget = data.get('budget', 0.05)
+            self.batch_size = data.get('batch_size', 64)
+            self.batch_delay = data.get('batch_delay', 0.005)
+            self.quarantine_after = data.get('quarantine_after', 3)
+            self.stats_interval = data.get('stats_interval', 300)
+
+    class Subscription:
+        def __init__(self, data: dict):
+            self.rate = data.get('rate', 1.0)
+            self.burst = data.get('burst', 5)
+            self.max_channels = data.get('max_channels', 5)
+
+    class Metrics:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.host = data.get('host', '127.0.0.1')
+            self.port = data.get('port', 9108)
+            self.lag_interval = data.get('lag_interval', 1.0)
+
+    class Capture:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.path = data.get('path', 'gateway_capture.jsonl.gz')
+            self.queue_size = data.get('queue_size', 10000)
+
+    class AttachmentCache:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.path = data.get('path', 'attachment_cache')
+            self.max_bytes = data.get('max_size_mb', 500) * 1024 * 1024
+            self.max_file_size = data.get('max_file_size_mb', 10) * 1024 * 1024
+            self.concurrency = data.get('concurrency', 4)
+            self.timeout = data.get('timeout', 15.0)
+            self.wait = data.get('wait', 2.0)
+            self.delivery = data.get('delivery', 'base64')
+
+    class Notifier:
+        def __init__(self, data: dict):
+            self.backend = data.get('backend', 'toast')
+            self.path = data.get('path', 'notifications.txt')
+            self.queue_size = data.get('queue_size', 100)
+            self.merge_window = data.get('merge_window', 2.0)
+            self.max_length = data.get('max_length', 250)
+
+    class Archive:
+        def __init__(self, data: dict):
+            self.enable = data.get('enable', False)
+            self.path = data.get('path', 'archive.db')
+            self.commit_interval = data.get('commit_interval', 1.0)
+            self.queue_size = data.get('queue_size', 10000)
+
+    class Reload:
+        def __init__(self, data: dict):
+            self.watch = data.get('watch', True)
+            self.interval = data.get('interval', 2.0)
+
+    class Log:
+        def __init__(self, data: dict):
+            self.path = data.get('path', 'discord_monitor.log')
+            self.queue_size = data.get('queue_size', 10000)
+            self.batch_size = data.get('batch_size', 256)
+            self.flush_interval = data.get('flush_interval', 1.0)
+            self.rotate = data.get('rotate', 'size')
+            self.max_bytes = data.get('max_size_mb', 10) * 1024 * 1024
+            self.backup_count = data.get('backup_count', 10)
+            self.json_lines = data.get('json_lines', False)
+            self.echo = data.get('echo', True)
+
+
+# 当前使用的配置文件路径，由read_config设置
+config_path = 'config.json'
+
+
+def parse_arguments():
+    """
+    解析命令行中的--config及--headless参数，忽略其余参数
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--config')
+    parser.add_argument('--headless', action='store_true')
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def is_headless(args=None) -> bool:
+    """
+    判断是否以无交互模式运行，即指定--headless、设置DISCORD_MONITOR_HEADLESS环境变量或标准输入不是终端时，
+    不询问配置文件路径，退出前亦不暂停
+
+    :param args: parse_arguments的返回值
+    :return:
+    """
+    if args is None:
+        args = parse_arguments()
+    if args.headless or os.environ.get('DISCORD_MONITOR_HEADLESS'):
+        return True
+    return sys.stdin is None or not sys.stdin.isatty()
+
+
+def load_config(path: str) -> Config:
+    """
+    读取并解析配置文件，出错时抛出异常
+
+    :param path: 配置文件路径
+    :return:
+    """
+    with open(path, 'r', encoding='utf8') as f:
+        return Config(json.load(f), os.path.dirname(path))
 
 
 def read_config() -> Config:
+    global config_path
+    args = parse_arguments()
+    headless = is_headless(args)
     while True:
         config_path = 'config.json'
         try:
-            config_path_temp = input('请输入配置文件路径，空输入则为默认(默认为config.json):\n')
+            # 由命令行或环境变量指定时不再询问配置文件路径
+            config_path_temp = args.config or os.environ.get('DISCORD_MONITOR_CONFIG')
+            specified = config_path_temp is not None or headless
+            if config_path_temp is None:
+                config_path_temp = '' if headless else input('请输入配置文件路径，空输入则为默认(默认为config.json):\n')
             if config_path_temp != '':
                 config_path = config_path_temp
-            with open(config_path, 'r', encoding='utf8') as f:
-                return Config(json.load(f))
+            return load_config(config_path)
         except FileNotFoundError:
-            print('配置文件不存在')
+            print('配置文件不存在: %s' % config_path)
+            if specified:
+                sys.exit(1)
         except KeyboardInterrupt:
             sys.exit(1)
         except Exception:
             print('配置文件读取出错，请检查配置文件各参数是否正确')
-            if platform.system() == 'Windows':
+            if platform.system() == 'Windows' and not headless:
                 os.system('pause')
             sys.exit(1)
 
@@ -2,49 +2,140 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import datetime
+import json
 import os
 import platform
 import traceback
 
 import discord
 from aiohttp import ClientConnectorError, ClientProxyConnectionError, InvalidURL
-from plyer import notification
-from pytz import timezone as tz
 
-from Config import config
-from Log import add_log
+from Accounts import SharedPipeline
+from Attachments import image_cqcode
+from Cache import PinCache
+from Capture import recorded_events
+import Config
+from Config import config, is_headless, load_config
+from Log import add_log, close_log, init_log
+from Metrics import events_filtered_total, events_total, timed
+from Notifier import create_notifier
+from Prefilter import GatewayPrefilter
 from PushTextProcessor import PushTextProcessor
-from QQPush import QQPush
+from QQPush import TokenBucket
+from Reload import ConfigWatcher
+from Router import MonitorRouter
+from Subscription import SubscriptionScheduler
 
 # Log file path
 log_path = 'discord_monitor.log'
 # Timezone
-timezone = tz('Asia/Shanghai')
+timezone_name = 'Asia/Shanghai'
 
+
+def load_timezone(name: str):
+    """
+    取得时区，优先使用标准库zoneinfo，系统缺少时区数据时改用pytz
+
+    :param name: 时区名
+    :return: tzinfo
+    """
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+    except Exception:
+        from pytz import timezone as tz
+        return tz(name)
+
+
+timezone = load_timezone(timezone_name)
 img_MIME = ["image/png", "image/jpeg", "image/gif"]
 
+# 重新加载配置时无法生效，需重启方可生效的配置项
+restart_keys = ['token', 'is_bot', 'proxy', 'accounts', 'coolq_url', 'coolq_token', 'coolq_transport', 'coolq_ws_url',
+                'coolq_ws_fallback', 'log', 'metrics', 'capture', 'subscription', 'reload', 'attachment_cache',
+                'notifier', 'archive']
+# 推送设置中可重新加载的项
+reloadable_push_keys = ['QQ_group', 'QQ_user', 'coalesce']
+
 
 class DiscordMonitor(discord.Client):
 
-    def __init__(self, **kwargs):
-        if config.proxy:
-            discord.Client.__init__(self, proxy=config.proxy, **kwargs)
+    def __init__(self, shared: SharedPipeline = None, account=None, **kwargs):
+        """
+        :param shared: 多个账号共用的推送及去重组件，为None时单独创建并于关闭时一同关闭
+        :param account: Config.Account，为None时使用配置中的首个账号
+        :param kwargs: discord.Client的参数
+        """
+        self.account = account if account is not None else config.accounts[0]
+        # 消息编辑及删除由被监听消息缓存处理，关闭discord.py缓存所有频道消息的全局缓存
+        kwargs.setdefault('max_messages', None)
+        if self.account.proxy:
+            discord.Client.__init__(self, proxy=self.account.proxy, **kwargs)
         else:
             discord.Client.__init__(self, **kwargs)
-        self.message_user = config.message_monitor.users
-        self.message_channel = config.message_monitor.channel_ids
-        self.message_channel_name = config.message_monitor.channel_names
-        self.user_dynamic_user = config.user_dynamic_monitor.users
-        self.user_dynamic_server = config.user_dynamic_monitor.servers
-        self.qq_push = QQPush()
-        self.push_text_processor = PushTextProcessor()
-        self.event_set = set()
+        self.owns_shared = shared is None
+        if shared is None:
+            shared = SharedPipeline(config)
+        self.shared = shared
+        shared.monitors.append(self)
+        self.config = config
+        self.set_monitors(config, MonitorRouter(config.message_monitor, config.user_dynamic_monitor))
+        self.push_text_processor = shared.push_text_processor
+        self.qq_push = shared.qq_push
+        # 用户动态及消息动态去重缓存，多个账号共用
+        self.event_cache = shared.event_cache
+        self.message_cache = shared.message_cache
+        self.message_store = shared.message_store
+        self.archive = shared.archive
+        # 多个账号同在一个Server中时，仅由归属账号处理该Server的事件
+        self.guild_owners = shared.guild_owners
+        # 各频道的标注消息缓存，及尚未完成的标注列表请求
+        self.pin_cache = PinCache()
+        self.pin_fetches = dict()
+        self.pin_debounce = config.message_monitor.pin_debounce
         self.status_dict = {'online': '在线', 'offline': '离线', 'idle': '闲置', 'dnd': '请勿打扰'}
-        self.username_dict = {}
-        if platform.system() == 'Windows' and platform.release() == '10' and config.toast:
-            self.do_toast = True
-        else:
-            self.do_toast = False
+        # 被监听用户的用户名及Tag，启动时从快照文件读取，连接后在后台刷新
+        self.username_snapshot = config.user_dynamic_monitor.username_snapshot
+        if shared.username_dict is None:
+            shared.username_dict = self.load_username_snapshot()
+        self.username_dict = shared.username_dict
+        self.username_task = None
+        self.fetch_semaphore = asyncio.Semaphore(config.user_dynamic_monitor.fetch_concurrency)
+        self.fetch_bucket = TokenBucket(config.user_dynamic_monitor.fetch_rate,
+                                        config.user_dynamic_monitor.fetch_concurrency)
+        self.do_toast = shared.notifier is not None
+        # 运行状态指标
+        self.metrics_server = shared.metrics_server
+        # gateway事件录制，仅启用时注册on_socket_response，避免为每条gateway消息创建任务
+        self.recorder = shared.recorder
+        if self.recorder is not None:
+            self.on_socket_response = self.record_socket_response
+        # 未被监听用户的成员更新事件于解析前丢弃
+        self.prefilter = GatewayPrefilter(self, self.accepts_member_update)
+        if config.user_dynamic_monitor.prefilter:
+            self.prefilter.install()
+        # 用户Token的Server订阅调度
+        self.subscriptions = SubscriptionScheduler(self, self.router, self.message_monitoring, self.user_monitoring,
+                                                   config.subscription.rate, config.subscription.burst,
+                                                   config.subscription.max_channels)
+        # 配置文件变更或收到SIGHUP时重新加载配置
+        self.config_watcher = ConfigWatcher(Config.config_path, self.prepare_config, self.apply_config,
+                                            config.reload.interval if config.reload.watch else 0)
+
+    def set_monitors(self, new_config, router: MonitorRouter):
+        """
+        设置被监听对象及路由索引
+
+        :param new_config: Config
+        :param router: 由new_config生成的路由索引
+        :return:
+        """
+        self.message_user = new_config.message_monitor.users
+        self.message_channel = new_config.message_monitor.channel_ids
+        self.message_channel_name = new_config.message_monitor.channel_names
+        self.user_dynamic_user = new_config.user_dynamic_monitor.users
+        self.user_dynamic_server = new_config.user_dynamic_monitor.servers
+        self.router = router
         self.message_monitoring = True
         self.user_monitoring = True
         if 0 in self.message_channel and len(self.message_channel_name) == 0:
@@ -52,6 +143,122 @@ class DiscordMonitor(discord.Client):
         if 0 in self.user_dynamic_server or len(self.user_dynamic_user) == 0:
             self.user_monitoring = False
 
+    @staticmethod
+    def prepare_config(path: str):
+        """
+        读取配置文件并编译路由索引及推送模板，于线程池中调用，配置有误时抛出异常
+
+        :param path: 配置文件路径
+        :return: (Config, MonitorRouter, PushTextProcessor)
+        """
+        new_config = load_config(path)
+        router = MonitorRouter(new_config.message_monitor, new_config.user_dynamic_monitor)
+        processor = PushTextProcessor(new_config.push_content)
+        return new_config, router, processor
+
+    def apply_config(self, prepared):
+        """
+        替换各账号的被监听对象、路由索引、推送模板及推送对象，gateway连接及各缓存保持不变
+
+        :param prepared: prepare_config的返回值
+        :return:
+        """
+        new_config, router, processor = prepared
+        old_data = self.config.data
+        new_data = new_config.data
+        changed = [key for key in restart_keys if old_data.get(key) != new_data.get(key)]
+        changed.extend('push.' + key for key in set(old_data['push']) | set(new_data['push'])
+                       if key not in reloadable_push_keys and old_data['push'].get(key) != new_data['push'].get(key))
+        if changed:
+            log_text = 'Config changes to %s take effect after a restart.' % ', '.join(sorted(changed))
+            add_log(1, 'Config', log_text)
+        if processor is not self.shared.push_text_processor:
+            self.shared.push_text_processor.close()
+        self.shared.push_text_processor = processor
+        self.message_store.configure(new_config.message_monitor.cache_size, new_config.message_monitor.cache_age)
+        self.event_cache.configure(new_config.user_dynamic_monitor.dedup_ttl,
+                                   new_config.user_dynamic_monitor.dedup_max_size)
+        self.message_cache.configure(new_config.message_monitor.dedup_ttl, new_config.message_monitor.dedup_max_size)
+        if new_config.toast and self.shared.notifier is None:
+            self.shared.notifier = create_notifier(new_config)
+        self.qq_push.update_config(new_config.push, processor.render_digest)
+        for monitor in self.shared.monitors:
+            if monitor is not self:
+                # 各账号所在的Server不同，频道名解析结果需各自保存
+                monitor.apply_monitor_config(new_config, MonitorRouter(new_config.message_monitor,
+                                                                       new_config.user_dynamic_monitor), processor)
+        self.apply_monitor_config(new_config, router, processor)
+
+    def apply_monitor_config(self, new_config, router: MonitorRouter, processor: PushTextProcessor):
+        """
+        替换本账号的被监听对象、路由索引及推送模板
+
+        :param new_config: Config
+        :param router: 由new_config生成、尚未解析频道名的路由索引
+        :param processor: 由new_config生成的PushTextProcessor
+        :return:
+        """
+        for guild in self.guilds:
+            router.resolve_guild(guild)
+        old_users = self.router.dynamic_users
+        self.set_monitors(new_config, router)
+        self.push_text_processor = processor
+        self.pin_debounce = new_config.message_monitor.pin_debounce
+        self.do_toast = new_config.toast and self.shared.notifier is not None
+        self.config = new_config
+        subscriptions = self.subscriptions
+        if new_config.user_dynamic_monitor.prefilter:
+            self.prefilter.install()
+        else:
+            self.prefilter.uninstall()
+        subscriptions.router = router
+        subscriptions.message_monitoring = self.message_monitoring
+        subscriptions.user_monitoring = self.user_monitoring
+        if not self.is_ready():
+            return
+        if not self.user.bot:
+            subscriptions.schedule_all(self.owned_guilds())
+        # 新增的被监听用户需取得用户名
+        if self.user_monitoring and router.dynamic_users - old_users and \
+                (self.username_task is None or self.username_task.done()):
+            self.username_task = asyncio.ensure_future(self.refresh_usernames())
+
+    def accepts_member_update(self, user_id: int, guild_id: int) -> bool:
+        """
+        判断成员更新事件是否需要解析，供gateway预过滤器调用
+
+        :param user_id: 用户ID
+        :param guild_id: Server ID
+        :return:
+        """
+        return self.user_monitoring and self.router.is_monitored_user_dynamic(user_id, guild_id)
+
+    def owns(self, guild) -> bool:
+        """
+        判断Server的事件是否由本账号处理，Server无归属时归属于本账号
+
+        :param guild: Guild，私聊时为None
+        :return:
+        """
+        return guild is None or self.guild_owners.claim(guild.id, self)
+
+    def owns_payload(self, payload) -> bool:
+        """
+        判断原始事件是否由本账号处理，于读取或修改多个账号共用的被监听消息缓存前调用
+
+        :param payload: 原始事件
+        :return:
+        """
+        return payload.guild_id is None or self.guild_owners.claim(payload.guild_id, self)
+
+    def owned_guilds(self) -> list:
+        """
+        取得归属于本账号的Server
+
+        :return:
+        """
+        return [guild for guild in self.guilds if self.owns(guild)]
+
     def is_monitored_object(self, user, channel, server, user_dynamic=False):
         """
         判断事件是否由被检测对象发出
@@ -62,25 +269,11 @@ class DiscordMonitor(discord.Client):
         :param server:动态来源Server
         :return:
         """
-        # 用户动态
         if user_dynamic:
-            # 被检测用户列表为空
-            if len(self.user_dynamic_user) == 0:
-                return False
-            # 用户id在列表中 且 server在列表中或列表为空
-            elif str(user.id) in self.user_dynamic_user and \
-                    (server.id in self.user_dynamic_server or len(self.user_dynamic_server) == 0):
-                return True
-        # 消息动态
-        else:
-            # 被检测用户列表为空 或 用户id在列表中
-            if len(self.message_user) == 0 or str(user.id) in self.message_user:
-                # 被检测频道列表为空 或 频道在列表中 或 频道名称在列表中
-                if (len(self.message_channel) == 0 or channel.id in self.message_channel or
-                        (server.name in self.message_channel_name and channel.name in self.message_channel_name[server.name])):
-                    return True
-        return False
+            return self.router.is_monitored_user_dynamic(user.id, server.id) and self.owns(server)
+        return self.router.is_monitored_message(user.id, channel.id) and self.owns(server)
 
+    @timed('process_message')
     async def process_message(self, message: discord.Message, status):
         """
         处理消息动态，并生成推送消息文本及log
@@ -89,26 +282,46 @@ class DiscordMonitor(discord.Client):
         :param status: 消息动态
         :return:
         """
-        content_cat = self.push_text_processor.get_content_cat(message.content)
+        # Server归属转移期间，同一消息可能由多个账号收到；每次编辑的编辑时间不同，编辑回此前的正文时仍推送
+        if not self.message_cache.check((message.id, status, message.edited_at, message.content)):
+            return
+        # 重新加载配置期间保持使用同一推送模板
+        processor = self.push_text_processor
+        content_cat = await processor.get_content_cat_async(message.content)
         if not content_cat and content_cat != "":
             return
+        template = processor.message_template
+        # 仅计算推送模板中出现的关键词
+        with_image = 'image' in template
+        with_content = 'content' in template
         attachment_urls = list()
-        image_cqcodes = list()
+        # (图片URL, 大小)
+        images = list()
         for attachment in message.attachments:
             attachment_urls.append(attachment.url)
-            if attachment.content_type in img_MIME:
-                # 尝试利用discord.py加载图片为base64，使用代理情况下会无法连接
-                #image = await attachment.read(use_cached=False)
-                #image_base64 = base64.b64encode(image).decode("utf8")
-                #image_cqcodes.append(f"[CQ:image,file=base64://{image_base64}==,timeout=5]")
-                image_cqcodes.append(f"[CQ:image,file={attachment.url},timeout=5]")
+            if with_image and attachment.content_type in img_MIME:
+                images.append((attachment.url, attachment.size))
         for embed in message.embeds:
             if embed.image.proxy_url:
-                image_cqcodes.append(f"[CQ:image,file={embed.image.proxy_url},timeout=5]")
+                if with_image:
+                    images.append((embed.image.proxy_url, None))
                 attachment_urls.append(embed.image.proxy_url)
+        attachment_cache = self.shared.attachment_cache
+        if images and attachment_cache is not None:
+            # 经代理下载并缓存图片，推送本地路径或base64，cqhttp应用无需访问discord
+            # 下载失败或未于wait秒内完成时推送原链接，避免后续消息的推送先于本条，未完成的下载在后台继续
+            fetches = [asyncio.ensure_future(attachment_cache.fetch(url, size)) for url, size in images]
+            await asyncio.wait(fetches, timeout=self.config.attachment_cache.wait)
+            files = [fetch.result() if fetch.done() and not fetch.cancelled() and fetch.exception() is None else None
+                     for fetch in fetches]
+        else:
+            files = [None] * len(images)
+        image_cqcodes = [image_cqcode(url, file) for (url, _), file in zip(images, files)]
         attachment_str = ' ; '.join(attachment_urls)
-        image_str = "".join(image_cqcodes)
-        content = self.push_text_processor.sub(message.content)
+        if with_content or self.do_toast:
+            content = await processor.sub_async(message.content)
+        else:
+            content = message.content
         if self.do_toast:
             if status == '标注消息':
                 toast_title = '%s #%s %s' % (message.guild.name, message.channel.name, status)
@@ -120,42 +333,47 @@ class DiscordMonitor(discord.Client):
                 toast_text = content[:240] + "..." if len(message.attachments) == 0 else content + "..." + "[附件]"
             else:
                 toast_text = content if len(message.attachments) == 0 else content + "[附件]"
-            notification.notify(toast_title, toast_text, app_icon='icon.ico', app_name='Discord Monitor')
+            self.shared.notifier.notify(toast_title, toast_text)
         if len(attachment_str) > 0:
             attachment_log = '. Attachment: ' + attachment_str
         else:
             attachment_log = ''
-        if status == '发送消息':
-            t = message.created_at.replace(tzinfo=datetime.timezone.utc).astimezone(timezone).strftime(
-                '%Y/%m/%d %H:%M:%S')
-        else:
-            t = datetime.datetime.now(tz=timezone).strftime('%Y/%m/%d %H:%M:%S')
         log_text = '%s: ID: %d. Username: %s. Server: %s. Channel: %s. Content: %s%s' % \
                    (status, message.author.id,
                     message.author.name + '#' + message.author.discriminator,
                     message.guild.name, message.channel.name, message.content, attachment_log)
         add_log(0, 'Discord', log_text)
+        if self.archive is not None:
+            self.archive.record_message(status, message, content_cat)
         keywords = {"type": status,
                     "user_id": str(message.author.id),
                     "user_name": message.author.name,
                     "user_discriminator": message.author.discriminator,
-                    "channel_id:": str(message.channel.id),
+                    "channel_id": str(message.channel.id),
                     "channel_name": message.channel.name,
                     "server_id": str(message.guild.id),
                     "server_name": message.guild.name,
-                    "content": self.push_text_processor.escape_cqcode(content),
                     "content_cat": content_cat,
                     "attachment": attachment_str,
-                    "image": image_str,
-                    "time": t,
-                    "timezone": timezone.zone}
+                    "timezone": timezone_name}
+        if with_content:
+            keywords["content"] = processor.escape_cqcode(content)
+        if with_image:
+            keywords["image"] = "".join(image_cqcodes)
+        if 'time' in template:
+            if status == '发送消息':
+                keywords["time"] = message.created_at.replace(tzinfo=datetime.timezone.utc).astimezone(
+                    timezone).strftime('%Y/%m/%d %H:%M:%S')
+            else:
+                keywords["time"] = datetime.datetime.now(tz=timezone).strftime('%Y/%m/%d %H:%M:%S')
         if len(self.message_user) != 0:
             keywords["user_display_name"] = self.message_user[str(message.author.id)]
         else:
             keywords["user_display_name"] = message.author.name + '#' + message.author.discriminator
-        push_text = self.push_text_processor.push_text_process(keywords, is_user_dynamic=False)
-        asyncio.create_task(self.qq_push.push_message(push_text, 1))
+        push_text = processor.push_text_process(keywords, is_user_dynamic=False)
+        asyncio.create_task(self.qq_push.push_message(push_text, 1, content_cat))
 
+    @timed('process_user_update')
     async def process_user_update(self, before, after, user: discord.Member, status):
         """
         处理用户动态，并生成推送消息文本及log
@@ -171,13 +389,14 @@ class DiscordMonitor(discord.Client):
         if self.do_toast:
             toast_title = '%s %s' % (self.user_dynamic_user[str(user.id)], status)
             toast_text = '变更后：%s' % after
-            notification.notify(toast_title, toast_text[:250], app_icon='icon.ico', app_name='Discord Monitor')
-        t = datetime.datetime.now(tz=timezone).strftime('%Y/%m/%d %H:%M:%S')
+            self.shared.notifier.notify(toast_title, toast_text)
         log_text = '%s: ID: %d. Username: %s. Server: %s. Before: %s. After: %s.' % \
                    (status, user.id,
                     user.name + '#' + user.discriminator,
                     user.guild.name, before, after)
         add_log(0, 'Discord', log_text)
+        if self.archive is not None:
+            self.archive.record_user_update(status, user, before, after)
         keywords = {"type": status,
                     "user_id": user.id,
                     "user_name": user.name,
@@ -187,9 +406,12 @@ class DiscordMonitor(discord.Client):
                     "server_name": user.guild.name,
                     "before": before,
                     "after": after,
-                    "time": t,
-                    "timezone": timezone.zone}
-        push_text = self.push_text_processor.push_text_process(keywords, is_user_dynamic=True)
+                    "timezone": timezone_name}
+        # 重新加载配置期间保持使用同一推送模板
+        processor = self.push_text_processor
+        if 'time' in processor.user_dynamic_template:
+            keywords["time"] = datetime.datetime.now(tz=timezone).strftime('%Y/%m/%d %H:%M:%S')
+        push_text = processor.push_text_process(keywords, is_user_dynamic=True)
         asyncio.create_task(self.qq_push.push_message(push_text, 2))
 
     async def on_ready(self, *args, **kwargs):
@@ -200,27 +422,19 @@ class DiscordMonitor(discord.Client):
         :param kwargs:
         :return:
         """
+        for guild in self.guilds:
+            self.router.resolve_guild(guild)
         if not self.user.bot:
-            for guild in self.guilds:
-                payload = {
-                    "op": 14,
-                    "d": {
-                        "guild_id": str(guild.id),
-                        "typing": True,
-                        "threads": False,
-                        "activities": True,
-                        "members": [],
-                        "channels": {
-                            str(guild.channels[0].id): [
-                                [
-                                    0,
-                                    99
-                                ]
-                            ]
-                        }
-                    }
-                }
-                asyncio.ensure_future(self.ws.send_as_json(payload), loop=self.loop)
+            self.subscriptions.schedule_all(self.owned_guilds())
+
+    async def on_resumed(self):
+        """
+        会话恢复后重新订阅Server，重写自discord.Client
+
+        :return:
+        """
+        if not self.user.bot:
+            self.subscriptions.schedule_all(self.owned_guilds())
 
     async def on_connect(self):
         """
@@ -235,20 +449,111 @@ class DiscordMonitor(discord.Client):
         log_text = 'Logged in as %s, ID: %d.' % (self.user.name + '#' + self.user.discriminator, self.user.id)
         print(log_text + '\n')
         add_log(0, 'Discord', log_text)
-        if self.user_monitoring:
-            for uid in self.user_dynamic_user:
-                uid = int(uid)
-                user = None
-                for guild in self.guilds:
-                    try:
-                        user = await guild.fetch_member(uid)
-                    except:
-                        continue
-                if user:
-                    self.username_dict[uid] = [user.name, user.discriminator]
-                else:
-                    log_text = 'Fetching ID %s\'s username failed.' % uid
-                    add_log(2, 'Discord', log_text)
+        if self.user_monitoring and (self.username_task is None or self.username_task.done()):
+            self.username_task = asyncio.ensure_future(self.refresh_usernames())
+
+    async def refresh_usernames(self):
+        """
+        刷新所监视用户的用户名列表并保存快照。优先从本地成员缓存中查找，其余用户并发请求，每个用户在首个成功的Server处停止
+
+        :return:
+        """
+        await self.wait_until_ready()
+        # 优先在监听的Server中查找
+        servers = self.router.dynamic_servers
+        guilds = sorted(self.guilds, key=lambda guild: servers is not None and guild.id not in servers)
+        missing = []
+        for uid in self.router.dynamic_users:
+            for guild in guilds:
+                member = guild.get_member(uid)
+                if member is not None:
+                    self.username_dict[uid] = [member.name, member.discriminator]
+                    break
+            else:
+                missing.append(uid)
+        results = await asyncio.gather(*[self.fetch_username(uid, guilds) for uid in missing])
+        for uid, member in zip(missing, results):
+            if member is not None:
+                self.username_dict[uid] = [member.name, member.discriminator]
+            elif uid in self.username_dict:
+                log_text = 'Fetching ID %s\'s username failed, using username from snapshot.' % uid
+                add_log(1, 'Discord', log_text)
+            else:
+                log_text = 'Fetching ID %s\'s username failed.' % uid
+                add_log(2, 'Discord', log_text)
+        await self.loop.run_in_executor(None, self.save_username_snapshot, dict(self.username_dict))
+
+    async def fetch_username(self, uid: int, guilds):
+        """
+        依次在各Server中请求用户信息，成功时即停止
+
+        :param uid: 用户ID
+        :param guilds: Server列表
+        :return: Member，均失败时为None
+        """
+        for guild in guilds:
+            await self.fetch_bucket.acquire()
+            try:
+                async with self.fetch_semaphore:
+                    return await guild.fetch_member(uid)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                continue
+        return None
+
+    def load_username_snapshot(self):
+        """
+        读取用户名快照文件
+
+        :return: 用户ID至[用户名, Tag]的字典
+        """
+        if not self.username_snapshot:
+            return {}
+        try:
+            with open(self.username_snapshot, 'r', encoding='utf8') as f:
+                data = json.load(f)
+            return {int(uid): [name, discriminator] for uid, (name, discriminator) in data.items()}
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            log_text = 'Failed to load username snapshot %s.' % self.username_snapshot
+            add_log(1, 'Discord', log_text)
+            return {}
+
+    def save_username_snapshot(self, username_dict):
+        """
+        保存用户名快照文件，先写入临时文件再替换，避免写入中断时损坏快照
+
+        :param username_dict: 用户ID至[用户名, Tag]的字典
+        :return:
+        """
+        if not self.username_snapshot:
+            return
+        temp_path = self.username_snapshot + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf8') as f:
+                json.dump({str(uid): value for uid, value in username_dict.items()}, f, ensure_ascii=False)
+            os.replace(temp_path, self.username_snapshot)
+        except Exception:
+            log_text = 'Failed to save username snapshot %s.' % self.username_snapshot
+            add_log(1, 'Discord', log_text)
+
+    async def record_socket_response(self, msg):
+        """
+        录制gateway事件，启用录制时作为on_socket_response注册
+
+        :param msg: gateway消息
+        :return:
+        """
+        if msg.get('t') not in recorded_events:
+            return
+        # 多个账号同在一个Server中时，仅录制归属账号收到的事件
+        data = msg.get('d')
+        if isinstance(data, dict) and data.get('guild_id') is not None and \
+                not self.guild_owners.claim(int(data['guild_id']), self):
+            return
+        self.recorder.record(msg, self)
 
     async def on_disconnect(self):
         """
@@ -259,6 +564,8 @@ class DiscordMonitor(discord.Client):
         log_text = 'Disconnected...'
         add_log(1, 'Discord', log_text)
         print()
+        # 断开期间由同在各Server中的其他账号接管
+        self.guild_owners.release_all(self)
 
     async def on_message(self, message):
         """
@@ -267,10 +574,16 @@ class DiscordMonitor(discord.Client):
         :param message: Message
         :return:
         """
+        events_total.inc('on_message')
         if not self.message_monitoring:
             return
+        if not self.is_monitored_object(message.author, message.channel, message.guild):
+            events_filtered_total.inc('on_message', 'unmonitored')
         # 消息标注事件亦会被捕获，同时其content及attachments为空，需特判排除
-        if self.is_monitored_object(message.author, message.channel, message.guild) and (message.content != '' or len(message.attachments) > 0):
+        elif message.content == '' and len(message.attachments) == 0:
+            events_filtered_total.inc('on_message', 'empty')
+        else:
+            self.message_store.add(message)
             await self.process_message(message, '发送消息')
 
     async def on_message_delete(self, message):
@@ -280,10 +593,64 @@ class DiscordMonitor(discord.Client):
         :param message: Message
         :return:
         """
+        events_total.inc('on_message_delete')
         if not self.message_monitoring:
             return
         if self.is_monitored_object(message.author, message.channel, message.guild):
             await self.process_message(message, '删除消息')
+        else:
+            events_filtered_total.inc('on_message_delete', 'unmonitored')
+
+    async def on_raw_message_delete(self, payload):
+        """
+        监听消息删除原始事件，由被监听消息缓存得出被删除的消息，重写自discord.Client
+
+        :param payload: RawMessageDeleteEvent
+        :return:
+        """
+        # 被监听消息缓存由多个账号共用，仅由归属账号取出
+        if not self.owns_payload(payload):
+            return
+        message = self.message_store.pop(payload.channel_id, payload.message_id)
+        if message is None:
+            events_total.inc('on_message_delete')
+            events_filtered_total.inc('on_message_delete', 'uncached')
+            return
+        await self.on_message_delete(message)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        """
+        监听批量删除消息原始事件，重写自discord.Client
+
+        :param payload: RawBulkMessageDeleteEvent
+        :return:
+        """
+        if not self.owns_payload(payload):
+            return
+        for message_id in payload.message_ids:
+            message = self.message_store.pop(payload.channel_id, message_id)
+            if message is None:
+                events_total.inc('on_message_delete')
+                events_filtered_total.inc('on_message_delete', 'uncached')
+                continue
+            await self.on_message_delete(message)
+
+    async def on_raw_message_edit(self, payload):
+        """
+        监听消息编辑原始事件，由被监听消息缓存得出编辑前的消息，重写自discord.Client
+
+        :param payload: RawMessageUpdateEvent
+        :return:
+        """
+        if not self.owns_payload(payload):
+            return
+        before = self.message_store.get(payload.channel_id, payload.message_id)
+        if before is None:
+            events_total.inc('on_message_edit')
+            events_filtered_total.inc('on_message_edit', 'uncached')
+            return
+        after = self.message_store.add(before.updated(payload.data))
+        await self.on_message_edit(before, after)
 
     async def on_message_edit(self, before, after):
         """
@@ -293,10 +660,20 @@ class DiscordMonitor(discord.Client):
         :param after: Message
         :return:
         """
+        events_total.inc('on_message_edit')
         if not self.message_monitoring:
             return
-        if self.is_monitored_object(after.author, after.channel, after.guild) and before.content != after.content:
+        if not self.is_monitored_object(after.author, after.channel, after.guild):
+            events_filtered_total.inc('on_message_edit', 'unmonitored')
+        elif before.content == after.content:
+            events_filtered_total.inc('on_message_edit', 'unchanged')
+        else:
             await self.process_message(after, '编辑消息')
+        # 消息标注状态变更，已缓存的消息可直接推送而无需请求标注列表
+        if before.pinned != after.pinned and self.router.is_monitored_channel(after.channel.id) and \
+                self.owns(after.guild):
+            if self.pin_cache.set_pinned(after.channel.id, after.id, after.pinned) and after.pinned:
+                await self.process_message(after, '标注消息')
 
     async def on_guild_channel_pins_update(self, channel, last_pin):
         """
@@ -306,13 +683,114 @@ class DiscordMonitor(discord.Client):
         :param last_pin: datetime.datetime 最新标注消息的发送时间
         :return:
         """
+        events_total.inc('on_guild_channel_pins_update')
         if not self.message_monitoring:
             return
-        if channel.id in self.message_channel or len(self.message_channel) == 0 or \
-                (channel.guild.name in self.message_channel_name and channel.name in self.message_channel_name[channel.guild.name]):
+        if not self.router.is_monitored_channel(channel.id) or not self.owns(channel.guild):
+            events_filtered_total.inc('on_guild_channel_pins_update', 'unmonitored')
+            return
+        # 取消标注时最新标注时间不变，无需请求标注列表
+        if not self.pin_cache.is_new_pin(channel.id, last_pin):
+            return
+        # 短时间内的多次标注合并为一次请求
+        if channel.id not in self.pin_fetches:
+            self.pin_fetches[channel.id] = asyncio.ensure_future(self.fetch_pins(channel))
+
+    async def fetch_pins(self, channel):
+        """
+        延时请求频道的标注列表，与缓存比较后推送新标注的消息
+
+        :param channel: 频道
+        :return:
+        """
+        try:
+            await asyncio.sleep(self.pin_debounce)
+        finally:
+            self.pin_fetches.pop(channel.id, None)
+        try:
             pins = await channel.pins()
-            if len(pins) > 0:
-                await self.process_message(pins[0], '标注消息')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_text = 'Fetching pins of channel %s failed. Reason: %r' % (channel.id, e)
+            add_log(1, 'Discord', log_text)
+            return
+        new_ids = self.pin_cache.update(channel.id, [message.id for message in pins])
+        for message in reversed(pins):
+            if message.id in new_ids:
+                await self.process_message(message, '标注消息')
+
+    async def on_guild_available(self, guild):
+        """
+        监听Server可用事件，解析频道名规则并订阅Server，重写自discord.Client
+
+        :param guild: Guild
+        :return:
+        """
+        self.router.resolve_guild(guild)
+        if not self.user.bot and self.owns(guild):
+            self.subscriptions.schedule(guild)
+
+    async def on_guild_join(self, guild):
+        """
+        监听加入Server事件，解析频道名规则并订阅Server，重写自discord.Client
+
+        :param guild: Guild
+        :return:
+        """
+        self.router.resolve_guild(guild)
+        if not self.user.bot and self.owns(guild):
+            self.subscriptions.schedule(guild)
+
+    async def on_guild_remove(self, guild):
+        """
+        监听离开Server事件，移除频道名解析结果并释放Server归属，重写自discord.Client
+
+        :param guild: Guild
+        :return:
+        """
+        self.router.remove_guild(guild.id)
+        self.guild_owners.release(guild.id, self)
+
+    async def on_guild_update(self, before, after):
+        """
+        监听Server更新事件，Server更名时重新解析频道名规则，重写自discord.Client
+
+        :param before: Guild
+        :param after: Guild
+        :return:
+        """
+        if before.name != after.name:
+            self.router.resolve_guild(after)
+
+    async def on_guild_channel_create(self, channel):
+        """
+        监听频道创建事件，重新解析频道名规则，重写自discord.Client
+
+        :param channel: 频道
+        :return:
+        """
+        self.router.resolve_guild(channel.guild)
+
+    async def on_guild_channel_delete(self, channel):
+        """
+        监听频道删除事件，重新解析频道名规则，重写自discord.Client
+
+        :param channel: 频道
+        :return:
+        """
+        self.router.resolve_guild(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        """
+        监听频道更新事件，频道更名时重新解析频道名规则，重写自discord.Client
+
+        :param before: 频道
+        :param after: 频道
+        :return:
+        """
+        if before.name != after.name:
+            self.router.resolve_guild(after.guild)
 
     async def on_member_update(self, before, after):
         """
@@ -322,53 +800,40 @@ class DiscordMonitor(discord.Client):
         :param after: Member
         :return:
         """
+        events_total.inc('on_member_update')
         if not self.user_monitoring:
             return
-        if self.is_monitored_object(before, None, before.guild, user_dynamic=True):
-            # 昵称变更
-            if before.nick != after.nick:
-                event = str(before.nick) + str(after.nick)
-                if self.check_event(event):
-                    await self.process_user_update(before.nick, after.nick, before, '昵称更新')
-                    self.delete_event(event)
-            # 在线状态变更
-            if before.status != after.status:
-                event = str(before.id) + str(before.status) + str(after.status)
-                if self.check_event(event):
-                    await self.process_user_update(self.get_status(before.status), self.get_status(after.status),
-                                                   before, '状态更新')
-                    self.delete_event(event)
-            # 用户名或Tag变更
-            try:
-                self.username_dict[before.id]
-            except KeyError:
-                self.username_dict[before.id] = [after.name, after.discriminator]
-            if self.username_dict[before.id][0] != after.name or self.username_dict[before.id][1] != after.discriminator:
-                before_screenname = self.username_dict[before.id][0] + '#' + self.username_dict[before.id][1]
-                after_screenname = after.name + '#' + after.discriminator
-                self.username_dict[before.id][0] = after.name
-                self.username_dict[before.id][1] = after.discriminator
-                event = before_screenname + after_screenname
-                if self.check_event(event):
-                    await self.process_user_update(before_screenname, after_screenname, before, '用户名更新')
-                    self.delete_event(event)
-            # 用户活动变更
-            if before.activity != after.activity:
-                if not before.activity:
-                    event = after.activity.name
-                    if self.check_event(event):
-                        await self.process_user_update(None, after.activity.name, before, '活动更新')
-                        self.delete_event(event)
-                elif not after.activity:
-                    event = before.activity.name
-                    if self.check_event(event):
-                        await self.process_user_update(before.activity.name, None, before, '活动更新')
-                        self.delete_event(event)
-                elif before.activity.name != after.activity.name:
-                    event = before.activity.name + after.activity.name
-                    if self.check_event(event):
-                        await self.process_user_update(before.activity.name, after.activity.name, before, '活动更新')
-                        self.delete_event(event)
+        if not self.is_monitored_object(before, None, before.guild, user_dynamic=True):
+            events_filtered_total.inc('on_member_update', 'unmonitored')
+            return
+        # 昵称变更
+        if before.nick != after.nick:
+            if self.event_cache.check((before.id, 'nick', before.nick, after.nick)):
+                await self.process_user_update(before.nick, after.nick, before, '昵称更新')
+        # 在线状态变更
+        if before.status != after.status:
+            if self.event_cache.check((before.id, 'status', before.status, after.status)):
+                await self.process_user_update(self.get_status(before.status), self.get_status(after.status),
+                                               before, '状态更新')
+        # 用户名或Tag变更
+        try:
+            self.username_dict[before.id]
+        except KeyError:
+            self.username_dict[before.id] = [after.name, after.discriminator]
+        if self.username_dict[before.id][0] != after.name or self.username_dict[before.id][1] != after.discriminator:
+            before_screenname = self.username_dict[before.id][0] + '#' + self.username_dict[before.id][1]
+            after_screenname = after.name + '#' + after.discriminator
+            self.username_dict[before.id][0] = after.name
+            self.username_dict[before.id][1] = after.discriminator
+            if self.event_cache.check((before.id, 'username', before_screenname, after_screenname)):
+                await self.process_user_update(before_screenname, after_screenname, before, '用户名更新')
+        # 用户活动变更
+        if before.activity != after.activity:
+            before_activity = before.activity.name if before.activity else None
+            after_activity = after.activity.name if after.activity else None
+            if before_activity != after_activity:
+                if self.event_cache.check((before.id, 'activity', before_activity, after_activity)):
+                    await self.process_user_update(before_activity, after_activity, before, '活动更新')
 
     def get_status(self, status):
         """
@@ -382,51 +847,80 @@ class DiscordMonitor(discord.Client):
             return self.status_dict[status]
         return status
 
-    def check_event(self, event):
+    async def close(self):
         """
-        检查该事件是否已在用户动态事件set中，不在则将事件加入set，防止眼和监测用户同在多个Server中时重复推送用户动态
+        关闭至discord的连接，单独创建共用组件时一同关闭QQPush模块的连接
 
-        :param event: event
-        :return: True if yes, otherwise False
+        :return:
         """
-        if event in self.event_set:
-            return False
+        if self.username_task is not None:
+            self.username_task.cancel()
+        for task in self.pin_fetches.values():
+            task.cancel()
+        self.subscriptions.cancel()
+        self.config_watcher.close()
+        self.guild_owners.release_all(self)
+        if self.owns_shared:
+            await asyncio.gather(
+                super(DiscordMonitor, self).close(),
+                self.shared.close()
+            )
         else:
-            self.event_set.add(event)
-            return True
+            await super(DiscordMonitor, self).close()
+        self.save_username_snapshot(self.username_dict)
 
-    def delete_event(self, event):
-        """
-        延时删除set中的用户动态事件
 
-        :param event: event
-        :return:
-        """
-        asyncio.get_event_loop().call_later(5, self.event_set.remove, event)
-
-    async def close(self):
-        """
-        关闭至discord的连接，以及QQPush模块的连接
+async def run_account(dc: DiscordMonitor, index: int):
+    """
+    登录并运行单个账号，登录失败或连接中断时记录错误并释放其Server归属，不影响其余账号
 
-        :return:
-        """
-        await asyncio.gather(
-            super(DiscordMonitor, self).close(),
-            self.qq_push.close()
-        )
+    :param dc: DiscordMonitor
+    :param index: 账号在配置中的序号，用于log
+    :return:
+    """
+    try:
+        await dc.start(dc.account.token)
+        return
+    except (ClientProxyConnectionError, InvalidURL) as e:
+        reason = '代理错误，请检查代理设置'
+        error = e
+    except (TimeoutError, ClientConnectorError) as e:
+        reason = '连接超时，请检查连接状态及代理设置'
+        error = e
+    except discord.errors.LoginFailure as e:
+        reason = '登录失败，请检查Token及bot设置是否正确，或更新Token，或检查是否使用了正确的discord.py依赖库'
+        error = e
+    except Exception as e:
+        reason = '登录失败，请检查配置文件中各参数是否正确'
+        error = e
+        traceback.print_exc()
+    print('账号%d: %s' % (index + 1, reason))
+    add_log(2, 'Discord', 'Account %d stopped. Reason: %r' % (index + 1, error))
+    dc.guild_owners.release_all(dc)
 
 
 def main():
+    init_log(config.log)
+    # 不支持fork的平台上，正则表达式sandbox子进程重新导入本模块时无需再次输入配置文件路径
+    os.environ.setdefault('DISCORD_MONITOR_CONFIG', os.path.abspath(Config.config_path))
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    if config.bot:
-        intents = discord.Intents.default()
-        dc = DiscordMonitor(loop=loop, intents=intents)
-    else:
-        dc = DiscordMonitor(loop=loop)
+    # 多个账号共用推送队列、去重缓存及Server归属登记
+    shared = SharedPipeline(config)
+    monitors = []
+    for account in config.accounts:
+        if account.bot:
+            intents = discord.Intents.default()
+            monitors.append(DiscordMonitor(shared, account, loop=loop, intents=intents))
+        else:
+            monitors.append(DiscordMonitor(shared, account, loop=loop))
     try:
+        loop.run_until_complete(shared.start())
+        # 重新加载配置时同时替换各账号的配置
+        monitors[0].config_watcher.start()
         print('Logging in...')
-        loop.run_until_complete(dc.start(config.token))
+        # 单个账号登录失败时其余账号继续运行
+        loop.run_until_complete(asyncio.gather(*[run_account(dc, index) for index, dc in enumerate(monitors)]))
     except (ClientProxyConnectionError, InvalidURL):
         print('代理错误，请检查代理设置')
     except (TimeoutError, ClientConnectorError):
@@ -439,15 +933,18 @@ def main():
         print('登录失败，请检查配置文件中各参数是否正确')
         traceback.print_exc()
     finally:
-        loop.run_until_complete(dc.close())
+        for dc in monitors:
+            loop.run_until_complete(dc.close())
+        loop.run_until_complete(shared.close())
         # 2022.5.8：
         # Windows环境下aiohttp似乎会在程序退出释放内存时自动调用方法关闭事件循环导致报错，在此对平台进行特判
         # 暂未测试在Linux下的表现
         if platform.system() != 'Windows':
             loop.close()
+        close_log()
 
 
 if __name__ == '__main__':
     main()
-    if platform.system() == 'Windows':
+    if platform.system() == 'Windows' and not is_headless():
         os.system('pause')
@@ -0,0 +1,182 @@
+"""
+轻量的discord对象替身
+
+仅包含DiscordMonitor各事件处理方法所用到的属性，用于离线基准测试及事件回放，无需连接Discord即可构造；
+亦作为被监听消息缓存中的紧凑记录。
+"""
+import datetime
+from typing import List, Optional
+
+
+class LiteGuild:
+    __slots__ = ('id', 'name', 'channels', 'members')
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.channels: List['LiteChannel'] = []
+        self.members = dict()
+
+    def get_member(self, user_id: int):
+        return self.members.get(user_id)
+
+
+class LiteChannel:
+    __slots__ = ('id', 'name', 'guild')
+
+    def __init__(self, id: int, name: str, guild: LiteGuild):
+        self.id = id
+        self.name = name
+        self.guild = guild
+
+
+class LiteUser:
+    __slots__ = ('id', 'name', 'discriminator', 'bot')
+
+    def __init__(self, id: int, name: str, discriminator: str = '0001', bot: bool = False):
+        self.id = id
+        self.name = name
+        self.discriminator = discriminator
+        self.bot = bot
+
+
+class LiteActivity:
+    __slots__ = ('name',)
+
+    def __init__(self, name: Optional[str]):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, LiteActivity) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class LiteMember:
+    __slots__ = ('id', 'name', 'discriminator', 'bot', 'guild', 'nick', 'status', 'activity')
+
+    def __init__(self, user: LiteUser, guild: LiteGuild, nick: Optional[str] = None, status: str = 'offline',
+                 activity: Optional[LiteActivity] = None):
+        self.id = user.id
+        self.name = user.name
+        self.discriminator = user.discriminator
+        self.bot = user.bot
+        self.guild = guild
+        self.nick = nick
+        self.status = status
+        self.activity = activity
+
+    def copy(self, **changes) -> 'LiteMember':
+        """
+        复制成员并修改部分属性，用于构造用户动态事件的after
+
+        :param changes: 修改的属性
+        :return:
+        """
+        member = LiteMember.__new__(LiteMember)
+        for name in LiteMember.__slots__:
+            setattr(member, name, changes.get(name, getattr(self, name)))
+        return member
+
+
+class LiteAttachment:
+    __slots__ = ('id', 'url', 'proxy_url', 'filename', 'content_type', 'size')
+
+    def __init__(self, id: int, url: str, filename: str = '', content_type: Optional[str] = None, size: int = 0):
+        self.id = id
+        self.url = url
+        self.proxy_url = url
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+
+
+class LiteEmbedImage:
+    __slots__ = ('url', 'proxy_url')
+
+    def __init__(self, url: Optional[str] = None, proxy_url: Optional[str] = None):
+        self.url = url
+        self.proxy_url = proxy_url
+
+
+class LiteEmbed:
+    __slots__ = ('image',)
+
+    def __init__(self, image: Optional[LiteEmbedImage] = None):
+        self.image = image if image is not None else LiteEmbedImage()
+
+
+class LiteMessage:
+    __slots__ = ('id', 'content', 'author', 'channel', 'guild', 'attachments', 'embeds', 'created_at',
+                 'edited_at', 'pinned', 'type')
+
+    def __init__(self, id: int, content: str, author, channel: LiteChannel, attachments: List[LiteAttachment] = None,
+                 embeds: List[LiteEmbed] = None, created_at: datetime.datetime = None, pinned: bool = False,
+                 type: str = 'default'):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = attachments if attachments is not None else []
+        self.embeds = embeds if embeds is not None else []
+        self.created_at = created_at if created_at is not None else datetime.datetime.utcnow()
+        self.edited_at = None
+        self.pinned = pinned
+        self.type = type
+
+    def copy(self, **changes) -> 'LiteMessage':
+        """
+        复制消息并修改部分属性，用于构造编辑事件的after
+
+        :param changes: 修改的属性
+        :return:
+        """
+        message = LiteMessage.__new__(LiteMessage)
+        for name in LiteMessage.__slots__:
+            setattr(message, name, changes.get(name, getattr(self, name)))
+        return message
+
+    @classmethod
+    def from_message(cls, message) -> 'LiteMessage':
+        """
+        由discord.Message生成紧凑记录，仅保留作者、频道、正文、附件及嵌入图片
+
+        :param message: Message
+        :return:
+        """
+        if isinstance(message, cls):
+            return message
+        author = message.author
+        attachments = [LiteAttachment(a.id, a.url, a.filename, a.content_type, a.size) for a in message.attachments]
+        embeds = [LiteEmbed(LiteEmbedImage(embed.image.url or None, embed.image.proxy_url or None))
+                  for embed in message.embeds if embed.image.proxy_url]
+        record = cls(message.id, message.content, LiteUser(author.id, author.name, author.discriminator, author.bot),
+                     message.channel, attachments, embeds, message.created_at, message.pinned, message.type)
+        record.edited_at = message.edited_at
+        return record
+
+    def updated(self, data: dict) -> 'LiteMessage':
+        """
+        以MESSAGE_UPDATE事件的数据生成编辑后的消息，事件中没有的字段保持不变
+
+        :param data: 原始事件数据
+        :return:
+        """
+        changes = dict()
+        if 'content' in data:
+            changes['content'] = data['content']
+        if 'pinned' in data:
+            changes['pinned'] = data['pinned']
+        if data.get('edited_timestamp'):
+            changes['edited_at'] = datetime.datetime.fromisoformat(
+                data['edited_timestamp'].replace('Z', '+00:00')).replace(tzinfo=None)
+        if 'attachments' in data:
+            changes['attachments'] = [LiteAttachment(int(a['id']), a['url'], a.get('filename', ''),
+                                                     a.get('content_type'), a.get('size', 0))
+                                      for a in data['attachments']]
+        if 'embeds' in data:
+            changes['embeds'] = [LiteEmbed(LiteEmbedImage(embed['image'].get('url'), embed['image'].get('proxy_url')))
+                                 for embed in data['embeds'] if (embed.get('image') or dict()).get('proxy_url')]
+        return self.copy(**changes)
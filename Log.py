@@ -1,28 +1,237 @@
+import atexit
+import datetime
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
 import time
 import traceback
 
 log_path = 'discord_monitor.log'
+log_type_dict = {0: 'INFO', 1: 'WARN', 2: 'ERROR'}
+
+
+class LogWriter:
+    """
+    后台日志写入线程
+
+    add_log仅将日志放入有界队列，由后台线程持有文件句柄批量写入，按数量或时间刷新，并按大小或日期轮转压缩。
+    队列满时丢弃日志并计数，不会阻塞事件循环。
+    """
+
+    def __init__(self, path=log_path, queue_size=10000, batch_size=256, flush_interval=1.0, rotate='size',
+                 max_bytes=10 * 1024 * 1024, backup_count=10, json_lines=False, echo=True):
+        """
+        :param path: 日志文件路径
+        :param queue_size: 队列长度上限
+        :param batch_size: 单批写入的最大日志条数
+        :param flush_interval: 刷新间隔，单位为秒
+        :param rotate: 轮转方式，"size"为按大小，"daily"为按日期，"none"为不轮转
+        :param max_bytes: 按大小轮转时单个日志文件的大小上限
+        :param backup_count: 保留的压缩日志数量，0表示不删除
+        :param json_lines: 是否以JSON Lines格式写入
+        :param echo: 是否同时打印至标准输出
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.json_lines = json_lines
+        self.echo = echo
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._file = None
+        self._file_date = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, log_type: str, method: str, text: str):
+        """
+        将日志放入队列，队列满时丢弃
+
+        :param log_type: INFO, WARN或ERROR
+        :param method: 产生log的模块
+        :param text: log文本
+        :return:
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((log_type, time.time(), method, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """
+        启动后台写入线程
+
+        :return:
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='LogWriter', daemon=True)
+                self._thread.start()
+
+    def close(self, timeout=5.0):
+        """
+        写入队列中剩余的日志并关闭文件
+
+        :param timeout: 等待时间，单位为秒
+        :return:
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _format(self, record) -> str:
+        log_type, t, method, text = record
+        if self.json_lines:
+            return json.dumps({'level': log_type, 'time': t, 'method': method, 'text': text}, ensure_ascii=False)
+        text = text.replace('\n', '\\n')
+        return '[%s][%s][%s] %s' % (log_type, time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(t)), method, text)
+
+    def _run(self):
+        closing = False
+        last_flush = time.monotonic()
+        while not closing:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+            batch = []
+            if record is None:
+                closing = True
+            elif record:
+                batch.append(record)
+            # 批量取出队列中的日志
+            while not closing and len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    closing = True
+                else:
+                    batch.append(record)
+            if self.dropped != self._reported_dropped:
+                dropped = self.dropped - self._reported_dropped
+                self._reported_dropped = self.dropped
+                batch.append(('WARN', time.time(), 'LOG', '%d log records dropped, queue is full' % dropped))
+            try:
+                if batch:
+                    self._write_batch(batch)
+                now = time.monotonic()
+                if self._file and (closing or len(batch) >= self.batch_size or
+                                   now - last_flush >= self.flush_interval):
+                    self._file.flush()
+                    last_flush = now
+            except Exception:
+                traceback.print_exc()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, batch):
+        lines = [self._format(record) for record in batch]
+        if self.echo:
+            print('\n'.join(lines))
+        self._open()
+        self._file.write('\n'.join(lines))
+        self._file.write('\n')
+        if self.rotate == 'size' and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        if self.rotate == 'daily' and self._file and self._file_date != datetime.date.today():
+            self._rotate()
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf8')
+            self._file_date = datetime.date.today()
+
+    def _rotate(self):
+        """
+        将当前日志文件重命名并以gzip压缩，删除超出数量的旧日志
+
+        :return:
+        """
+        self._file.close()
+        self._file = None
+        if self.rotate == 'daily':
+            suffix = self._file_date.strftime('%Y%m%d')
+        else:
+            suffix = time.strftime('%Y%m%d-%H%M%S')
+        rotated = '%s.%s' % (self.path, suffix)
+        index = 1
+        while os.path.exists(rotated + '.gz'):
+            rotated = '%s.%s.%d' % (self.path, suffix, index)
+            index += 1
+        os.replace(self.path, rotated)
+        with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        if self.backup_count > 0:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            prefix = os.path.basename(self.path) + '.'
+            backups = [os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.startswith(prefix) and name.endswith('.gz')]
+            backups.sort(key=os.path.getmtime)
+            for backup in backups[:-self.backup_count]:
+                os.remove(backup)
+
+
+log_writer = LogWriter()
+atexit.register(lambda: log_writer.close())
+
+
+def init_log(log_config):
+    """
+    按配置重新创建日志写入线程
+
+    :param log_config: Config.Log
+    :return:
+    """
+    global log_writer
+    old_writer = log_writer
+    log_writer = LogWriter(path=log_config.path, queue_size=log_config.queue_size,
+                           batch_size=log_config.batch_size, flush_interval=log_config.flush_interval,
+                           rotate=log_config.rotate, max_bytes=log_config.max_bytes,
+                           backup_count=log_config.backup_count, json_lines=log_config.json_lines,
+                           echo=log_config.echo)
+    old_writer.close()
+
+
+def close_log():
+    """
+    写入剩余日志并关闭日志文件
+
+    :return:
+    """
+    log_writer.close()
 
 
 def add_log(log_type, method, text):
     """
-    将log打印并存储至文件
+    将log打印并存储至文件，由后台线程写入，不会阻塞调用方
 
     :param log_type: 0: INFO, 1: WARN, 2: ERROR
     :param method: 产生log的模块
     :param text: log文本
     :return:
     """
-    log_type_dict = {0: 'INFO', 1: 'WARN', 2: 'ERROR'}
     try:
         log_type = log_type_dict[log_type]
     except KeyError:
         traceback.print_exc()
         return
-    text = text.replace('\n', '\\n')
-    t = time.strftime('%Y/%m/%d %H:%M:%S')
-    log_text = '[%s][%s][%s] %s' % (log_type, t, method, text)
-    print(log_text)
-    with open(log_path, 'a', encoding='utf8') as log:
-        log.write(log_text)
-        log.write('\n')
+    log_writer.write(log_type, method, text)
@@ -0,0 +1,260 @@
+import asyncio
+import bisect
+import functools
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from Log import add_log
+
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    """
+    按标签计数的计数器
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = dict()
+        if not labels:
+            self.values[()] = 0
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        for label_values, value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Gauge:
+    """
+    渲染时由回调函数取值的仪表
+    """
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] = None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float('nan')
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s gauge' % self.name,
+                '%s %s' % (self.name, value)]
+
+
+class Histogram:
+    """
+    按标签统计的直方图，桶为累积计数
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Iterable[float] = default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label_values: [各桶计数, 总和, 总数]
+        self.values: Dict[Tuple[str, ...], list] = dict()
+
+    def observe(self, value: float, *label_values: str):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[label_values] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, label_values,
+                                                                           'le="%s"' % bound), cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, label_values, 'le="+Inf"'),
+                                             count))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, label_values), total))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, label_values), count))
+        return lines
+
+
+class Registry:
+    """
+    指标集合，以Prometheus文本格式输出
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float] = None) -> Gauge:
+        """
+        注册仪表，同名仪表已存在时替换其回调函数
+
+        :param name: 指标名
+        :param documentation: 说明
+        :param function: 取值函数
+        :return:
+        """
+        for metric in self.metrics:
+            if isinstance(metric, Gauge) and metric.name == name:
+                metric.function = function
+                return metric
+        return self.register(Gauge(name, documentation, function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+events_total = registry.register(Counter('discord_monitor_events_total', 'Gateway events received by handler.',
+                                         ('handler',)))
+events_filtered_total = registry.register(Counter('discord_monitor_events_filtered_total',
+                                                  'Gateway events dropped by handler and reason: unmonitored for '
+                                                  'routing index rejects, uncached for edits and deletes of '
+                                                  'messages not in the message store, empty or unchanged for '
+                                                  'messages without content or edits without content changes.',
+                                                  ('handler', 'reason')))
+stage_seconds = registry.register(Histogram('discord_monitor_stage_seconds', 'Latency of processing stages.',
+                                            ('stage',)))
+push_results_total = registry.register(Counter('discord_monitor_push_results_total',
+                                               'QQ push outcomes by final HTTP status.', ('status',)))
+push_retries_total = registry.register(Counter('discord_monitor_push_retries_total', 'QQ push retries.'))
+gateway_prefilter_total = registry.register(Counter('discord_monitor_gateway_prefilter_total',
+                                                    'Raw member update payloads seen by the gateway prefilter.',
+                                                    ('event', 'result')))
+regex_timeouts_total = registry.register(Counter('discord_monitor_regex_timeouts_total',
+                                                 'User regex evaluations that exceeded the sandbox time budget.'))
+loop_lag_seconds = registry.register(Histogram('discord_monitor_event_loop_lag_seconds',
+                                               'Delay of scheduled callbacks on the event loop.'))
+loop_lag = registry.gauge('discord_monitor_event_loop_lag_last_seconds', 'Last measured event loop lag.')
+
+
+class Timer:
+    """
+    记录代码块耗时至直方图
+
+    with Timer('process_message'):
+        ...
+    """
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_seconds.observe(time.perf_counter() - self.start, self.stage)
+
+
+def timed(stage: str):
+    """
+    记录协程耗时至直方图的装饰器
+
+    :param stage: 阶段名
+    :return:
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, stage)
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    """
+    提供/metrics接口的本地HTTP服务，并定时测量事件循环延迟
+    """
+
+    def __init__(self, host: str, port: int, lag_interval: float = 1.0):
+        """
+        :param host: 监听地址
+        :param port: 监听端口
+        :param lag_interval: 测量事件循环延迟的间隔，单位为秒
+        """
+        self.host = host
+        self.port = port
+        self.lag_interval = lag_interval
+        self.runner = None
+        self.lag_task = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def _measure_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - start - self.lag_interval)
+            loop_lag_seconds.observe(lag)
+            loop_lag.set(lag)
+
+    async def start(self):
+        """
+        启动HTTP服务
+
+        :return:
+        """
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.lag_task = asyncio.ensure_future(self._measure_lag())
+        add_log(0, 'Metrics', 'Serving metrics on http://%s:%d/metrics' % (self.host, self.port))
+
+    async def close(self):
+        """
+        关闭HTTP服务
+
+        :return:
+        """
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,205 @@
+import abc
+import platform
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from Log import add_log
+
+
+class NotifierBackend(abc.ABC):
+    """
+    通知后端基类，notify于Notifier的后台线程中调用，可阻塞
+    """
+
+    @abc.abstractmethod
+    def notify(self, title: str, text: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class ToastBackend(NotifierBackend):
+    """
+    Windows系统通知，plyer于首次通知时导入
+    """
+
+    def __init__(self, app_icon: str = 'icon.ico', app_name: str = 'Discord Monitor'):
+        self.app_icon = app_icon
+        self.app_name = app_name
+        self.notification = None
+
+    def notify(self, title: str, text: str):
+        if self.notification is None:
+            from plyer import notification
+            self.notification = notification
+        self.notification.notify(title, text, app_icon=self.app_icon, app_name=self.app_name)
+
+
+class FileBackend(NotifierBackend):
+    """
+    将通知逐行写入文件，path可为FIFO，由其他程序读取后显示
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def notify(self, title: str, text: str):
+        if self.file is None:
+            # FIFO在有读取方之前打开会阻塞，仅阻塞后台线程
+            self.file = open(self.path, 'a', encoding='utf8')
+        self.file.write('[%s] %s: %s\n' % (time.strftime('%Y/%m/%d %H:%M:%S'), title, text.replace('\n', ' ')))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class NullBackend(NotifierBackend):
+    """
+    不显示通知，仅保留最近的通知，用于测试
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.notifications: List[Tuple[str, str]] = []
+
+    def notify(self, title: str, text: str):
+        self.notifications.append((title, text))
+        if len(self.notifications) > self.max_size:
+            del self.notifications[0]
+
+
+class Notifier:
+    """
+    通知队列
+
+    通知放入有界队列后立即返回，由后台线程调用后端显示，队列满时丢弃并计数，后端缓慢不会阻塞事件循环。
+    距上次显示不足merge_window秒时，期间到达的通知合并为一条显示。
+    """
+
+    def __init__(self, backend: NotifierBackend, queue_size: int = 100, merge_window: float = 2.0,
+                 max_length: int = 250):
+        """
+        :param backend: 通知后端
+        :param queue_size: 队列长度上限
+        :param merge_window: 两次显示通知的最短间隔，单位为秒
+        :param max_length: 通知正文长度上限
+        """
+        self.backend = backend
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.merge_window = merge_window
+        self.max_length = max_length
+        self.dropped = 0
+        self.shown = 0
+        self.merged = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name='Notifier', daemon=True)
+        self._thread.start()
+
+    def notify(self, title: str, text: str):
+        """
+        发送通知，不阻塞
+
+        :param title: 通知标题
+        :param text: 通知正文
+        :return:
+        """
+        try:
+            self.queue.put_nowait((title, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def merge(self, items: List[Tuple[str, str]]) -> Tuple[str, str]:
+        """
+        合并多条通知
+
+        :param items: (标题, 正文)列表
+        :return:
+        """
+        if len(items) == 1:
+            title, text = items[0]
+        else:
+            title = '%d条动态' % len(items)
+            text = '\n'.join('%s: %s' % item for item in items)
+        if len(text) > self.max_length:
+            text = text[:self.max_length - 3] + '...'
+        return title, text
+
+    def _run(self):
+        last_shown = 0.0
+        closing = False
+        while not closing:
+            item = self.queue.get()
+            if item is None:
+                break
+            items = [item]
+            # 距上次显示不足merge_window时等待并收集后续通知
+            while True:
+                wait = last_shown + self.merge_window - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=wait) if wait > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                items.append(item)
+            self.merged += len(items) - 1
+            try:
+                self.backend.notify(*self.merge(items))
+                self.shown += 1
+            except Exception as e:
+                self.failed += 1
+                log_text = 'Failed to show %d notifications with %s. Reason: %r' % \
+                           (len(items), type(self.backend).__name__, e)
+                add_log(2, 'Notifier', log_text)
+            last_shown = time.monotonic()
+        try:
+            self.backend.close()
+        except Exception as e:
+            add_log(1, 'Notifier', 'Failed to close %s. Reason: %r' % (type(self.backend).__name__, e))
+
+    def close(self, timeout: float = 5.0):
+        """
+        显示剩余通知并停止后台线程
+
+        :param timeout: 等待时间，单位为秒
+        :return:
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        if self.dropped:
+            add_log(1, 'Notifier', '%d notifications dropped, queue was full' % self.dropped)
+
+
+def create_notifier(config) -> Optional[Notifier]:
+    """
+    按配置创建通知队列
+
+    :param config: Config
+    :return: 未启用通知或当前系统不支持toast时为None
+    """
+    if not config.toast:
+        return None
+    notifier = config.notifier
+    if notifier.backend == 'toast':
+        if platform.system() != 'Windows' or platform.release() != '10':
+            return None
+        backend = ToastBackend()
+    elif notifier.backend == 'file':
+        backend = FileBackend(notifier.path)
+    elif notifier.backend == 'null':
+        backend = NullBackend()
+    else:
+        add_log(1, 'Notifier', 'Unknown notifier backend %r, notifications are disabled' % notifier.backend)
+        return None
+    return Notifier(backend, notifier.queue_size, notifier.merge_window, notifier.max_length)
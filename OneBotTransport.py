@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+import json
+import random
+from typing import Dict, Optional, Tuple, Union
+
+import aiohttp
+
+from Log import add_log
+
+# onebot WebSocket接口中与HTTP状态码含义相同的返回码
+retcode_status = {1400: 400, 1401: 401, 1403: 403, 1404: 404}
+# 调用失败（如status为"failed"）时的状态码，推送时重试
+failed_status = 502
+
+
+def response_status(response: dict) -> int:
+    """
+    将onebot接口的响应转换为与HTTP状态码含义相同的状态码
+
+    status为"ok"或"async"（retcode为0或1）时为200，其余返回码视为调用失败
+
+    :param response: 响应数据
+    :return:
+    """
+    retcode = response.get('retcode')
+    if response.get('status') in ('ok', 'async') or retcode in (0, 1):
+        return 200
+    return retcode_status.get(retcode, failed_status)
+
+
+class HttpTransport:
+    """
+    通过HTTP POST调用onebot接口，每次调用发送一次请求
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, token: str):
+        """
+        :param session: aiohttp ClientSession
+        :param url: cqhttp应用的HTTP URL
+        :param token: cqhttp access token，为空表示未设置
+        """
+        self.session = session
+        self.url = url
+        self.headers = {'Content-type': 'application/json'}
+        if token != "":
+            self.headers['Authorization'] = "Bearer " + token
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def call(self, action: str, params: dict, timeout: float = 10) -> int:
+        """
+        调用onebot接口
+
+        :param action: 接口名，如"send_msg"
+        :param params: 接口参数
+        :param timeout: 超时时间，单位为秒
+        :return: HTTP状态码，调用失败时cqhttp仍返回200，以响应中的status及retcode为准
+        """
+        url = '%s/%s' % (self.url, action)
+        async with self.session.post(url, headers=self.headers, data=json.dumps(params), timeout=timeout) as response:
+            if response.status != 200:
+                return response.status
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                # 响应不是JSON时无从判断，视为已接受
+                return response.status
+            if not isinstance(data, dict):
+                return response.status
+            return response_status(data)
+
+
+class WebSocketTransport:
+    """
+    通过正向WebSocket长连接调用onebot接口
+
+    所有调用共用一个连接并以echo字段匹配响应，无需等待上一调用返回即可发送下一调用。连接断开后以指数退避重连，
+    尚未收到响应的调用在重连后以相同的echo重新发送；设置HTTP接口时，连接不可用期间发起的调用改用HTTP接口，
+    已写入连接的调用不改用HTTP接口，避免cqhttp应用已收到的调用经HTTP接口再次推送。
+    推送至少送达一次：cqhttp应用已处理但响应未送达的调用，于重连后重新发送或超时后由调用方重试时仍会重复推送。
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, token: str,
+                 fallback: Optional[HttpTransport] = None, reconnect_base: float = 1.0, reconnect_max: float = 30.0):
+        """
+        :param session: aiohttp ClientSession
+        :param url: cqhttp应用的正向WebSocket URL
+        :param token: cqhttp access token，为空表示未设置
+        :param fallback: 连接不可用时使用的HTTP接口，为None时等待重连
+        :param reconnect_base: 重连的初始等待时间，单位为秒
+        :param reconnect_max: 重连的最长等待时间，单位为秒
+        """
+        self.session = session
+        self.url = url
+        self.headers = dict()
+        if token != "":
+            self.headers['Authorization'] = "Bearer " + token
+        self.fallback = fallback
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.ws = None
+        self.connected = asyncio.Event()
+        # 握手失败时的HTTP状态码，用于无HTTP接口时返回鉴权错误
+        self.handshake_status = None
+        self.echo = itertools.count()
+        # 尚未收到响应的调用，echo: (序列化后的调用, future)
+        self.pending: Dict[str, Tuple[str, asyncio.Future]] = dict()
+        self.task = None
+        self.is_closed = False
+
+    async def start(self):
+        """
+        启动连接任务
+
+        :return:
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        关闭连接，未收到响应的调用以异常结束
+
+        :return:
+        """
+        self.is_closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                pass
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('onebot websocket transport is closed'))
+        self.pending.clear()
+
+    async def _run(self):
+        delay = self.reconnect_base
+        while not self.is_closed:
+            # 本次连接是否收到过消息，连接正常工作后断开时立即重连
+            received = False
+            try:
+                async with self.session.ws_connect(self.url, headers=self.headers, heartbeat=30) as ws:
+                    self.ws = ws
+                    self.handshake_status = None
+                    delay = self.reconnect_base
+                    log = 'Connected to onebot websocket %s.' % self.url
+                    if self.pending:
+                        log += ' Resending %d pending actions.' % len(self.pending)
+                    add_log(0, 'PUSH', log)
+                    for payload, future in list(self.pending.values()):
+                        if not future.done():
+                            await ws.send_str(payload)
+                    self.connected.set()
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            received = True
+                            self._dispatch(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except aiohttp.WSServerHandshakeError as e:
+                self.handshake_status = e.status
+                log = 'Failed to connect to onebot websocket %s. Response:%d.' % (self.url, e.status)
+                add_log(1, 'PUSH', log)
+            except Exception as e:
+                log = 'Failed to connect to onebot websocket %s. Reason: %r' % (self.url, e)
+                add_log(1, 'PUSH', log)
+            finally:
+                # 已写入连接的调用可能已被cqhttp应用收到，等待重连后重新发送
+                self.ws = None
+                self.connected.clear()
+            if self.is_closed:
+                break
+            if received:
+                # 尽快重新发送尚未收到响应的调用，再次连接失败时方才退避
+                add_log(1, 'PUSH', 'Onebot websocket disconnected, reconnecting.')
+                continue
+            log = 'Onebot websocket disconnected, reconnecting in %.1f seconds.' % delay
+            add_log(1, 'PUSH', log)
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(self.reconnect_max, delay * 2)
+
+    def _dispatch(self, data: str):
+        """
+        按echo字段将响应交给对应的调用，忽略事件上报等其他消息
+
+        :param data: WebSocket文本消息
+        :return:
+        """
+        try:
+            response = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(response, dict):
+            return
+        entry = self.pending.pop(str(response.get('echo')), None)
+        if entry is None or entry[1].done():
+            return
+        entry[1].set_result(response_status(response))
+
+    async def call(self, action: str, params: dict, timeout: float = 10) -> int:
+        """
+        调用onebot接口，连接不可用时使用HTTP接口或等待重连
+
+        :param action: 接口名，如"send_msg"
+        :param params: 接口参数
+        :param timeout: 超时时间，单位为秒
+        :return: 与HTTP状态码含义相同的状态码
+        """
+        if self.ws is None:
+            if self.fallback is not None:
+                return await self.fallback.call(action, params, timeout)
+            if self.handshake_status is not None:
+                return self.handshake_status
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        echo = str(next(self.echo))
+        payload = json.dumps({'action': action, 'params': params, 'echo': echo})
+        future = asyncio.get_event_loop().create_future()
+        self.pending[echo] = (payload, future)
+        try:
+            ws = self.ws
+            if ws is not None:
+                try:
+                    await ws.send_str(payload)
+                except ConnectionError:
+                    # 连接已断开，调用未写入连接，有HTTP接口时改用HTTP接口，否则重连后重新发送
+                    if self.fallback is not None:
+                        self.pending.pop(echo, None)
+                        return await self.fallback.call(action, params, timeout)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(echo, None)
+
+
+def create_transport(session: aiohttp.ClientSession, config) -> Union[HttpTransport, WebSocketTransport]:
+    """
+    按配置创建onebot接口调用方式
+
+    :param session: aiohttp ClientSession
+    :param config: Config
+    :return: HttpTransport或WebSocketTransport
+    """
+    http = HttpTransport(session, config.cqhttp_url, config.cqhttp_token)
+    if config.cqhttp_transport == 'websocket':
+        return WebSocketTransport(session, config.cqhttp_ws_url, config.cqhttp_token,
+                                  fallback=http if config.cqhttp_ws_fallback else None)
+    return http
@@ -0,0 +1,184 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from Log import add_log
+
+
+class Outbox:
+    """
+    基于SQLite的推送发件箱
+
+    每条推送在发送前写入发件箱，推送成功后确认删除，重启或cqhttp应用恢复后按顺序重新推送未确认的消息。
+    写入与确认在短时间窗口内合并为一次提交，数据库以WAL模式运行且不在每次提交时fsync。所有数据库操作均在独立线程中执行。
+    """
+
+    def __init__(self, path: str, max_messages: int, commit_interval: float):
+        """
+        :param path: 数据库文件路径
+        :param max_messages: 发件箱中消息数量上限，超出时删除最早的消息
+        :param commit_interval: 合并提交的时间窗口，单位为秒
+        """
+        self.path = path
+        self.max_messages = max_messages
+        self.commit_interval = commit_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Outbox')
+        self.conn = None
+        self.pending_adds = []
+        self.pending_acks = []
+        # 已确认但删除尚未提交的消息，定时重新推送时跳过
+        self.acked_ids = set()
+        self.flush_task = None
+        self.closed = False
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA journal_size_limit=%d' % (16 * 1024 * 1024))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                          'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'target_type TEXT NOT NULL, '
+                          'target_id INTEGER NOT NULL, '
+                          'message TEXT NOT NULL, '
+                          'created REAL NOT NULL)')
+        self.conn.commit()
+
+    async def open(self):
+        """
+        打开数据库
+
+        :return:
+        """
+        await asyncio.get_event_loop().run_in_executor(self.executor, self._open)
+
+    def _load(self) -> List[Tuple[int, str, int, str]]:
+        return self.conn.execute('SELECT id, target_type, target_id, message FROM outbox ORDER BY id').fetchall()
+
+    async def load(self) -> List[Tuple[int, str, int, str]]:
+        """
+        按写入顺序读取所有未确认的消息
+
+        :return: (id, target_type, target_id, message)列表
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._load)
+
+    async def add(self, entries: List[Tuple[str, int, str]]) -> List[int]:
+        """
+        写入消息，于所在批次提交后返回，发件箱关闭后调用时抛出RuntimeError
+
+        :param entries: (target_type, target_id, message)列表
+        :return: 各消息的id
+        """
+        if self.closed:
+            raise RuntimeError('Push outbox is closed')
+        future = asyncio.get_event_loop().create_future()
+        self.pending_adds.append((entries, future))
+        self._schedule_flush()
+        return await future
+
+    def ack(self, row_ids: List[int]):
+        """
+        确认消息已推送成功，随下一批次删除
+
+        :param row_ids: 消息id
+        :return:
+        """
+        self.pending_acks.extend(row_ids)
+        self.acked_ids.update(row_ids)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.closed:
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        await asyncio.sleep(self.commit_interval)
+        while self.pending_adds or self.pending_acks:
+            adds, self.pending_adds = self.pending_adds, []
+            acks, self.pending_acks = self.pending_acks, []
+            try:
+                row_ids, trimmed = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, self._commit, [entries for entries, _ in adds], acks)
+            except Exception as e:
+                for _, future in adds:
+                    if not future.done():
+                        future.set_exception(e)
+                # 确认保留至下次提交，期间仍不重新推送
+                self.pending_acks[:0] = acks
+                log = 'Failed to commit push outbox. Reason: %r' % e
+                add_log(2, 'PUSH', log)
+                if self.pending_acks or self.pending_adds:
+                    asyncio.get_event_loop().call_later(self.commit_interval, self._schedule_flush)
+                return
+            self.acked_ids.difference_update(acks)
+            for ids, (_, future) in zip(row_ids, adds):
+                if not future.done():
+                    future.set_result(ids)
+            if trimmed:
+                log = 'Push outbox is full, %d oldest messages dropped.' % trimmed
+                add_log(1, 'PUSH', log)
+
+    def _commit(self, adds: List[List[Tuple[str, int, str]]], acks: List[int]):
+        try:
+            cursor = self.conn.cursor()
+            row_ids = []
+            now = time.time()
+            for entries in adds:
+                ids = []
+                for target_type, target_id, message in entries:
+                    cursor.execute('INSERT INTO outbox (target_type, target_id, message, created) VALUES (?, ?, ?, ?)',
+                                   (target_type, target_id, message, now))
+                    ids.append(cursor.lastrowid)
+                row_ids.append(ids)
+            if acks:
+                cursor.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in acks])
+            trimmed = 0
+            if adds and self.max_messages > 0:
+                count = cursor.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+                if count > self.max_messages:
+                    trimmed = cursor.execute('DELETE FROM outbox WHERE id IN '
+                                             '(SELECT id FROM outbox ORDER BY id LIMIT ?)',
+                                             (count - self.max_messages,)).rowcount
+            self.conn.commit()
+        except Exception:
+            # 未提交的写入及删除一同回滚，确认由调用方保留至下次提交
+            self.conn.rollback()
+            raise
+        return row_ids, trimmed
+
+    async def close(self):
+        """
+        提交剩余的写入及确认并关闭数据库，无法提交的写入以异常结束
+
+        :return:
+        """
+        self.closed = True
+        if self.flush_task is not None and not self.flush_task.done():
+            await self.flush_task
+        # 提交失败后等待重试的写入及确认不再重新调度，于此一并提交
+        adds, self.pending_adds = self.pending_adds, []
+        acks, self.pending_acks = self.pending_acks, []
+        error = RuntimeError('Push outbox is closed')
+        if (adds or acks) and self.conn is not None:
+            try:
+                row_ids, _ = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, self._commit, [entries for entries, _ in adds], acks)
+                for ids, (_, future) in zip(row_ids, adds):
+                    if not future.done():
+                        future.set_result(ids)
+            except Exception as e:
+                error = e
+                log = 'Failed to commit push outbox. Reason: %r' % e
+                add_log(2, 'PUSH', log)
+        for _, future in adds:
+            if not future.done():
+                future.set_exception(error)
+        if self.conn is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,72 @@
+from typing import Callable
+
+from Metrics import gateway_prefilter_total
+
+# 预过滤的gateway事件，其原始数据均含有user.id及guild_id
+prefiltered_events = ('PRESENCE_UPDATE', 'GUILD_MEMBER_UPDATE')
+
+
+class GatewayPrefilter:
+    """
+    gateway成员更新事件预过滤器
+
+    替换discord.py的PRESENCE_UPDATE及GUILD_MEMBER_UPDATE解析函数，由原始数据中的用户ID及Server ID判断是否被监听，
+    未被监听的事件在构造及比较Member、修改成员缓存之前直接丢弃。被丢弃用户的成员缓存不再随这两种事件更新。
+    """
+
+    def __init__(self, client, accept: Callable[[int, int], bool]):
+        """
+        :param client: discord.Client
+        :param accept: 判断事件是否保留的函数，参数为用户ID及Server ID
+        """
+        self.connection = client._connection
+        self.accept = accept
+        self.originals = dict()
+
+    @property
+    def installed(self) -> bool:
+        return bool(self.originals)
+
+    def install(self):
+        """
+        替换解析函数，已替换时不重复替换
+
+        :return:
+        """
+        # gateway连接与ConnectionState共用同一parsers字典，替换其中的项即可对已建立的连接生效
+        parsers = self.connection.parsers
+        for event in prefiltered_events:
+            if event in self.originals or event not in parsers:
+                continue
+            self.originals[event] = parsers[event]
+            parsers[event] = self._wrap(event, parsers[event])
+
+    def uninstall(self):
+        """
+        恢复原解析函数
+
+        :return:
+        """
+        parsers = self.connection.parsers
+        for event, parse in self.originals.items():
+            parsers[event] = parse
+        self.originals.clear()
+
+    def _wrap(self, event: str, parse: Callable[[dict], None]) -> Callable[[dict], None]:
+        connection = self.connection
+        accept = self.accept
+        inc = gateway_prefilter_total.inc
+
+        def prefiltered(data: dict):
+            try:
+                user_id = int(data['user']['id'])
+                guild_id = int(data['guild_id'])
+            except (KeyError, TypeError, ValueError):
+                return parse(data)
+            # 本账号的成员信息始终更新
+            if user_id == connection.self_id or accept(user_id, guild_id):
+                inc(event, 'passed')
+                return parse(data)
+            inc(event, 'dropped')
+
+        return prefiltered
@@ -1,33 +1,193 @@
-import re
-from typing import Dict, Pattern
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, List, Optional
 
 from Config import push_content
+from Log import add_log
+from Metrics import Timer
+from Sandbox import RegexSandbox
+from TextMatcher import CategoryClassifier, ReplaceEngine, is_safe
 
 keys = ["type", "user_id", "user_name", "user_discriminator", "user_display_name", "channel_id", "channel_name",
-        "server_id", "server_name", "attachment", "image", "before", "after", "time", "timezone", "content", "content_cat"]
+        "server_id", "server_name", "attachment", "image", "before", "after", "time", "timezone", "content", "content_cat",
+        "count", "messages"]
 escape_character = {"&": "&amp;", "[": "&#91;", "]": "&#93;"}
+escape_table = str.maketrans(escape_character)
+# 编译缓存的格式版本，编译计划的结构或表达式的分析规则变化时递增
+compile_cache_version = 3
+
+
+class PushTemplate:
+    """
+    预编译的推送消息模板
+
+    模板被编译为str.format格式串，渲染时仅取模板中出现的关键词
+    """
+
+    __slots__ = ('keys', '_format')
+
+    def __init__(self, blocks: list, num2keyword: Dict[int, str]):
+        """
+        :param blocks: format_blocks解析得到的文本块，int为关键词序号
+        :param num2keyword: 关键词序号至关键词的字典
+        """
+        keys = []
+        parts = []
+        for block in blocks:
+            if type(block) == int:
+                keyword = num2keyword[block]
+                if keyword not in keys:
+                    keys.append(keyword)
+                parts.append('{%d}' % keys.index(keyword))
+            else:
+                parts.append(block.replace('{', '{{').replace('}', '}}'))
+        self.keys = tuple(keys)
+        self._format = ''.join(parts).format
+
+    def __contains__(self, keyword: str):
+        return keyword in self.keys
+
+    def render(self, keywords: Dict[str, str]) -> str:
+        """
+        渲染推送消息，缺失或为空的关键词以"None"代替
+
+        :param keywords: 消息中各信息的字典
+        :return:
+        """
+        return self._format(*[keywords.get(key) or "None" for key in self.keys])
+
+
+def compile_cache_key(content) -> str:
+    """
+    计算推送格式、替换及类别配置的哈希值，作为编译缓存的key
+
+    :param content: Config.PushContent
+    :return:
+    """
+    data = json.dumps([compile_cache_version, list(sys.version_info[:2]), content.message_format,
+                       content.user_dynamic_format, content.digest_format, list(content.replace.items()),
+                       list(content.categories.items()), content.sandbox.enable], ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+def load_compile_cache(path: str, key: str) -> Optional[dict]:
+    """
+    读取编译缓存，缓存不存在、已损坏或key不符时返回None
+
+    :param path: 缓存文件路径
+    :param key: compile_cache_key的返回值
+    :return:
+    """
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        return None
+    return cache
+
+
+def save_compile_cache(path: str, cache: dict):
+    """
+    保存编译缓存，先写入临时文件再替换
+
+    :param path: 缓存文件路径
+    :param cache: 含key的编译计划
+    :return:
+    """
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except Exception:
+        log_text = 'Failed to save compile cache %s.' % path
+        add_log(1, 'PushText', log_text)
 
 
 class PushTextProcessor:
 
-    def __init__(self):
+    def __init__(self, content=None):
+        """
+        :param content: Config.PushContent，为None时使用启动时读取的配置
+        """
+        if content is None:
+            content = push_content
         self.keyword2num = dict()
         self.num2keyword = dict()
         for i in range(len(keys)):
             self.keyword2num[keys[i]] = i
             self.num2keyword[i] = keys[i]
-        self.message_blocks = self.format_preprocess(push_content.message_format)
-        self.user_dynamic_blocks = self.format_preprocess(push_content.user_dynamic_format)
-        self.replace_dict = self.pattern_dict_preprocess(push_content.replace)
-        self.content_cat_dict = self.pattern_dict_preprocess(push_content.categories)
+        self.sandbox = None
+        # 模板文本块及替换、类别表达式的编译计划与配置一致时直接读取缓存，跳过逐字解析及表达式的分析与合并
+        cache = None
+        key = None
+        if content.compile_cache:
+            key = compile_cache_key(content)
+            cache = load_compile_cache(content.compile_cache, key)
+        if cache is not None:
+            try:
+                self._build(content, cache)
+                return
+            except Exception:
+                log_text = 'Compile cache %s is invalid, recompiling.' % content.compile_cache
+                add_log(1, 'PushText', log_text)
+        # 启用sandbox时，可能产生灾难性回溯的表达式被隔离至子进程中匹配
+        isolated = []
+        if content.sandbox.enable:
+            isolated = [pattern for pattern in list(content.replace) + list(content.categories) if not is_safe(pattern)]
+        cache = {'key': key,
+                 'templates': {'message': self.format_blocks(content.message_format),
+                               'user_dynamic': self.format_blocks(content.user_dynamic_format),
+                               'digest': self.format_blocks(content.digest_format)},
+                 'replace': ReplaceEngine.make_plan(content.replace, isolated),
+                 'category': CategoryClassifier.make_plan(list(content.categories), isolated)}
+        self._build(content, cache)
+        if content.compile_cache:
+            save_compile_cache(content.compile_cache, cache)
+
+    def _build(self, content, cache: dict):
+        """
+        由编译计划生成推送模板、替换引擎及类别匹配器
+
+        :param content: Config.PushContent
+        :param cache: 编译计划
+        :return:
+        """
+        templates = cache['templates']
+        self.message_template = PushTemplate(templates['message'], self.num2keyword)
+        self.user_dynamic_template = PushTemplate(templates['user_dynamic'], self.num2keyword)
+        self.digest_template = PushTemplate(templates['digest'], self.num2keyword)
+        self.digest_separator = content.digest_separator
+        self.replace_engine = ReplaceEngine(content.replace, cache['replace'])
+        self.classifier = CategoryClassifier(content.categories, cache['category'])
+        sandbox = content.sandbox
+        if sandbox.enable and (self.classifier.isolated or self.replace_engine.segments):
+            # 子进程于首次匹配时启动
+            self.sandbox = RegexSandbox([(i, pattern.pattern) for i, pattern in self.classifier.isolated],
+                                        self.replace_engine.segments, sandbox.workers, sandbox.budget,
+                                        sandbox.batch_size, sandbox.batch_delay, sandbox.quarantine_after,
+                                        sandbox.stats_interval)
 
-    def format_preprocess(self, message_format: str):
+    def format_preprocess(self, message_format: str) -> PushTemplate:
         """
-        预处理用户自定义推送消息格式
+        预处理用户自定义推送消息格式，并编译为推送消息模板
 
         :param message_format: config中推送消息格式
         :return:
         """
+        return PushTemplate(self.format_blocks(message_format), self.num2keyword)
+
+    def format_blocks(self, message_format: str) -> list:
+        """
+        将用户自定义推送消息格式解析为文本块
+
+        :param message_format: config中推送消息格式
+        :return: 文本块列表，str为文本，int为关键词序号
+        """
         backslash_count = 0
         is_keyword = False
         candi_keyword = ""
@@ -69,32 +229,35 @@ class PushTextProcessor:
             blocks.append(message_format[block_begin:])
         return blocks
 
-    def pattern_dict_preprocess(self, pattern_dict: Dict[str, str]) -> Dict[Pattern, str]:
+    def get_content_cat(self, content: str):
         """
-        预处理用户自定义的用于替换discord消息正文的正则表达式
+        匹配消息动态正文类别
 
-        :param pattern_dict: config中用户自定义正则表达式字典
+        :param content: 消息正文
         :return:
         """
-        pattern_dict_compiled = dict()
-        for k in pattern_dict:
-            pattern = re.compile(k)
-            pattern_dict_compiled[pattern] = pattern_dict[k]
-        return pattern_dict_compiled
+        if len(self.classifier.patterns) == 0:
+            return ""
+        return self.classifier.classify(content)
 
-    def get_content_cat(self, content: str):
+    async def get_content_cat_async(self, content: str):
         """
-        匹配消息动态正文类别
+        匹配消息动态正文类别，隔离的表达式交由sandbox匹配
 
         :param content: 消息正文
         :return:
         """
-        if len(self.content_cat_dict) == 0:
+        if self.sandbox is None:
+            return self.get_content_cat(content)
+        classifier = self.classifier
+        if len(classifier.patterns) == 0:
             return ""
-        for pattern in self.content_cat_dict:
-            if re.search(pattern, content):
-                return self.content_cat_dict[pattern]
-        return None
+        best = classifier.search(content)
+        if classifier.isolated and classifier.isolated[0][0] < best:
+            index = await self.sandbox.evaluate('category', content, best)
+            if index is not None:
+                best = index
+        return classifier.category_of(best)
 
     def sub(self, content: str):
         """
@@ -103,9 +266,27 @@ class PushTextProcessor:
         :param content: discord消息正文
         :return:
         """
-        for pattern in self.replace_dict:
-            content = re.sub(pattern, self.replace_dict[pattern], content)
-        return content
+        return self.replace_engine.sub(content)
+
+    async def sub_async(self, content: str):
+        """
+        正则表达式替换消息正文内容，隔离的表达式交由sandbox替换
+
+        :param content: discord消息正文
+        :return:
+        """
+        if self.sandbox is None or not self.replace_engine.segments:
+            return self.replace_engine.sub(content)
+        return await self.replace_engine.sub_async(content, self.sandbox.evaluate)
+
+    def close(self):
+        """
+        关闭sandbox子进程
+
+        :return:
+        """
+        if self.sandbox is not None:
+            self.sandbox.close()
 
     def push_text_process(self, keywords: Dict[str, str], is_user_dynamic: bool):
         """
@@ -115,25 +296,26 @@ class PushTextProcessor:
         :param is_user_dynamic: 是否为用户动态推送
         :return:
         """
-        if is_user_dynamic:
-            blocks = self.user_dynamic_blocks.copy()
-        else:
-            blocks = self.message_blocks.copy()
-        for i in range(len(blocks)):
-            block = blocks[i]
-            if type(block) == int:
-                keyword = self.num2keyword[block]
-                v = keywords[keyword]
-                if not v:
-                    v = "None"
-                blocks[i] = v
-        return "".join(blocks)
+        with Timer('render'):
+            if is_user_dynamic:
+                return self.user_dynamic_template.render(keywords)
+            return self.message_template.render(keywords)
+
+    def render_digest(self, messages: List[str]):
+        """
+        将推送至同一对象的多条推送消息合并为一条摘要消息
+
+        :param messages: 已处理的推送消息
+        :return:
+        """
+        return self.digest_template.render({"count": str(len(messages)),
+                                            "messages": self.digest_separator.join(messages)})
 
     def escape_cqcode(self, text: str):
-        escaped_text = ""
-        for c in text:
-            if c in escape_character:
-                escaped_text += escape_character[c]
-            else:
-                escaped_text += c
-        return escaped_text
+        """
+        转义文本中的CQ码特殊字符
+
+        :param text: 文本
+        :return:
+        """
+        return text.translate(escape_table)
@@ -1,23 +1,168 @@
 import asyncio
-import json
+import random
+import re
 import time
 import traceback
 
 import aiohttp
 
+from Attachments import restore_missing_files
 from Config import config
 from Log import add_log
+from Metrics import push_results_total, push_retries_total, timed
+from OneBotTransport import create_transport
+from Outbox import Outbox
+
+inline_image_pattern = re.compile(r'base64://([A-Za-z0-9+/=]+)')
+
+
+def redact_inline_images(message: str) -> str:
+    """
+    将推送文本中base64编码的图片替换为其大小，用于log
+
+    :param message: 推送文本
+    :return:
+    """
+    if 'base64://' not in message:
+        return message
+    return inline_image_pattern.sub(lambda m: 'base64://<%d bytes>' % (len(m.group(1)) * 3 // 4), message)
+
+
+class TokenBucket:
+    """
+    令牌桶限速器
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: 每秒产生的令牌数，不大于0表示不限速
+        :param burst: 令牌桶容量
+        """
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """
+        等待并取得一个令牌
+
+        :return:
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
 
 
 class QQPush:
 
-    def __init__(self):
+    def __init__(self, render_digest=None):
+        """
+        :param render_digest: 将多条推送合并为一条推送的函数，参数为推送消息列表，为None时以空行连接
+        """
         self.qq_user = config.push.users
         self.qq_group = config.push.groups
-        self.coolq_url = config.cqhttp_url
-        self.coolq_token = config.cqhttp_token
-        self.session = aiohttp.ClientSession()
+        self.max_retries = config.push.max_retries
+        self.retry_base = config.push.retry_base
+        self.retry_max_delay = config.push.retry_max_delay
+        self.queue_size = config.push.queue_size
+        self.target_rate = config.push.target_rate
+        self.target_burst = config.push.target_burst
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=config.push.connection_limit))
+        # 通过HTTP或WebSocket调用onebot接口
+        self.transport = create_transport(self.session, config)
         self.is_closed = False
+        # 全局并发推送数量及速率限制
+        self.semaphore = asyncio.Semaphore(config.push.workers)
+        self.global_bucket = TokenBucket(config.push.global_rate, config.push.global_burst)
+        # 每个推送对象各自的队列、限速器及推送任务，保证同一对象的推送顺序
+        self.queues = dict()
+        self.buckets = dict()
+        self.workers = dict()
+        # 发件箱，保存未推送成功的消息
+        if config.push.outbox.enable:
+            self.outbox = Outbox(config.push.outbox.path, config.push.outbox.max_messages,
+                                 config.push.outbox.commit_interval)
+        else:
+            self.outbox = None
+        self.retry_interval = config.push.outbox.retry_interval
+        self.queued_ids = set()
+        self.parked_ids = set()
+        self.sweep_task = None
+        # 短时间内推送至同一对象的多条消息合并为一条推送
+        self.render_digest = render_digest if render_digest is not None else '\n\n'.join
+        self.set_coalesce(config.push.coalesce)
+        self.arrivals = dict()
+
+    def set_coalesce(self, coalesce):
+        """
+        设置推送合并参数
+
+        :param coalesce: Config.Coalesce
+        :return:
+        """
+        self.coalesce_window = coalesce.window if coalesce.enable else 0
+        self.coalesce_max_messages = coalesce.max_messages
+        self.coalesce_max_length = coalesce.max_length
+        self.priority_categories = set(coalesce.priority_categories)
+
+    def update_config(self, push, render_digest=None):
+        """
+        重新加载配置时替换推送对象及合并参数，已入队的消息仍推送至原对象
+
+        :param push: Config.Push
+        :param render_digest: 新的摘要消息生成函数，为None时不变
+        :return:
+        """
+        self.qq_user = push.users
+        self.qq_group = push.groups
+        self.set_coalesce(push.coalesce)
+        if render_digest is not None:
+            self.render_digest = render_digest
+
+    async def start(self):
+        """
+        连接cqhttp应用，打开发件箱，按顺序重新推送上次运行时未推送成功的消息
+
+        :return:
+        """
+        await self.transport.start()
+        if self.outbox is None:
+            return
+        await self.outbox.open()
+        rows = await self.outbox.load()
+        if rows:
+            log = 'Replaying %d unsent messages from push outbox.' % len(rows)
+            add_log(0, 'PUSH', log)
+        for row_id, id_type, qq_id, message in rows:
+            self.enqueue(message, qq_id, id_type, row_id)
+        self.sweep_task = asyncio.ensure_future(self._sweep())
+
+    async def _sweep(self):
+        """
+        定时重新推送发件箱中推送失败的消息
+
+        :return:
+        """
+        while not self.is_closed:
+            await asyncio.sleep(self.retry_interval)
+            try:
+                rows = await self.outbox.load()
+            except Exception:
+                traceback.print_exc()
+                continue
+            for row_id, id_type, qq_id, message in rows:
+                # 已推送成功但删除尚未提交的消息不重新推送
+                if row_id not in self.queued_ids and row_id not in self.parked_ids and \
+                        row_id not in self.outbox.acked_ids:
+                    self.enqueue(message, qq_id, id_type, row_id)
 
     async def close(self):
         """
@@ -26,35 +171,170 @@ class QQPush:
         :return:
         """
         self.is_closed = True
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+        for worker in self.workers.values():
+            worker.cancel()
+        if self.outbox is not None:
+            await self.outbox.close()
+        await self.transport.close()
         await self.session.close()
 
-    async def push_message(self, message, permission):
+    async def push_message(self, message, permission, category=None):
         """
-        将消息按配置文件推送至QQ私聊或群聊
+        将消息按配置文件放入各QQ私聊或群聊的推送队列，启用发件箱时先写入发件箱
 
         :param message: message text
         :param permission: 1表示消息动态，2表示用户动态
+        :param category: 消息正文类别，属于优先类别的消息不等待合并，立即推送
         :return:
         """
-        for group in self.qq_group:
-            if group[permission]:
-                await self._push(message, group[0], 'group')
-        for user in self.qq_user:
-            if user[permission]:
-                await self._push(message, user[0], 'user')
+        if self.is_closed:
+            return
+        entries = [('group', group[0], message) for group in self.qq_group if group[permission]]
+        entries.extend(('user', user[0], message) for user in self.qq_user if user[permission])
+        row_ids = [None] * len(entries)
+        if self.outbox is not None and entries:
+            try:
+                row_ids = await self.outbox.add(entries)
+            except Exception:
+                traceback.print_exc()
+        urgent = category in self.priority_categories
+        for (id_type, qq_id, _), row_id in zip(entries, row_ids):
+            self.enqueue(message, qq_id, id_type, row_id, urgent)
 
-    async def _push(self, message, qq_id, id_type):
+    def enqueue(self, message, qq_id, id_type, row_id=None, urgent=False):
         """
-        将消息推送至cqhttp
+        将消息放入推送对象的队列，队列不存在时创建队列及推送任务
+
         :param message: message text
         :param qq_id: QQ user ID or group ID
         :param id_type: "group"表示群聊, "user"私聊
+        :param row_id: 消息在发件箱中的id，未启用发件箱时为None
+        :param urgent: 是否立即推送，不等待合并
+        :return:
+        """
+        if self.is_closed:
+            return
+        target = (id_type, qq_id)
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            self.queues[target] = queue
+            self.buckets[target] = TokenBucket(self.target_rate, self.target_burst)
+            self.arrivals[target] = asyncio.Event()
+            self.workers[target] = asyncio.ensure_future(self._worker(target, queue))
+        try:
+            queue.put_nowait((row_id, message, urgent, asyncio.get_event_loop().time()))
+        except asyncio.QueueFull:
+            log = 'Push queue of %s %d is full, message dropped. Message: %s' % \
+                  (id_type, qq_id, redact_inline_images(message))
+            add_log(1, 'PUSH', log)
+            return
+        if row_id is not None:
+            self.queued_ids.add(row_id)
+        self.arrivals[target].set()
+
+    async def _collect(self, target, queue, first):
+        """
+        收集合并窗口内推送至同一对象的消息，窗口自第一条消息入队时开始计算
+
+        :param target: (id_type, qq_id)
+        :param queue: 推送队列
+        :param first: 第一条消息
+        :return: 合并的消息列表，及因超出长度上限而留待下次推送的消息
+        """
+        batch = [first]
+        length = len(first[1])
+        if self.coalesce_window <= 0 or first[2]:
+            return batch, None
+        arrival = self.arrivals[target]
+        deadline = first[3] + self.coalesce_window
+        loop = asyncio.get_event_loop()
+        while len(batch) < self.coalesce_max_messages:
+            arrival.clear()
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(arrival.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if length + len(item[1]) > self.coalesce_max_length:
+                return batch, item
+            batch.append(item)
+            length += len(item[1])
+            if item[2]:
+                break
+        return batch, None
+
+    async def _worker(self, target, queue):
+        """
+        按顺序推送单个推送对象队列中的消息，启用合并时将合并窗口内的多条消息合并为一条推送
+
+        :param target: (id_type, qq_id)
+        :param queue: 推送队列
+        :return:
+        """
+        id_type, qq_id = target
+        pending = None
+        while not self.is_closed:
+            if pending is None:
+                first = await queue.get()
+            else:
+                first, pending = pending, None
+            batch, pending = await self._collect(target, queue, first)
+            if len(batch) == 1:
+                message = batch[0][1]
+            else:
+                message = self.render_digest([item[1] for item in batch])
+            status = None
+            try:
+                status = await self._push(message, qq_id, id_type)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            push_results_total.inc(str(status) if status is not None else 'timeout')
+            row_ids = [item[0] for item in batch if item[0] is not None]
+            if not row_ids:
+                continue
+            self.queued_ids.difference_update(row_ids)
+            if status == 200:
+                self.outbox.ack(row_ids)
+            elif status in (401, 403, 404):
+                # 配置错误，保留于发件箱中待重启后重新推送
+                self.parked_ids.update(row_ids)
+
+    def _backoff(self, retries):
+        """
+        计算带随机抖动的指数退避时间
+
+        :param retries: 已重试次数
         :return:
         """
-        # message = pattern.sub(lambda m: rep[re.escape(m.group(0))], message)
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base * 2 ** retries))
+
+    @timed('push')
+    async def _push(self, message, qq_id, id_type):
+        """
+        将消息推送至cqhttp，每次调用前等待限速器及并发推送名额，失败时指数退避后重试
+
+        :param message: message text
+        :param qq_id: QQ user ID or group ID
+        :param id_type: "group"表示群聊, "user"私聊
+        :return: 最后一次调用的HTTP状态码，调用未完成时为None
+        """
+        # 排队期间被淘汰的本地图片文件改为推送原链接
+        message = restore_missing_files(message)
         data = {'message': message, 'auto_escape': False}
-        headers = {'Content-type': 'application/json'}
-        url = '%s/send_msg' % self.coolq_url
 
         if id_type == 'group':
             data['message_type'] = 'group'
@@ -63,54 +343,60 @@ class QQPush:
             data['message_type'] = 'private'
             data['user_id'] = qq_id
 
-        # 判断是否设置cqhttp access token
-        if self.coolq_token != "":
-            headers['Authorization'] = "Bearer " + self.coolq_token
-
-        # 5次重试
-        for i in range(5):
+        bucket = self.buckets.get((id_type, qq_id))
+        for i in range(self.max_retries):
+            if bucket is not None:
+                await bucket.acquire()
+            await self.global_bucket.acquire()
             try:
-                async with self.session.post(url, headers=headers, data=json.dumps(data), timeout=10) as response:
-                    if response is not None:
-                        if response.status == 200:
-                            # cqhttp接受消息，但不知操作实际成功与否
-                            log = 'Message to %s %d is sent. Response:%d. Retries:%d. Message: %s' % \
-                                  (id_type, qq_id, response.status, i, data)
-                            add_log(0, 'PUSH', log)
-                            break
-                        if response.status == 401:
-                            # token needed
-                            log = 'Failed to send message to %s %d. Reason: Access token is not provided. ' \
-                                  'Response:%d. Retries:%d. Message: %s' % (id_type, qq_id, response.status, i, data)
-                            add_log(0, 'PUSH', log)
-                            break
-                        if response.status == 403:
-                            # token is wrong
-                            log = 'Failed to send message to %s %d. Reason: Access token is wrong. ' \
-                                  'Response:%d. Retries:%d. Message: %s' % (id_type, qq_id, response.status, i, data)
-                            add_log(0, 'PUSH', log)
-                            break
-                        if response.status == 404:
-                            # url is wrong
-                            log = 'Failed to send message to %s %d. Reason: Coolq URL is wrong. ' \
-                                  'Response:%d. Retries:%d. Message: %s' % (id_type, qq_id, response.status, i, data)
-                            add_log(0, 'PUSH', log)
-                            break
-                    if i == 4:
-                        # 未超时但失败，还没出过这问题
-                        log = 'Failed to send message to %s %d. Response:%d. Message: %s' % \
-                              (id_type, qq_id, response.status, data)
-                        add_log(0, 'PUSH', log)
-            except:
+                async with self.semaphore:
+                    status = await self.transport.call('send_msg', data, timeout=10)
+                if status == 200:
+                    # cqhttp接受消息，但不知操作实际成功与否
+                    # 推送成功时仅记录推送对象及长度，推送失败时方记录正文
+                    log = 'Message to %s %d is sent. Response:%d. Retries:%d. Length:%d.' % \
+                          (id_type, qq_id, status, i, len(message))
+                    add_log(0, 'PUSH', log)
+                    return status
+                if status == 401:
+                    # token needed
+                    log = 'Failed to send message to %s %d. Reason: Access token is not provided. ' \
+                          'Response:%d. Retries:%d. Message: %s' % \
+                          (id_type, qq_id, status, i, redact_inline_images(message))
+                    add_log(0, 'PUSH', log)
+                    return status
+                if status == 403:
+                    # token is wrong
+                    log = 'Failed to send message to %s %d. Reason: Access token is wrong. ' \
+                          'Response:%d. Retries:%d. Message: %s' % \
+                          (id_type, qq_id, status, i, redact_inline_images(message))
+                    add_log(0, 'PUSH', log)
+                    return status
+                if status == 404:
+                    # url is wrong
+                    log = 'Failed to send message to %s %d. Reason: Coolq URL is wrong. ' \
+                          'Response:%d. Retries:%d. Message: %s' % \
+                          (id_type, qq_id, status, i, redact_inline_images(message))
+                    add_log(0, 'PUSH', log)
+                    return status
+                if i == self.max_retries - 1:
+                    # 未超时但失败
+                    log = 'Failed to send message to %s %d. Response:%d. Message: %s' % \
+                          (id_type, qq_id, status, redact_inline_images(message))
+                    add_log(0, 'PUSH', log)
+                    return status
+            except asyncio.CancelledError:
+                raise
+            except Exception:
                 traceback.print_exc()
-                if i == 4:
-                    # 哦 5次全超时
+                if i == self.max_retries - 1:
+                    # 全部超时
                     log = 'Timeout! Failed to send message to %s %d. Message: %s' % \
-                          (id_type, qq_id, data)
+                          (id_type, qq_id, redact_inline_images(message))
                     add_log(0, 'PUSH', log)
-                    break
-                await asyncio.sleep(5)
-                if self.is_closed:
-                    break
-                continue
-
+                    return None
+            push_retries_total.inc()
+            await asyncio.sleep(self._backoff(i))
+            if self.is_closed:
+                break
+        return None
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import signal
+import traceback
+from typing import Callable, Optional, Tuple
+
+from Log import add_log
+
+
+class ConfigWatcher:
+    """
+    配置文件监视器
+
+    定时比较配置文件的修改时间及大小，或收到SIGHUP时重新加载配置。配置文件的读取、校验及编译于线程池中进行，
+    完成后在事件循环中一次性替换，出错时保留当前配置，同一版本的文件不会重复加载。
+    """
+
+    def __init__(self, path: str, prepare: Callable, apply: Callable, interval: float = 2.0):
+        """
+        :param path: 配置文件路径
+        :param prepare: 读取并编译配置的函数，参数为配置文件路径，于线程池中调用，出错时应抛出异常
+        :param apply: 替换配置的函数，参数为prepare的返回值，于事件循环中调用
+        :param interval: 检查配置文件的间隔，单位为秒，不大于0表示仅在收到SIGHUP时重新加载
+        """
+        self.path = path
+        self.prepare = prepare
+        self.apply = apply
+        self.interval = interval
+        self.version = self._version()
+        self.task = None
+        self.lock = asyncio.Lock()
+        self._signal = False
+
+    def _version(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        """
+        注册SIGHUP处理函数并开始定时检查
+
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+                self._signal = True
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.interval > 0:
+            self.task = asyncio.ensure_future(self._watch())
+
+    def close(self):
+        """
+        停止检查并移除SIGHUP处理函数
+
+        :return:
+        """
+        if self.task is not None:
+            self.task.cancel()
+        if self._signal:
+            asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+            self._signal = False
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            version = self._version()
+            if version is not None and version != self.version:
+                await self.reload()
+
+    async def reload(self) -> bool:
+        """
+        重新加载配置文件
+
+        :return: 是否加载成功
+        """
+        async with self.lock:
+            version = self._version()
+            loop = asyncio.get_event_loop()
+            try:
+                prepared = await loop.run_in_executor(None, self.prepare, self.path)
+            except Exception as e:
+                # 编辑器保存途中的文件亦会读取失败，待文件再次变更时重试
+                self.version = version
+                log_text = 'Failed to reload config %s, keeping the current config. Reason: %r' % (self.path, e)
+                add_log(2, 'Config', log_text)
+                return False
+            self.version = version
+            try:
+                self.apply(prepared)
+            except Exception:
+                traceback.print_exc()
+                return False
+            add_log(0, 'Config', 'Reloaded config %s.' % self.path)
+            return True
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+回放gateway录制文件，用法：python Replay.py <capture> [options]
+
+录制文件由config.json中capture设置生成。回放时按录制顺序将事件转换为轻量的discord对象，送入DiscordMonitor的各事件处理方法，
+可用于离线复现问题、以真实流量进行性能分析，以及修改推送格式后补发推送。默认不推送，仅统计推送数量。
+回放不读取及保存用户名快照，不录制gateway事件，不写入动态存档，不显示系统通知，不下载附件。
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from Capture import read_capture
+from LiteModels import LiteActivity, LiteAttachment, LiteChannel, LiteEmbed, LiteEmbedImage, LiteGuild, LiteMember, \
+    LiteMessage, LiteUser
+
+# discord snowflake纪元，单位为毫秒
+discord_epoch = 1420070400000
+
+
+def snowflake_time(snowflake: int) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(((snowflake >> 22) + discord_epoch) / 1000)
+
+
+def parse_time(timestamp: Optional[str]) -> Optional[datetime.datetime]:
+    """
+    将ISO 8601时间转换为不含时区的UTC时间，与discord.py一致
+
+    :param timestamp: ISO 8601时间
+    :return:
+    """
+    if not timestamp:
+        return None
+    parsed = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class ReplayChannel(LiteChannel):
+    """
+    回放用频道，标注列表由已回放的消息得出
+    """
+
+    __slots__ = ('replayer',)
+
+    def __init__(self, id: int, name: str, guild: LiteGuild, replayer: 'Replayer'):
+        super().__init__(id, name, guild)
+        self.replayer = replayer
+
+    async def pins(self):
+        return self.replayer.pinned_messages(self.id)
+
+
+class Replayer:
+    """
+    将录制的gateway事件转换为轻量的discord对象并送入DiscordMonitor
+    """
+
+    def __init__(self, monitor, speed: float = 0.0, max_messages: int = 100000):
+        """
+        :param monitor: DiscordMonitor
+        :param speed: 回放速度，1为按录制时的间隔回放，0为尽快回放
+        :param max_messages: 缓存的消息数量上限，用于编辑及删除事件
+        """
+        self.monitor = monitor
+        self.speed = speed
+        self.max_messages = max_messages
+        self.guilds: Dict[int, LiteGuild] = dict()
+        self.channels: Dict[int, ReplayChannel] = dict()
+        self.users: Dict[int, LiteUser] = dict()
+        self.members: Dict[Tuple[int, int], LiteMember] = dict()
+        self.messages: 'OrderedDict[int, LiteMessage]' = OrderedDict()
+        self.counts: Dict[str, int] = dict()
+        self.skipped = 0
+
+    def guild(self, guild_id, name: Optional[str] = None) -> LiteGuild:
+        guild_id = int(guild_id)
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = LiteGuild(guild_id, name or str(guild_id))
+            self.guilds[guild_id] = guild
+        elif name:
+            guild.name = name
+        return guild
+
+    def channel(self, channel_id, guild: LiteGuild, name: Optional[str] = None) -> ReplayChannel:
+        channel_id = int(channel_id)
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = ReplayChannel(channel_id, name or str(channel_id), guild, self)
+            self.channels[channel_id] = channel
+            guild.channels.append(channel)
+        elif name:
+            channel.name = name
+        return channel
+
+    def user(self, data: dict) -> LiteUser:
+        user_id = int(data['id'])
+        user = self.users.get(user_id)
+        if user is None:
+            user = LiteUser(user_id, data.get('username', str(user_id)), data.get('discriminator', '0000'),
+                            data.get('bot', False))
+            self.users[user_id] = user
+        else:
+            user.name = data.get('username', user.name)
+            user.discriminator = data.get('discriminator', user.discriminator)
+        return user
+
+    def message(self, data: dict, channel: ReplayChannel) -> LiteMessage:
+        attachments = [LiteAttachment(int(a['id']), a['url'], a.get('filename', ''), a.get('content_type'),
+                                      a.get('size', 0)) for a in data.get('attachments', [])]
+        embeds = []
+        for embed in data.get('embeds', []):
+            image = embed.get('image') or dict()
+            embeds.append(LiteEmbed(LiteEmbedImage(image.get('url'), image.get('proxy_url'))))
+        message_id = int(data['id'])
+        return LiteMessage(message_id, data.get('content', ''), self.user(data['author']), channel, attachments,
+                           embeds, snowflake_time(message_id), data.get('pinned', False), data.get('type', 0))
+
+    def pinned_messages(self, channel_id: int):
+        """
+        已回放的消息中被标注的消息，由新到旧排列
+
+        :param channel_id: 频道ID
+        :return:
+        """
+        return [message for message in reversed(self.messages.values())
+                if message.pinned and message.channel.id == channel_id]
+
+    def cache_message(self, message: LiteMessage):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        if len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+    def member_update(self, record: dict):
+        """
+        由PRESENCE_UPDATE或GUILD_MEMBER_UPDATE得出成员变更前后的状态，首次出现的成员仅记录状态
+
+        :param record: 录制的事件
+        :return: (before, after)，无法得出before时为None
+        """
+        data = record['d']
+        guild = self.guild(data['guild_id'], record.get('guild_name'))
+        user = self.user(data['user'])
+        key = (guild.id, user.id)
+        before = self.members.get(key)
+        base = before if before is not None else LiteMember(user, guild)
+        changes = {'name': user.name, 'discriminator': user.discriminator}
+        if record['type'] == 'PRESENCE_UPDATE':
+            changes['status'] = data.get('status', base.status)
+            activities = data.get('activities') or []
+            changes['activity'] = LiteActivity(activities[0].get('name')) if activities else None
+        else:
+            changes['nick'] = data.get('nick')
+        after = base.copy(**changes)
+        self.members[key] = after
+        guild.members[user.id] = after
+        if before is None:
+            return None
+        return before, after
+
+    async def dispatch(self, record: dict):
+        """
+        将单条录制的事件送入对应的事件处理方法
+
+        :param record: 录制的事件
+        :return:
+        """
+        event_type = record['type']
+        data = record['d']
+        monitor = self.monitor
+        self.counts[event_type] = self.counts.get(event_type, 0) + 1
+        if event_type in ('PRESENCE_UPDATE', 'GUILD_MEMBER_UPDATE'):
+            update = self.member_update(record)
+            if update is None:
+                self.skipped += 1
+                return
+            await monitor.on_member_update(*update)
+            return
+        if data.get('guild_id') is None:
+            # 私聊消息
+            self.skipped += 1
+            return
+        guild = self.guild(data['guild_id'], record.get('guild_name'))
+        channel = self.channel(data['channel_id'], guild, record.get('channel_name'))
+        if event_type == 'MESSAGE_CREATE':
+            message = self.message(data, channel)
+            self.cache_message(message)
+            await monitor.on_message(message)
+        elif event_type == 'MESSAGE_UPDATE':
+            before = self.messages.get(int(data['id']))
+            if before is None:
+                self.skipped += 1
+                return
+            changes = dict()
+            if 'content' in data:
+                changes['content'] = data['content']
+            if 'pinned' in data:
+                changes['pinned'] = data['pinned']
+            if 'embeds' in data or 'attachments' in data:
+                merged = self.message(dict(data, author={'id': before.author.id}), channel)
+                changes['attachments'] = merged.attachments
+                changes['embeds'] = merged.embeds
+            after = before.copy(**changes)
+            self.cache_message(after)
+            await monitor.on_message_edit(before, after)
+        elif event_type == 'MESSAGE_DELETE':
+            message = self.messages.pop(int(data['id']), None)
+            if message is None:
+                self.skipped += 1
+                return
+            await monitor.on_message_delete(message)
+        elif event_type == 'CHANNEL_PINS_UPDATE':
+            await monitor.on_guild_channel_pins_update(channel, parse_time(data.get('last_pin_timestamp')))
+
+    async def run(self, records: Iterable[dict]) -> int:
+        """
+        按顺序回放事件
+
+        :param records: 录制的事件，可为逐行读取的生成器
+        :return: 回放的事件数量
+        """
+        count = 0
+        first_time = None
+        start = time.monotonic()
+        for record in records:
+            if self.speed > 0:
+                if first_time is None:
+                    first_time = record['time']
+                delay = start + (record['time'] - first_time) / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.dispatch(record)
+            count += 1
+            if count % 256 == 0:
+                # 让出事件循环，使推送任务得以执行
+                await asyncio.sleep(0)
+        return count
+
+
+def isolate_config(config):
+    """
+    关闭回放时会读写运行中使用的文件或产生外部作用的功能：不读取及保存用户名快照，回放结果不受快照影响，亦不覆盖运行中的快照；
+    不录制gateway事件，不写入动态存档，不显示系统通知，不下载附件
+
+    :param config: Config
+    :return:
+    """
+    config.user_dynamic_monitor.username_snapshot = ''
+    config.capture.enable = False
+    config.archive.enable = False
+    config.toast = False
+    config.attachment_cache.enable = False
+
+
+async def replay(args) -> int:
+    from Config import config
+    from DiscordMonitor import DiscordMonitor
+    isolate_config(config)
+    monitor = DiscordMonitor(loop=asyncio.get_event_loop())
+    pushes = []
+    if args.push:
+        await monitor.qq_push.start()
+    else:
+        async def push_message(message, permission, category=None):
+            pushes.append(message)
+            if args.print:
+                print(message)
+                print('---')
+
+        monitor.qq_push.push_message = push_message
+    replayer = Replayer(monitor, args.speed, args.max_messages)
+    start = time.monotonic()
+    count = await replayer.run(read_capture(args.capture))
+    elapsed = time.monotonic() - start
+    # 等待标注列表请求及推送完成
+    pending = list(monitor.pin_fetches.values())
+    if pending:
+        await asyncio.wait(pending, timeout=args.drain_timeout)
+    queues = [queue.join() for queue in monitor.qq_push.queues.values()]
+    if queues:
+        try:
+            await asyncio.wait_for(asyncio.gather(*queues), args.drain_timeout)
+        except asyncio.TimeoutError:
+            print('Timed out waiting for pushes to finish')
+    await monitor.close()
+    print('replayed: %d events in %.2f s (%.0f events/s), skipped: %d' %
+          (count, elapsed, count / elapsed if elapsed > 0 else 0, replayer.skipped))
+    print('events: %s' % ', '.join('%s: %d' % item for item in sorted(replayer.counts.items())))
+    if not args.push:
+        print('pushes: %d (not sent, use --push to send)' % len(pushes))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a Discord Monitor gateway capture',
+                                     epilog='The username snapshot is neither loaded nor saved, and gateway capture, '
+                                            'the event archive, notifications and attachment downloads are off, so '
+                                            'a replay never writes to the files of a running monitor.')
+    parser.add_argument('capture', help='capture file, .jsonl or .jsonl.gz')
+    parser.add_argument('--config', help='config file, defaults to DISCORD_MONITOR_CONFIG or a prompt')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='1 for real time, 10 for ten times faster, 0 for as fast as possible')
+    parser.add_argument('--push', action='store_true', help='send pushes to cqhttp, e.g. to backfill')
+    parser.add_argument('--print', action='store_true', help='print push texts when not sending them')
+    parser.add_argument('--max-messages', type=int, default=100000,
+                        help='messages kept for edit and delete events')
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    args = parser.parse_args()
+    if args.config:
+        os.environ['DISCORD_MONITOR_CONFIG'] = args.config
+    return asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+from typing import Dict, FrozenSet, Iterable, Optional
+
+
+def _to_ids(values: Iterable) -> FrozenSet[int]:
+    """
+    将配置中的ID转换为int集合，忽略无法转换的占位值
+
+    :param values: 字符串或整型ID
+    :return:
+    """
+    ids = set()
+    for value in values:
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return frozenset(ids)
+
+
+class MonitorRouter:
+    """
+    由配置预编译的事件路由索引
+
+    用户ID、频道ID及Server ID均以int存储于frozenset中，按频道名指定的频道在加入Server、频道创建或更名时解析为频道ID，
+    使每次事件的判断仅需一次集合查找。集合为None表示不作限制。
+    """
+
+    def __init__(self, message_monitor, user_dynamic_monitor):
+        """
+        :param message_monitor: Config.MessageMonitor
+        :param user_dynamic_monitor: Config.UserDynamicMonitor
+        """
+        # 消息动态
+        self.message_users: Optional[FrozenSet[int]] = _to_ids(message_monitor.users) if message_monitor.users else None
+        self.all_channels = len(message_monitor.channel_ids) == 0
+        # 频道ID为0表示不通过频道ID监听
+        self.static_channels = _to_ids(message_monitor.channel_ids) - {0}
+        self.channel_names: Dict[str, FrozenSet[str]] = {server: frozenset(channels) for server, channels in
+                                                         message_monitor.channel_names.items()}
+        self.resolved_channels: Dict[int, FrozenSet[int]] = dict()
+        self.message_channels: Optional[FrozenSet[int]] = None
+        # 用户动态
+        self.dynamic_users: FrozenSet[int] = _to_ids(user_dynamic_monitor.users)
+        self.dynamic_servers: Optional[FrozenSet[int]] = _to_ids(user_dynamic_monitor.servers) if \
+            user_dynamic_monitor.servers else None
+        self._rebuild()
+
+    def _rebuild(self):
+        """
+        合并频道ID及已解析的频道名，生成新的频道集合并整体替换
+
+        :return:
+        """
+        if self.all_channels:
+            self.message_channels = None
+            return
+        channels = set(self.static_channels)
+        for ids in self.resolved_channels.values():
+            channels.update(ids)
+        self.message_channels = frozenset(channels)
+
+    def resolve_guild(self, guild):
+        """
+        将Server中与频道名规则匹配的频道解析为频道ID，于加入Server、Server更名及频道创建、更名、删除时调用
+
+        :param guild: Guild
+        :return:
+        """
+        names = self.channel_names.get(guild.name)
+        if names:
+            ids = frozenset(channel.id for channel in guild.channels if channel.name in names)
+        else:
+            ids = frozenset()
+        if self.resolved_channels.get(guild.id, frozenset()) != ids:
+            if ids:
+                self.resolved_channels[guild.id] = ids
+            else:
+                self.resolved_channels.pop(guild.id, None)
+            self._rebuild()
+
+    def remove_guild(self, guild_id: int):
+        """
+        移除已离开Server的频道解析结果
+
+        :param guild_id: Server ID
+        :return:
+        """
+        if self.resolved_channels.pop(guild_id, None) is not None:
+            self._rebuild()
+
+    def is_monitored_channel(self, channel_id: int) -> bool:
+        """
+        判断频道是否被监听
+
+        :param channel_id: 频道ID
+        :return:
+        """
+        channels = self.message_channels
+        return channels is None or channel_id in channels
+
+    def is_monitored_message(self, user_id: int, channel_id: int) -> bool:
+        """
+        判断消息动态是否由被监听用户于被监听频道中发出
+
+        :param user_id: 用户ID
+        :param channel_id: 频道ID
+        :return:
+        """
+        users = self.message_users
+        if users is not None and user_id not in users:
+            return False
+        channels = self.message_channels
+        return channels is None or channel_id in channels
+
+    def is_monitored_user_dynamic(self, user_id: int, server_id: int) -> bool:
+        """
+        判断用户动态是否来自被监听用户及被监听Server
+
+        :param user_id: 用户ID
+        :param server_id: Server ID
+        :return:
+        """
+        if user_id not in self.dynamic_users:
+            return False
+        servers = self.dynamic_servers
+        return servers is None or server_id in servers
@@ -0,0 +1,346 @@
+import asyncio
+import multiprocessing
+import re
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from Log import add_log
+from Metrics import regex_timeouts_total
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def _worker_main(conn, categories: List[Tuple[int, str]], segments: List[List], budget: float):
+    """
+    子进程主循环，逐批接收消息并以隔离的表达式匹配类别或替换正文
+
+    每个表达式对每条消息的匹配时间上限为budget，超时的表达式视为未匹配（替换时不替换），该消息其余的隔离表达式照常匹配。
+
+    :param conn: 与主进程通信的Pipe
+    :param categories: (类别表达式序号, 表达式)列表
+    :param segments: 各组隔离替换表达式，[[表达式, 替换字符串], ...]列表
+    :param budget: 每个表达式对每条消息的匹配时间上限，单位为秒
+    :return:
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    compiled_categories = [(index, ('category', pattern), re.compile(pattern)) for index, pattern in categories]
+    compiled_segments = [[(('replace', pattern), re.compile(pattern), repl) for pattern, repl in segment]
+                         for segment in segments]
+    state = {'armed': False}
+    use_alarm = hasattr(signal, 'setitimer')
+    if use_alarm:
+        def on_alarm(signum, frame):
+            # 计时器恰于消息匹配完成后触发时不应中断主循环
+            if state['armed']:
+                raise BudgetExceeded()
+
+        signal.signal(signal.SIGALRM, on_alarm)
+
+    def arm():
+        if use_alarm:
+            state['armed'] = True
+            signal.setitimer(signal.ITIMER_REAL, budget)
+
+    def disarm():
+        if use_alarm:
+            state['armed'] = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def run(key, match, *args):
+        # 每个表达式的匹配时间上限均为budget，超时的表达式视为未匹配，继续匹配其余表达式
+        start = time.perf_counter()
+        arm()
+        try:
+            return match(*args)
+        except BudgetExceeded:
+            timeouts.append(key)
+            return None
+        finally:
+            disarm()
+            timing = timings.setdefault(key, [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        skip, batch = request
+        results = []
+        timeouts = []
+        timings: Dict[Tuple[str, str], List[float]] = dict()
+        for op, content, arg in batch:
+            if op == 'category':
+                result = None
+                for index, key, pattern in compiled_categories:
+                    if index >= arg:
+                        break
+                    if key not in skip and run(key, pattern.search, content):
+                        result = index
+                        break
+            else:
+                result = content
+                for key, pattern, repl in compiled_segments[arg]:
+                    if key in skip:
+                        continue
+                    replaced = run(key, pattern.sub, repl, result)
+                    if replaced is not None:
+                        result = replaced
+            results.append(result)
+        try:
+            conn.send((results, timeouts, timings))
+        except (EOFError, OSError):
+            break
+
+
+class _Worker:
+    """
+    匹配子进程及其通信管道
+    """
+
+    def __init__(self, context, categories: List[Tuple[int, str]], segments: List[List], budget: float):
+        # call与close可能于不同线程中使用同一Pipe，关闭时等待当前批次完成
+        self.lock = threading.Lock()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, categories, segments, budget),
+                                       name='RegexSandbox', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def call(self, request, deadline: float):
+        """
+        发送一批消息并等待结果，于线程池中调用
+
+        :param request: (跳过的表达式, 消息列表)
+        :param deadline: 等待时间上限，单位为秒
+        :return:
+        """
+        with self.lock:
+            self.conn.send(request)
+            if not self.conn.poll(deadline):
+                raise asyncio.TimeoutError()
+            return self.conn.recv()
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1.0)
+
+    def close(self):
+        """
+        等待当前批次完成后停止子进程，于线程池中调用
+
+        :return:
+        """
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            self.process.join(1.0)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join(1.0)
+            self.conn.close()
+
+
+class RegexSandbox:
+    """
+    用户正则表达式隔离执行器
+
+    可能产生灾难性回溯的表达式于子进程中匹配，消息按批发送以减少进程间通信次数，每个表达式对每条消息有匹配时间上限。
+    多次超时的表达式被隔离并不再匹配，各表达式的耗时定期记录至log。子进程无响应时被终止并重新启动，该批消息按未匹配处理。
+    """
+
+    def __init__(self, categories: List[Tuple[int, str]], segments: List[List], workers: int = 2,
+                 budget: float = 0.05, batch_size: int = 64, batch_delay: float = 0.005, quarantine_after: int = 3,
+                 stats_interval: float = 300):
+        """
+        :param categories: 隔离的(类别表达式序号, 表达式)列表
+        :param segments: 各组隔离替换表达式，[[表达式, 替换字符串], ...]列表
+        :param workers: 子进程数量
+        :param budget: 每个表达式对每条消息的匹配时间上限，单位为秒
+        :param batch_size: 每批消息数量上限
+        :param batch_delay: 凑批等待时间，单位为秒
+        :param quarantine_after: 表达式超时该次数后被隔离
+        :param stats_interval: 记录表达式耗时的间隔，单位为秒，不大于0表示不记录
+        """
+        self.categories = categories
+        self.segments = segments
+        self.worker_count = max(1, workers)
+        self.budget = budget
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.quarantine_after = quarantine_after
+        self.stats_interval = stats_interval
+        # fork无需重新导入主模块，不支持fork的平台上子进程重新导入主模块并读取DISCORD_MONITOR_CONFIG指定的配置
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix='RegexSandbox')
+        self.workers: List[_Worker] = []
+        self.idle = None
+        self.pending = []
+        # 等待空闲子进程的批次及其任务
+        self.waiting: Dict[asyncio.Future, List] = dict()
+        self.flush_handle = None
+        self.strikes: Dict[Tuple[str, str], int] = dict()
+        self.quarantined = set()
+        self.stats: Dict[Tuple[str, str], List[float]] = dict()
+        self.last_stats = time.monotonic()
+        self.closed = False
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self.context, self.categories, self.segments, self.budget)
+        self.workers.append(worker)
+        return worker
+
+    def _start(self):
+        self.idle = asyncio.Queue()
+        for _ in range(self.worker_count):
+            self.idle.put_nowait(self._spawn())
+
+    async def evaluate(self, op: str, content: str, arg):
+        """
+        以隔离的表达式匹配类别或替换正文
+
+        :param op: 'category'或'replace'
+        :param content: 消息正文
+        :param arg: 'category'时为隔离表达式以外最靠前的匹配序号，'replace'时为替换表达式组序号
+        :return: 'category'时为匹配的表达式序号，无匹配或超时为None；'replace'时为替换后的正文，超时的表达式不替换
+        """
+        if self.closed:
+            return None if op == 'category' else content
+        if self.idle is None:
+            self._start()
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((op, content, arg, future))
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.batch_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending:
+            batch = self.pending
+            self.pending = []
+            task = asyncio.ensure_future(self._run(batch))
+            self.waiting[task] = batch
+
+    async def _run(self, batch: List):
+        """
+        由空闲子进程处理一批消息
+
+        :param batch: (op, content, arg, future)列表
+        :return:
+        """
+        worker = await self.idle.get()
+        self.waiting.pop(asyncio.current_task(), None)
+        request = (frozenset(self.quarantined), [(op, content, arg) for op, content, arg, _ in batch])
+        # 子进程内的计时器失效或不可用时，以整批的时间上限兜底，每个表达式的匹配时间上限均为budget
+        patterns = sum(len(self.categories) if op == 'category' else len(self.segments[arg]) for op, _, arg, _ in batch)
+        deadline = self.budget * patterns + 1.0
+        loop = asyncio.get_event_loop()
+        try:
+            results, timeouts, timings = await loop.run_in_executor(self.executor, worker.call, request, deadline)
+        except Exception as e:
+            for op, content, _, future in batch:
+                if not future.done():
+                    future.set_result(None if op == 'category' else content)
+            # 已关闭时子进程由close停止
+            if self.closed:
+                return
+            log_text = 'Regex worker failed on a batch of %d messages, restarting it. Reason: %r' % (len(batch), e)
+            add_log(2, 'Sandbox', log_text)
+            regex_timeouts_total.inc(amount=len(batch))
+            if worker in self.workers:
+                self.workers.remove(worker)
+            await loop.run_in_executor(self.executor, worker.kill)
+            if not self.closed:
+                self.idle.put_nowait(self._spawn())
+            return
+        if not self.closed:
+            self.idle.put_nowait(worker)
+        for (_, _, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        for key, (count, seconds) in timings.items():
+            stat = self.stats.setdefault(key, [0, 0.0])
+            stat[0] += count
+            stat[1] += seconds
+        for key in timeouts:
+            self._strike(key)
+        if 0 < self.stats_interval <= time.monotonic() - self.last_stats:
+            self.log_stats()
+
+    def _strike(self, key: Tuple[str, str]):
+        """
+        记录表达式超时，超时次数达到上限时隔离该表达式
+
+        :param key: (用途, 表达式)
+        :return:
+        """
+        regex_timeouts_total.inc()
+        strikes = self.strikes.get(key, 0) + 1
+        self.strikes[key] = strikes
+        if strikes >= self.quarantine_after and key not in self.quarantined:
+            self.quarantined.add(key)
+            log_text = 'Quarantined %s regex %r after %d timeouts, it is no longer evaluated until reload.' % \
+                       (key[0], key[1], strikes)
+            add_log(1, 'Sandbox', log_text)
+
+    def log_stats(self, top: int = 5):
+        """
+        记录平均耗时最长的表达式
+
+        :param top: 记录的表达式数量
+        :return:
+        """
+        self.last_stats = time.monotonic()
+        slowest = sorted(self.stats.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)[:top]
+        if not slowest:
+            return
+        text = ', '.join('%s %r: %.3f ms avg over %d, %d timeouts' %
+                         (key[0], key[1], seconds / count * 1000, count, self.strikes.get(key, 0))
+                         for key, (count, seconds) in slowest)
+        add_log(0, 'Sandbox', 'Slowest regexes: ' + text)
+
+    def close(self):
+        """
+        关闭子进程，不阻塞事件循环。尚未发送的消息按未匹配处理，正在匹配的批次完成后子进程于线程池中停止
+
+        :return:
+        """
+        self.closed = True
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batches = [self.pending] + list(self.waiting.values())
+        for task in self.waiting:
+            task.cancel()
+        self.waiting.clear()
+        self.pending = []
+        for batch in batches:
+            for op, content, _, future in batch:
+                if not future.done():
+                    future.set_result(None if op == 'category' else content)
+        for worker in self.workers:
+            self.executor.submit(worker.close)
+        self.workers = []
+        # 已提交的任务仍会执行
+        self.executor.shutdown(wait=False)
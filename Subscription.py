@@ -0,0 +1,168 @@
+import asyncio
+import traceback
+from collections import OrderedDict
+from typing import Optional
+
+import discord
+
+from Log import add_log
+from QQPush import TokenBucket
+from Router import MonitorRouter
+
+
+class SubscriptionScheduler:
+    """
+    用户Token的Server订阅（op 14）调度器
+
+    仅订阅路由配置中涉及的Server，含被监听频道的Server优先于仅监听用户动态的Server，订阅请求按令牌桶限速发送，
+    避免大量Server同时订阅触发gateway限速。订阅于连接就绪及恢复后重新进行。
+    """
+
+    def __init__(self, client: discord.Client, router: MonitorRouter, message_monitoring: bool,
+                 user_monitoring: bool, rate: float = 1.0, burst: int = 5, max_channels: int = 5):
+        """
+        :param client: discord.Client
+        :param router: 路由索引
+        :param message_monitoring: 是否监听消息动态
+        :param user_monitoring: 是否监听用户动态
+        :param rate: 每秒发送的订阅请求数
+        :param burst: 连续发送的订阅请求数上限
+        :param max_channels: 单个Server订阅的频道数量上限
+        """
+        self.client = client
+        self.router = router
+        self.message_monitoring = message_monitoring
+        self.user_monitoring = user_monitoring
+        self.bucket = TokenBucket(rate, burst)
+        self.max_channels = max_channels
+        # 待订阅的Server，guild_id: 优先级
+        self.pending = OrderedDict()
+        # 本次连接中已订阅的Server
+        self.subscribed = set()
+        self.task = None
+
+    def channels_of(self, guild: discord.Guild) -> list:
+        """
+        取得Server中需订阅的频道，被监听的频道在前
+
+        :param guild: Guild
+        :return: 频道列表
+        """
+        text_channels = [channel for channel in guild.channels if isinstance(channel, discord.TextChannel)]
+        channels = []
+        if self.message_monitoring:
+            channels = [channel for channel in text_channels if self.router.is_monitored_channel(channel.id)]
+        if not channels and self.is_dynamic_guild(guild) and text_channels:
+            channels = text_channels[:1]
+        return channels[:self.max_channels]
+
+    def is_dynamic_guild(self, guild: discord.Guild) -> bool:
+        """
+        判断是否监听Server中的用户动态
+
+        :param guild: Guild
+        :return:
+        """
+        if not self.user_monitoring:
+            return False
+        servers = self.router.dynamic_servers
+        return servers is None or guild.id in servers
+
+    def priority(self, guild: discord.Guild) -> Optional[int]:
+        """
+        计算Server的订阅优先级
+
+        :param guild: Guild
+        :return: 0为含被监听频道，1为仅监听用户动态，None为无需订阅
+        """
+        if self.message_monitoring and any(self.router.is_monitored_channel(channel.id) for channel in guild.channels):
+            return 0
+        if self.is_dynamic_guild(guild):
+            return 1
+        return None
+
+    def schedule_all(self, guilds):
+        """
+        重新订阅所有需订阅的Server
+
+        :param guilds: Guild列表
+        :return:
+        """
+        candidates = []
+        for guild in guilds:
+            priority = self.priority(guild)
+            if priority is not None:
+                candidates.append((priority, guild.id))
+        candidates.sort(key=lambda item: item[0])
+        self.pending = OrderedDict((guild_id, priority) for priority, guild_id in candidates)
+        self.subscribed.clear()
+        add_log(0, 'Discord', 'Subscribing to %d of %d guilds.' % (len(self.pending), len(guilds)))
+        self._start()
+
+    def schedule(self, guild: discord.Guild):
+        """
+        订阅单个Server，用于加入Server或Server变为可用时
+
+        :param guild: Guild
+        :return:
+        """
+        priority = self.priority(guild)
+        if priority is None or guild.id in self.pending or guild.id in self.subscribed:
+            return
+        self.pending[guild.id] = priority
+        if priority == 0:
+            self.pending.move_to_end(guild.id, last=False)
+        self._start()
+
+    def _start(self):
+        if self.pending and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._run())
+
+    def cancel(self):
+        """
+        取消尚未发送的订阅
+
+        :return:
+        """
+        self.pending.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        sent = 0
+        while self.pending:
+            guild_id, _ = self.pending.popitem(last=False)
+            guild = self.client.get_guild(guild_id)
+            if guild is None:
+                continue
+            channels = self.channels_of(guild)
+            if not channels:
+                continue
+            await self.bucket.acquire()
+            payload = {
+                "op": 14,
+                "d": {
+                    "guild_id": str(guild.id),
+                    "typing": True,
+                    "threads": False,
+                    "activities": True,
+                    "members": [],
+                    "channels": {str(channel.id): [[0, 99]] for channel in channels}
+                }
+            }
+            ws = self.client.ws
+            if ws is None:
+                # 连接断开，待恢复后重新订阅
+                self.pending.clear()
+                break
+            try:
+                await ws.send_as_json(payload)
+                self.subscribed.add(guild.id)
+                sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                self.pending.clear()
+                break
+        add_log(0, 'Discord', 'Subscribed to %d guilds.' % sent)
@@ -0,0 +1,935 @@
+import os
+import re
+from typing import Dict, Iterable, List, Pattern, Tuple
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+# 合并后无法保持原语义的操作符
+_UNMERGEABLE_OPS = {sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS, sre_constants.GROUPREF_IGNORE}
+# 可回溯的重复操作符，占有型重复不回溯
+_REPEAT_OPS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+# 回溯分析所理解的操作符，含其他操作符的表达式视为不安全
+_ANALYZED_OPS = {sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN,
+                 sre_constants.AT, sre_constants.CATEGORY, sre_constants.SUBPATTERN, sre_constants.BRANCH,
+                 sre_constants.ASSERT, sre_constants.ASSERT_NOT} | _REPEAT_OPS
+_ANALYZED_OPS.update(getattr(sre_constants, name) for name in ('POSSESSIVE_REPEAT', 'ATOMIC_GROUP')
+                     if hasattr(sre_constants, name))
+
+
+def _iter_ops(subpattern):
+    """
+    递归遍历解析后正则表达式中的所有操作符
+
+    :param subpattern: sre_parse.SubPattern
+    :return:
+    """
+    for op, av in subpattern:
+        yield op
+        stack = [av]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                yield from _iter_ops(item)
+            elif isinstance(item, (tuple, list)):
+                stack.extend(item)
+
+
+def _iter_pairs(subpattern):
+    """
+    递归遍历解析后正则表达式中的所有(操作符, 操作数)
+
+    :param subpattern: sre_parse.SubPattern
+    :return:
+    """
+    for op, av in subpattern:
+        yield op, av
+        for child in _children(av):
+            yield from _iter_pairs(child)
+
+
+def _children(av):
+    """
+    取得操作数中嵌套的子表达式
+
+    :param av: 操作数
+    :return:
+    """
+    stack = [av]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, sre_parse.SubPattern):
+            yield item
+        elif isinstance(item, (tuple, list)):
+            stack.extend(item)
+
+
+def _is_unbounded(op, av) -> bool:
+    return op in _REPEAT_OPS and av[1] == sre_constants.MAXREPEAT
+
+
+def _star_height(subpattern) -> int:
+    """
+    计算无上限重复的最大嵌套层数，包裹无上限重复的有限重复（如(.*,){11}）亦计为一层
+
+    :param subpattern: sre_parse.SubPattern
+    :return:
+    """
+    height = 0
+    for op, av in subpattern:
+        inner = max((_star_height(child) for child in _children(av)), default=0)
+        if _is_unbounded(op, av) or (op in _REPEAT_OPS and av[1] > 1 and inner > 0):
+            inner += 1
+        height = max(height, inner)
+    return height
+
+
+def _unbounded_repeats(subpattern) -> int:
+    """
+    计算无上限重复的数量
+
+    :param subpattern: sre_parse.SubPattern
+    :return:
+    """
+    count = 0
+    for op, av in subpattern:
+        if _is_unbounded(op, av):
+            count += 1
+        count += sum(_unbounded_repeats(child) for child in _children(av))
+    return count
+
+
+def _first_literal(alternative):
+    """
+    获取分支开头的字面量字符，开头不是字面量或分支可为空时返回None
+
+    :param alternative: sre_parse.SubPattern
+    :return:
+    """
+    for op, av in alternative:
+        if op is sre_constants.LITERAL:
+            return av
+        if op is sre_constants.SUBPATTERN:
+            return _first_literal(av[-1])
+        return None
+    return None
+
+
+def _ambiguous_repeat(subpattern, repeated: bool = False) -> bool:
+    """
+    判断无上限重复中是否有可能以同一字符开头的分支，如(a|aa)+
+
+    :param subpattern: sre_parse.SubPattern
+    :param repeated: 是否位于无上限重复中
+    :return:
+    """
+    for op, av in subpattern:
+        if op is sre_constants.BRANCH and repeated:
+            firsts = [_first_literal(alternative) for alternative in av[1]]
+            if None in firsts or len(set(firsts)) != len(firsts):
+                return True
+        inner = repeated or _is_unbounded(op, av)
+        if any(_ambiguous_repeat(child, inner) for child in _children(av)):
+            return True
+    return False
+
+
+def _sequence(subpattern) -> list:
+    """
+    展开顶层的无flag分组，得到按顺序匹配的操作符列表
+
+    :param subpattern: sre_parse.SubPattern
+    :return: (op, av)列表
+    """
+    items = []
+    for op, av in subpattern:
+        if op is sre_constants.SUBPATTERN and not av[1] and not av[2]:
+            items.extend(_sequence(av[-1]))
+        else:
+            items.append((op, av))
+    return items
+
+
+def _quadratic(parsed) -> bool:
+    """
+    判断未锚定开头的表达式是否在每个起始位置均可能扫描至正文末尾后失败，如\\s*$或\\s+x，匹配耗时与正文长度的平方成正比
+
+    :param parsed: sre_parse.SubPattern
+    :return:
+    """
+    items = _sequence(parsed)
+    if not items:
+        return False
+    op, av = items[0]
+    if op is sre_constants.AT and (av is sre_constants.AT_BEGINNING_STRING or
+                                   (av is sre_constants.AT_BEGINNING and
+                                    not parsed.state.flags & sre_constants.SRE_FLAG_MULTILINE)):
+        return False
+    # 开头的无上限重复之后仍有可能失败的部分
+    if _is_unbounded(op, av) and len(items) > 1:
+        return True
+    # 结尾的无上限重复之后为$、\b等断言
+    tail = len(items)
+    while tail > 0 and items[tail - 1][0] in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        tail -= 1
+    return 0 < tail < len(items) and _is_unbounded(*items[tail - 1])
+
+
+def is_safe(pattern: str) -> bool:
+    """
+    判断正则表达式是否不会发生灾难性回溯，可在事件循环中直接匹配
+
+    含反向引用、嵌套的无上限重复（如(a+)+及(.*,){11}）、无上限重复中开头相同的分支（如(a|aa)+）、三个及以上无上限重复（如.*a.*b.*）、
+    未锚定开头且以无上限重复开头或结尾（如\\s*$）的表达式，以及含无法分析的结构（如含重复的前后断言）的表达式视为不安全
+
+    :param pattern: 正则表达式
+    :return:
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, OverflowError, RecursionError):
+        return False
+    for op, av in _iter_pairs(parsed):
+        if op not in _ANALYZED_OPS:
+            return False
+        # 前后断言中的重复在每个位置均重新匹配，不作分析
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT) and _unbounded_repeats(av[1]):
+            return False
+    return _star_height(parsed) < 2 and _unbounded_repeats(parsed) < 3 and not _ambiguous_repeat(parsed) and \
+        not _quadratic(parsed)
+
+
+def _literal_prefix(parsed) -> str:
+    """
+    获取解析后正则表达式开头的字面量前缀，忽略开头的零宽边界断言
+
+    :param parsed: sre_parse.SubPattern
+    :return:
+    """
+    prefix = []
+    for op, av in parsed:
+        if op is sre_constants.AT and not prefix:
+            continue
+        if op is not sre_constants.LITERAL:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+def combine_patterns(patterns: List[str]) -> Tuple[Pattern, Dict[int, int]]:
+    """
+    将多个可合并的正则表达式合并为单个正则表达式
+
+    各表达式按字面量前缀组织为前缀树，以前瞻断言作为分支入口，使每个位置仅尝试前缀相符的表达式；分支内保持表达式原有顺序。
+    同一表达式可能出现在多个分支中。
+
+    :param patterns: 可合并的正则表达式列表
+    :return: 合并后的正则表达式，及外层分组序号至表达式序号的映射
+    """
+    parsed = [sre_parse.parse(pattern) for pattern in patterns]
+    inner_groups = [p.state.groups - 1 for p in parsed]
+    items = [(_literal_prefix(p), i) for i, p in enumerate(parsed)]
+    group_to_index = dict()
+    group_count = 0
+
+    def alternation(indexes: List[int]) -> str:
+        nonlocal group_count
+        branches = []
+        for i in indexes:
+            group_count += 1
+            group_to_index[group_count] = i
+            group_count += inner_groups[i]
+            branches.append('(%s)' % patterns[i])
+        return '|'.join(branches)
+
+    def build(group: List[Tuple[str, int]], depth: int, inherited: List[int]) -> str:
+        # 前缀恰好终止于此节点的表达式，以及祖先节点的表达式，均可能在此节点下任意分支中匹配
+        candidates = sorted(inherited + [i for prefix, i in group if len(prefix) == depth])
+        children = dict()
+        for prefix, i in group:
+            if len(prefix) > depth:
+                children.setdefault(prefix[depth], []).append((prefix, i))
+        branches = []
+        for child in children.values():
+            common = os.path.commonprefix([prefix for prefix, _ in child])
+            branches.append('(?=%s)(?:%s)' % (re.escape(common), build(child, len(common), candidates)))
+        if candidates:
+            branches.append(alternation(candidates))
+        return '|'.join(branches)
+
+    combined = build(items, 0, [])
+    if all(prefix for prefix, _ in items):
+        first_chars = ''.join(sorted(set(re.escape(prefix[0]) for prefix, _ in items)))
+        combined = '(?=[%s])(?:%s)' % (first_chars, combined)
+    return re.compile(combined), group_to_index
+
+
+def is_mergeable(pattern: str) -> bool:
+    """
+    判断正则表达式能否与其他表达式合并为单个多选分支
+
+    含反向引用、命名分组、全局flag或可匹配空字符串的表达式不可合并
+
+    :param pattern: 正则表达式
+    :return:
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, OverflowError, RecursionError):
+        return False
+    state = parsed.state
+    if state.flags & ~sre_constants.SRE_FLAG_UNICODE or state.groupdict:
+        return False
+    if parsed.getwidth()[0] == 0:
+        return False
+    return not any(op in _UNMERGEABLE_OPS for op in _iter_ops(parsed))
+
+
+# 字符类对应的单字符正则表达式，用于判断字符是否属于该类
+_CATEGORIES = {sre_constants.CATEGORY_DIGIT: re.compile(r'\d'), sre_constants.CATEGORY_NOT_DIGIT: re.compile(r'\D'),
+               sre_constants.CATEGORY_SPACE: re.compile(r'\s'), sre_constants.CATEGORY_NOT_SPACE: re.compile(r'\S'),
+               sre_constants.CATEGORY_WORD: re.compile(r'\w'), sre_constants.CATEGORY_NOT_WORD: re.compile(r'\W')}
+_WORD = _CATEGORIES[sre_constants.CATEGORY_WORD]
+
+
+def _any_char(_) -> bool:
+    return True
+
+
+class _CharSet:
+    """
+    可能匹配的字符集合，由可枚举的字符及无法枚举的字符类组成，两个字符类之间视为有交集
+    """
+
+    __slots__ = ('chars', 'tests')
+
+    def __init__(self, chars: Iterable[str] = (), tests: Iterable = ()):
+        self.chars = set(chars)
+        self.tests = list(tests)
+
+    def __contains__(self, char: str) -> bool:
+        return char in self.chars or any(test(char) for test in self.tests)
+
+    def __bool__(self) -> bool:
+        return bool(self.chars or self.tests)
+
+    def update(self, other: '_CharSet'):
+        self.chars |= other.chars
+        self.tests.extend(other.tests)
+
+    def copy(self) -> '_CharSet':
+        return _CharSet(self.chars, self.tests)
+
+    def isdisjoint(self, other: '_CharSet') -> bool:
+        if self.tests and other.tests:
+            return False
+        return not any(char in other for char in self.chars) and not any(char in self for char in other.chars)
+
+    def word(self):
+        """
+        :return: 所有字符均为\\w时为True，均不为\\w时为False，无法确定时为None
+        """
+        if self.tests or not self.chars:
+            return None
+        words = {_WORD.match(char) is not None for char in self.chars}
+        return words.pop() if len(words) == 1 else None
+
+
+def _in_set(items) -> _CharSet:
+    """
+    由字符集合[...]的操作数得出可能匹配的字符
+
+    :param items: IN的操作数
+    :return:
+    """
+    negate = False
+    chars = set()
+    tests = []
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_constants.RANGE and av[1] - av[0] < 256:
+            chars.update(map(chr, range(av[0], av[1] + 1)))
+        elif op is sre_constants.RANGE:
+            tests.append(lambda char, low=av[0], high=av[1]: low <= ord(char) <= high)
+        elif op is sre_constants.CATEGORY and av in _CATEGORIES:
+            tests.append(_CATEGORIES[av].match)
+        else:
+            tests.append(_any_char)
+    if negate:
+        return _CharSet(tests=[lambda char: char not in chars and not any(test(char) for test in tests)])
+    return _CharSet(chars, tests)
+
+
+class _Replacement:
+    """
+    替换表达式可能匹配及替换后可能产生的字符，用于判断之后的表达式能否与之在同一次扫描中替换
+    """
+
+    def __init__(self, pattern: str, repl: str):
+        """
+        :param pattern: 可合并的正则表达式
+        :param repl: 替换字符串
+        """
+        parsed = sre_parse.parse(pattern)
+        # 是否含\b或\B
+        self.boundary = False
+        # 是否含其他零宽断言
+        self.asserts = False
+        # 分组序号至分组可能匹配的字符，0为整个表达式
+        self.groups = dict()
+        # 匹配的首字符、非首字符及末字符
+        self.first, self.rest, self.last, _ = self._shape(parsed)
+        whole = self.first.copy()
+        whole.update(self.rest)
+        self.groups[0] = whole
+        self.max_width = parsed.getwidth()[1]
+        self.out_first, self.out_chars, self.out_last, self.out_empty = self._output(pattern, repl)
+
+    def _shape(self, subpattern):
+        """
+        :param subpattern: sre_parse.SubPattern
+        :return: (首字符, 非首字符, 末字符, 可否匹配空字符串)
+        """
+        first, rest, last = _CharSet(), _CharSet(), _CharSet()
+        nullable = True
+        consumed = False
+        for op, av in subpattern:
+            op_first, op_rest, op_last, op_nullable = self._op_shape(op, av)
+            if nullable:
+                first.update(op_first)
+            if consumed:
+                rest.update(op_first)
+            rest.update(op_rest)
+            if op_nullable:
+                last.update(op_last)
+            else:
+                last = op_last.copy()
+            nullable = nullable and op_nullable
+            consumed = consumed or bool(op_first)
+        return first, rest, last, nullable
+
+    def _op_shape(self, op, av):
+        if op is sre_constants.LITERAL:
+            chars = _CharSet(chr(av))
+            return chars, _CharSet(), chars, False
+        if op is sre_constants.IN:
+            chars = _in_set(av)
+            return chars, _CharSet(), chars, False
+        if op in (sre_constants.ANY, sre_constants.NOT_LITERAL):
+            chars = _CharSet(tests=[_any_char])
+            return chars, _CharSet(), chars, False
+        if op is sre_constants.AT:
+            if av in (sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY):
+                self.boundary = True
+            else:
+                self.asserts = True
+            return _CharSet(), _CharSet(), _CharSet(), True
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # 断言内容不计入匹配的字符，仅记录其中的分组
+            self.asserts = True
+            self._shape(av[1])
+            return _CharSet(), _CharSet(), _CharSet(), True
+        if op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, subpattern = av
+            shape = self._shape(subpattern)
+            if add_flags or del_flags:
+                # 局部flag（如(?i:...)）改变字面量的含义，不作分析
+                chars = _CharSet(tests=[_any_char])
+                shape = chars, chars, chars, shape[3]
+            if group is not None:
+                whole = shape[0].copy()
+                whole.update(shape[1])
+                self.groups[group] = whole
+            return shape
+        if op in _REPEAT_OPS or op is getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            low, high, subpattern = av
+            first, rest, last, nullable = self._shape(subpattern)
+            if high > 1:
+                # 第二次及之后重复的首字符位于匹配中间
+                rest = rest.copy()
+                rest.update(first)
+            return first, rest, last, nullable or low == 0
+        if op is sre_constants.BRANCH:
+            first, rest, last = _CharSet(), _CharSet(), _CharSet()
+            nullable = False
+            for alternative in av[1]:
+                shape = self._shape(alternative)
+                first.update(shape[0])
+                rest.update(shape[1])
+                last.update(shape[2])
+                nullable = nullable or shape[3]
+            return first, rest, last, nullable
+        if op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            return self._shape(av)
+        chars = _CharSet(tests=[_any_char])
+        return chars, chars, chars, True
+
+    def _output(self, pattern: str, repl: str):
+        """
+        :param pattern: 正则表达式
+        :param repl: 替换字符串
+        :return: (替换后文本的首字符, 所有字符, 末字符, 可否为空)
+        """
+        try:
+            template = sre_parse.parse_template(repl, re.compile(pattern))
+        except (re.error, IndexError):
+            chars = _CharSet(tests=[_any_char])
+            return chars, chars, chars, True
+        if isinstance(template, tuple):
+            # Python 3.11及之前为(分组列表, 字面量列表)
+            groups, pieces = template
+            pieces = list(pieces)
+            for index, group in groups:
+                pieces[index] = group
+        else:
+            pieces = list(template)
+        pieces = [piece for piece in pieces if piece is not None and piece != '']
+        any_chars = _CharSet(tests=[_any_char])
+
+        def edge(ordered, index):
+            # 分组可能匹配空字符串，继续取其后的字面量
+            chars = _CharSet()
+            for piece in ordered:
+                if isinstance(piece, str):
+                    chars.chars.add(piece[index])
+                    break
+                chars.update(self.groups.get(piece, any_chars))
+            return chars
+
+        chars = _CharSet()
+        for piece in pieces:
+            if isinstance(piece, str):
+                chars.chars.update(piece)
+            else:
+                chars.update(self.groups.get(piece, any_chars))
+        empty = not any(isinstance(piece, str) for piece in pieces)
+        return edge(pieces, 0), chars, edge(reversed(pieces), -1), empty
+
+    def allows(self, later: '_Replacement') -> bool:
+        """
+        判断之后的表达式能否与本表达式在同一次扫描中替换，结果与依次替换一致
+
+        之后的表达式不得含\\b、\\B以外的零宽断言，其匹配的非首字符不得为本表达式匹配的首字符（否则二者的匹配可能重叠），
+        且不得匹配本表达式替换后的文本或跨越替换后文本的两端；含\\b或\\B时替换前后两端字符的\\w属性须相同
+
+        :param later: 之后的表达式
+        :return:
+        """
+        if later.asserts:
+            return False
+        if not self.first.isdisjoint(later.rest):
+            return False
+        if self.out_empty and (later.max_width > 1 or later.boundary):
+            return False
+        if not self.out_chars.isdisjoint(later.first) or not self.out_first.isdisjoint(later.rest):
+            return False
+        if later.boundary:
+            for before, after in ((self.first, self.out_first), (self.last, self.out_last)):
+                word = before.word()
+                if word is None or word != after.word():
+                    return False
+        return True
+
+
+class ReplaceEngine:
+    """
+    多正则表达式替换引擎
+
+    相邻的可合并表达式被合并为单个正则表达式，仅扫描一次正文即完成替换；同一位置靠前的表达式优先匹配，已替换的文本不会再被同组表达式匹配。
+    可能匹配之前表达式替换后的文本或与其匹配重叠的表达式另起一组，使结果与依次替换一致。
+    不可合并的表达式单独作为一组，按原顺序依次替换。指定为隔离的表达式可交由RegexSandbox于子进程中替换。
+    """
+
+    def __init__(self, pattern_dict: Dict[str, str], plan: list = None, isolated: Iterable[str] = ()):
+        """
+        :param pattern_dict: config中用户自定义正则表达式字典，key为正则表达式，value为替换字符串
+        :param plan: 由相同pattern_dict生成的编译计划，为None时重新分析各表达式
+        :param isolated: 需隔离的表达式，相邻的隔离表达式组成一组，plan不为None时忽略
+        """
+        if plan is None:
+            plan = self.make_plan(pattern_dict, isolated)
+        # 可JSON序列化的编译计划，缓存后可跳过表达式的分析与合并
+        self.plan = plan
+        self.stages = [self._build(stage) for stage in plan]
+        # 各组隔离表达式，[[表达式, 替换字符串], ...]列表
+        self.segments = [stage[1] for stage in plan if stage[0] == 'isolated']
+
+    @staticmethod
+    def make_plan(pattern_dict: Dict[str, str], isolated: Iterable[str] = ()) -> list:
+        """
+        分析各表达式能否合并，生成编译计划
+
+        :param pattern_dict: config中用户自定义正则表达式字典
+        :param isolated: 需隔离的表达式
+        :return: ["sequential", 表达式, 替换字符串]、["merged", 合并后的表达式, [[外层分组序号, 表达式, 替换字符串], ...]]
+                 或["isolated", [[表达式, 替换字符串], ...]]列表
+        """
+        isolated = set(isolated)
+        plan = []
+        group = []
+        replacements = []
+        for pattern, repl in pattern_dict.items():
+            if pattern in isolated:
+                if group:
+                    plan.append(ReplaceEngine._merge_plan(group))
+                    group = []
+                    replacements = []
+                if plan and plan[-1][0] == 'isolated':
+                    plan[-1][1].append([pattern, repl])
+                else:
+                    plan.append(['isolated', [[pattern, repl]]])
+                continue
+            if is_mergeable(pattern):
+                replacement = _Replacement(pattern, repl)
+                if not all(earlier.allows(replacement) for earlier in replacements):
+                    # 可能匹配同组之前表达式替换后的文本或与其匹配重叠，另起一组
+                    plan.append(ReplaceEngine._merge_plan(group))
+                    group = []
+                    replacements = []
+                group.append((pattern, repl))
+                replacements.append(replacement)
+                continue
+            if group:
+                plan.append(ReplaceEngine._merge_plan(group))
+                group = []
+                replacements = []
+            plan.append(['sequential', pattern, repl])
+        if group:
+            plan.append(ReplaceEngine._merge_plan(group))
+        return plan
+
+    @staticmethod
+    def _merge_plan(group: List) -> list:
+        """
+        将一组表达式合并为单个正则表达式
+
+        :param group: (正则表达式, 替换字符串)列表
+        :return:
+        """
+        if len(group) == 1:
+            return ['sequential', group[0][0], group[0][1]]
+        combined, group_to_index = combine_patterns([pattern for pattern, _ in group])
+        return ['merged', combined.pattern, [[index, group[i][0], group[i][1]] for index, i in group_to_index.items()]]
+
+    @staticmethod
+    def _build(stage: list):
+        """
+        由编译计划生成替换函数
+
+        :param stage: 编译计划中的一项
+        :return:
+        """
+        if stage[0] == 'sequential':
+            return ReplaceEngine._sequential(re.compile(stage[1]), stage[2])
+        if stage[0] == 'isolated':
+            # 未使用RegexSandbox时于当前线程中依次替换
+            subs = [ReplaceEngine._sequential(re.compile(pattern), repl) for pattern, repl in stage[1]]
+
+            def isolated_stage(content: str) -> str:
+                for sub in subs:
+                    content = sub(content)
+                return content
+
+            return isolated_stage
+        return ReplaceEngine._merged(re.compile(stage[1]), stage[2])
+
+    @staticmethod
+    def _sequential(pattern: Pattern, repl: str):
+        """
+        生成单个表达式的替换函数
+
+        :param pattern: 已编译的正则表达式
+        :param repl: 替换字符串
+        :return:
+        """
+        sub = pattern.sub
+
+        def stage(content: str) -> str:
+            return sub(repl, content)
+
+        return stage
+
+    @staticmethod
+    def _merged(combined: Pattern, entries: List):
+        """
+        生成合并后表达式的单次扫描替换函数
+
+        :param combined: 已编译的合并后表达式
+        :param entries: [外层分组序号, 原表达式, 替换字符串]列表
+        :return:
+        """
+        # 外层分组最后闭合，lastindex即为所匹配表达式的外层分组序号
+        replacements = dict()
+        for index, pattern, repl in entries:
+            if '\\' in repl:
+                # 替换字符串中含转义或分组引用，需以原表达式在同一位置重新匹配后展开
+                replacements[index] = (re.compile(pattern), repl)
+            else:
+                replacements[index] = repl
+
+        def replace(match) -> str:
+            repl = replacements[match.lastindex]
+            if type(repl) is str:
+                return repl
+            pattern, template = repl
+            return pattern.match(match.string, match.start()).expand(template)
+
+        sub = combined.sub
+
+        def stage(content: str) -> str:
+            return sub(replace, content)
+
+        return stage
+
+    def sub(self, content: str) -> str:
+        """
+        替换消息正文
+
+        :param content: discord消息正文
+        :return:
+        """
+        for stage in self.stages:
+            content = stage(content)
+        return content
+
+    async def sub_async(self, content: str, evaluate) -> str:
+        """
+        替换消息正文，隔离的表达式交由evaluate替换
+
+        :param content: discord消息正文
+        :param evaluate: RegexSandbox.evaluate
+        :return:
+        """
+        segment = 0
+        for stage, (kind, *_) in zip(self.stages, self.plan):
+            if kind == 'isolated':
+                content = await evaluate('replace', content, segment)
+                segment += 1
+            else:
+                content = stage(content)
+        return content
+
+
+def _literal(parsed):
+    """
+    若解析后正则表达式仅由字面量组成，返回其对应的字符串，否则返回None
+
+    :param parsed: sre_parse.SubPattern
+    :return:
+    """
+    if parsed.state.flags & ~sre_constants.SRE_FLAG_UNICODE:
+        return None
+    chars = []
+    for op, av in parsed:
+        if op is not sre_constants.LITERAL:
+            return None
+        chars.append(chr(av))
+    return ''.join(chars)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick多关键词匹配自动机
+
+    转移表为稀疏DFA，各节点仅存储与根节点不同的转移，扫描正文时每个字符至多两次字典查找。
+    """
+
+    NO_MATCH = float('inf')
+
+    def __init__(self, keywords: List[Tuple[str, int]]):
+        """
+        :param keywords: (关键词, 优先级)列表，优先级数值越小越优先
+        """
+        goto = [dict()]
+        output = [self.NO_MATCH]
+        for keyword, priority in keywords:
+            state = 0
+            for c in keyword:
+                next_state = goto[state].get(c)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][c] = next_state
+                    goto.append(dict())
+                    output.append(self.NO_MATCH)
+                state = next_state
+            output[state] = min(output[state], priority)
+        # 广度优先计算失配指针，并将失配节点的转移及输出合并入各节点；与根节点相同的转移不重复存储
+        fail = [0] * len(goto)
+        delta = [dict() for _ in range(len(goto))]
+        queue = list(goto[0].values())
+        for state in queue:
+            output[state] = min(output[state], output[fail[state]])
+            transitions = dict(delta[fail[state]])
+            for c, next_state in goto[state].items():
+                if state != 0:
+                    fail_next = delta[fail[state]].get(c)
+                    fail[next_state] = goto[0].get(c, 0) if fail_next is None else fail_next
+                transitions[c] = next_state
+                queue.append(next_state)
+            delta[state] = transitions
+        self.root = goto[0]
+        self.delta = delta
+        self.output = output
+        self.min_priority = min(output) if output else self.NO_MATCH
+
+    def search(self, content: str, best=NO_MATCH):
+        """
+        查找正文中出现的关键词的最高优先级
+
+        :param content: 正文
+        :param best: 已知的最高优先级，仅查找更优先的关键词
+        :return: 最高优先级，无匹配则为NO_MATCH
+        """
+        output = self.output
+        best = min(best, output[0])
+        stop = self.min_priority
+        if best <= stop:
+            return best
+        root = self.root
+        delta = self.delta
+        state = 0
+        for c in content:
+            next_state = delta[state].get(c)
+            state = root.get(c, 0) if next_state is None else next_state
+            if output[state] < best:
+                best = output[state]
+                if best <= stop:
+                    break
+        return best
+
+
+class CategoryClassifier:
+    """
+    消息正文类别匹配器
+
+    纯字面量的类别关键词由Aho-Corasick自动机匹配，其余正则表达式合并后以前瞻断言逐位置查找，均只需扫描一次正文。
+    无法合并的正则表达式单独匹配。结果与按顺序逐条re.search得到的最靠前类别一致。指定为隔离的表达式可交由RegexSandbox于子进程中匹配。
+    """
+
+    def __init__(self, pattern_dict: Dict[str, str], plan: dict = None, isolated: Iterable[str] = ()):
+        """
+        :param pattern_dict: config中用户自定义类别字典，key为正则表达式，value为类别
+        :param plan: 由相同pattern_dict生成的编译计划，为None时重新分析各表达式
+        :param isolated: 需隔离的表达式，plan不为None时忽略
+        """
+        self.patterns = list(pattern_dict)
+        self.categories = [pattern_dict[pattern] for pattern in self.patterns]
+        self.hits = [0] * len(self.patterns)
+        if plan is None:
+            plan = self.make_plan(self.patterns, isolated)
+        # 可JSON序列化的编译计划，缓存后可跳过表达式的分析与合并
+        self.plan = plan
+        self.automaton = KeywordAutomaton([(keyword, i) for keyword, i in plan['keywords']])
+        self.separate = [(i, re.compile(self.patterns[i])) for i in plan['separate']]
+        # 隔离的表达式，序号由小到大排列
+        self.isolated = [(i, re.compile(self.patterns[i])) for i in plan.get('isolated', [])]
+        self.combined = None
+        self.combined_min = KeywordAutomaton.NO_MATCH
+        if plan['combined'] is not None:
+            # 以前瞻断言包裹，每个位置均产生零宽匹配，不会因匹配重叠而遗漏靠前的类别
+            self.combined = re.compile('(?=%s)' % plan['combined'])
+            self.combined_index = {group: i for group, i in plan['combined_index']}
+            self.combined_min = plan['combined_min']
+
+    @staticmethod
+    def make_plan(patterns: List[str], isolated: Iterable[str] = ()) -> dict:
+        """
+        将各表达式分为字面量关键词、可合并、需单独匹配及需隔离的表达式，生成编译计划
+
+        :param patterns: 正则表达式列表，按优先级排列
+        :param isolated: 需隔离的表达式
+        :return:
+        """
+        isolated = set(isolated)
+        keywords = []
+        mergeable = []
+        separate = []
+        isolated_indexes = []
+        for i, pattern in enumerate(patterns):
+            # 先行编译以检查表达式是否有误
+            re.compile(pattern)
+            if pattern in isolated:
+                isolated_indexes.append(i)
+                continue
+            parsed = sre_parse.parse(pattern)
+            literal = _literal(parsed)
+            if literal is not None:
+                keywords.append([literal, i])
+            elif parsed.state.flags & ~sre_constants.SRE_FLAG_UNICODE or parsed.state.groupdict or \
+                    any(op in _UNMERGEABLE_OPS for op in _iter_ops(parsed)):
+                separate.append(i)
+            else:
+                mergeable.append(i)
+        plan = {'keywords': keywords, 'separate': separate, 'isolated': isolated_indexes, 'combined': None}
+        if mergeable:
+            combined, group_to_index = combine_patterns([patterns[i] for i in mergeable])
+            plan['combined'] = combined.pattern
+            plan['combined_index'] = [[group, mergeable[i]] for group, i in group_to_index.items()]
+            plan['combined_min'] = mergeable[0]
+        return plan
+
+    def classify(self, content: str):
+        """
+        匹配消息正文类别
+
+        :param content: 消息正文
+        :return: 类别，无匹配则为None
+        """
+        best = self.search(content)
+        for i, pattern in self.isolated:
+            if i >= best:
+                break
+            if pattern.search(content):
+                best = i
+                break
+        return self.category_of(best)
+
+    def category_of(self, best):
+        """
+        取得序号对应的类别并计入命中次数
+
+        :param best: 表达式序号，无匹配则为NO_MATCH
+        :return: 类别，无匹配则为None
+        """
+        if best == KeywordAutomaton.NO_MATCH:
+            return None
+        self.hits[best] += 1
+        return self.categories[best]
+
+    def search(self, content: str):
+        """
+        查找除隔离表达式以外最靠前的匹配表达式
+
+        :param content: 消息正文
+        :return: 表达式序号，无匹配则为NO_MATCH
+        """
+        best = self.automaton.search(content)
+        for i, pattern in self.separate:
+            if i >= best:
+                break
+            if pattern.search(content):
+                best = i
+                break
+        if self.combined_min < best:
+            combined_index = self.combined_index
+            for match in self.combined.finditer(content):
+                i = combined_index[match.lastindex]
+                if i < best:
+                    best = i
+                    if i == self.combined_min:
+                        break
+        return best
+
+    def hit_counts(self) -> Dict[str, int]:
+        """
+        各类别表达式的命中次数
+
+        :return: 正则表达式至命中次数的字典
+        """
+        return dict(zip(self.patterns, self.hits))
@@ -0,0 +1,9 @@
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+# 各模块位于仓库根目录
+sys.path.insert(0, os.path.dirname(tests_dir))
+# Config于导入时读取配置文件，测试使用不写入快照及编译缓存的配置
+os.environ.setdefault('DISCORD_MONITOR_CONFIG', os.path.join(tests_dir, 'config.json'))
+os.environ.setdefault('DISCORD_MONITOR_HEADLESS', '1')
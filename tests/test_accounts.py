@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+from Accounts import SharedPipeline
+from Config import config
+from DiscordMonitor import DiscordMonitor
+from LiteModels import LiteChannel, LiteGuild, LiteMessage, LiteUser
+
+guild = LiteGuild(1, 'Server 1 name')
+channel = LiteChannel(1234567890, 'Channel 1 name', guild)
+author = LiteUser(123456789, 'John Smith')
+
+
+async def two_accounts():
+    shared = SharedPipeline(config)
+    loop = asyncio.get_event_loop()
+    monitors = [DiscordMonitor(shared, account, loop=loop) for account in (config.accounts[0], config.accounts[0])]
+    pushes = []
+    for monitor in monitors:
+        async def process_message(message, status, monitor=monitor):
+            pushes.append((monitor, message.id, status))
+
+        monitor.process_message = process_message
+    return shared, monitors, pushes
+
+
+async def close(shared, monitors):
+    for monitor in monitors:
+        await monitor.close()
+    await shared.close()
+
+
+def test_raw_events_left_to_owner():
+    async def run():
+        shared, (owner, other), pushes = await two_accounts()
+        assert owner.owns(guild)
+        await owner.on_message(LiteMessage(10, 'hello', author, channel))
+        await owner.on_message(LiteMessage(11, 'bye', author, channel))
+        # 非归属账号先收到原始事件时不得取出或覆盖共用缓存中的消息
+        edit = SimpleNamespace(guild_id=guild.id, channel_id=channel.id, message_id=10,
+                               data={'id': '10', 'content': 'edited'})
+        delete = SimpleNamespace(guild_id=guild.id, channel_id=channel.id, message_id=11)
+        bulk = SimpleNamespace(guild_id=guild.id, channel_id=channel.id, message_ids={10})
+        await other.on_raw_message_edit(edit)
+        await other.on_raw_message_delete(delete)
+        await owner.on_raw_message_edit(edit)
+        await owner.on_raw_message_delete(delete)
+        await other.on_raw_bulk_message_delete(bulk)
+        await owner.on_raw_bulk_message_delete(bulk)
+        await close(shared, [owner, other])
+        return [(monitor is owner, message_id, status) for monitor, message_id, status in pushes]
+
+    assert asyncio.run(run()) == [(True, 10, '发送消息'), (True, 11, '发送消息'), (True, 10, '编辑消息'),
+                                  (True, 11, '删除消息'), (True, 10, '删除消息')]
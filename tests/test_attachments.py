@@ -0,0 +1,26 @@
+import os
+import pathlib
+
+from Attachments import image_cqcode, restore_missing_files
+
+url = 'https://cdn.discordapp.com/attachments/1/2/a.png?ex=1&is=2'
+
+
+def test_image_cqcode():
+    assert image_cqcode(url) == '[CQ:image,file=%s,timeout=5]' % url
+    assert image_cqcode(url, 'base64://AAAA') == '[CQ:image,file=base64://AAAA,timeout=5]'
+    assert image_cqcode(url, 'file:///tmp/a.png') == \
+        '[CQ:image,file=file:///tmp/a.png,url=https://cdn.discordapp.com/attachments/1/2/a.png?ex=1&amp;is=2,timeout=5]'
+
+
+def test_missing_file_falls_back_to_url(tmp_path):
+    kept = tmp_path / 'kept file.png'
+    kept.write_bytes(b'png')
+    evicted = tmp_path / 'evicted.png'
+    message = 'a%sb%sc' % (image_cqcode(url, pathlib.Path(kept).as_uri()),
+                           image_cqcode(url, pathlib.Path(evicted).as_uri()))
+    restored = restore_missing_files(message)
+    assert restored == 'a%sb%sc' % (image_cqcode(url, pathlib.Path(kept).as_uri()),
+                                    '[CQ:image,file=%s,timeout=5]' % url.replace('&', '&amp;'))
+    assert os.path.exists(kept)
+    assert restore_missing_files('no images') == 'no images'
@@ -0,0 +1,151 @@
+import datetime
+
+import Cache
+from Cache import DedupCache, MessageStore, PinCache
+from LiteModels import LiteChannel, LiteGuild, LiteMessage, LiteUser
+
+guild = LiteGuild(1, 'Server 1 name')
+channels = [LiteChannel(1, 'Channel 1 name', guild), LiteChannel(2, 'Channel 2 name', guild)]
+author = LiteUser(123456789, 'John Smith')
+
+
+def message(message_id: int, channel: LiteChannel, age: float = 0) -> LiteMessage:
+    created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+    return LiteMessage(message_id, str(message_id), author, channel, created_at=created_at)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def patch_clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(Cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_dedup_ttl(monkeypatch):
+    clock = patch_clock(monkeypatch)
+    cache = DedupCache(ttl=5, max_size=100)
+    assert cache.check('a')
+    clock.now += 3
+    assert cache.check('b')
+    assert not cache.check('a')
+    assert 'a' in cache
+    # 键a于1005过期，过期的键于下次查询时清理
+    clock.now += 2
+    assert 'a' not in cache
+    assert not cache.check('b')
+    assert list(cache.entries) == ['b']
+    assert cache.check('a')
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_dedup_max_size(monkeypatch):
+    patch_clock(monkeypatch)
+    cache = DedupCache(ttl=5, max_size=3)
+    for key in range(5):
+        assert cache.check(key)
+    # 超出上限时淘汰最早插入的键
+    assert list(cache.entries) == [2, 3, 4]
+    assert cache.evictions == 2
+    assert cache.check(0)
+    assert not cache.check(4)
+
+
+def test_dedup_configure(monkeypatch):
+    clock = patch_clock(monkeypatch)
+    cache = DedupCache(ttl=10, max_size=5)
+    for key in range(4):
+        assert cache.check(key)
+        clock.now += 1
+    # 存活时间缩短后已有键按插入时间重新计算过期时间，超出新上限的最早的键被淘汰
+    cache.configure(ttl=3, max_size=3)
+    assert list(cache.entries) == [1, 2, 3]
+    clock.now += 0.5
+    # 键1于1004过期，键2及键3仍在缓存中
+    assert cache.check(1)
+    assert not cache.check(2)
+    assert not cache.check(3)
+    assert list(cache.entries) == [2, 3, 1]
+
+
+def test_pin_last_pin():
+    cache = PinCache(recent=60)
+    now = datetime.datetime.utcnow()
+    # 未缓存的频道按最新标注时间距今的时间判断
+    assert not cache.is_new_pin(1, now - datetime.timedelta(seconds=120))
+    assert cache.is_new_pin(2, now - datetime.timedelta(seconds=10))
+    # 已缓存的频道中最新标注时间变化表示标注，不变或提前表示取消标注
+    assert cache.is_new_pin(1, now - datetime.timedelta(seconds=100))
+    assert not cache.is_new_pin(1, now - datetime.timedelta(seconds=100))
+    assert not cache.is_new_pin(1, now - datetime.timedelta(seconds=110))
+    assert cache.get(1).last_pin == now - datetime.timedelta(seconds=100)
+    # 频道中已无标注消息
+    assert not cache.is_new_pin(1, None)
+    assert cache.get(1).last_pin is None
+    assert cache.get(1).loaded
+    assert not cache.is_new_pin(1, now - datetime.timedelta(seconds=120))
+
+
+def test_pin_update():
+    cache = PinCache()
+    # 缓存未初始化时仅最新标注的消息视为新标注
+    assert cache.update(1, [3, 2, 1]) == {3}
+    assert cache.update(1, [5, 4, 3, 1]) == {5, 4}
+    assert cache.get(1).ids == {5, 4, 3, 1}
+    assert not cache.set_pinned(1, 5, True)
+    assert cache.set_pinned(1, 6, True)
+    assert cache.set_pinned(1, 1, False)
+    assert not cache.set_pinned(1, 1, False)
+    assert cache.update(1, [6, 5, 4, 3]) == set()
+
+
+def test_message_store_limits(monkeypatch):
+    patch_clock(monkeypatch)
+    store = MessageStore(max_per_channel=2, max_age=100, sweep_interval=10)
+    for message_id in range(3):
+        store.add(message(message_id, channels[0]))
+    # 加入时移除超出数量上限的最早的消息及过期的消息
+    assert store.get(1, 0) is None
+    store.add(message(3, channels[1], age=200))
+    assert store.get(2, 3) is None
+    assert len(store) == 2
+    # 编辑后的消息替换原记录并保持原有位置
+    store.add(message(1, channels[0]).copy(content='edited'))
+    assert [record.content for record in store.channels[1].values()] == ['edited', '2']
+    assert store.pop(1, 1).content == 'edited'
+    assert store.pop(1, 1) is None
+    assert len(store) == 1
+
+
+def test_message_store_sweep(monkeypatch):
+    clock = patch_clock(monkeypatch)
+    store = MessageStore(max_per_channel=10, max_age=100, sweep_interval=10)
+    store.add(message(1, channels[0], age=95))
+    store.add(message(2, channels[1], age=50))
+    store.add(message(3, channels[1]))
+    # 不再收到消息的频道中的过期消息保留至下次定时清理
+    store.max_age = datetime.timedelta(seconds=90)
+    assert store.get(1, 1) is not None
+    clock.now += 10
+    assert store.get(2, 3) is not None
+    assert 1 not in store.channels
+    assert len(store) == 2
+
+
+def test_message_store_configure():
+    store = MessageStore(max_per_channel=10, max_age=0)
+    for message_id in range(5):
+        store.add(message(message_id, channels[0], age=1000 - message_id))
+    store.add(message(5, channels[1], age=2000))
+    assert len(store) == 6
+    # 超出新限制的消息立即移除
+    store.configure(max_per_channel=3, max_age=1500)
+    assert list(store.channels) == [1]
+    assert list(store.channels[1]) == [2, 3, 4]
+    assert len(store) == 3
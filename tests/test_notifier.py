@@ -0,0 +1,22 @@
+import pytest
+
+from Notifier import NotifierBackend, NullBackend, Notifier
+
+
+def test_backend_requires_notify():
+    class Incomplete(NotifierBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_close_shows_queued_notifications():
+    backend = NullBackend()
+    notifier = Notifier(backend, merge_window=60)
+    for i in range(3):
+        notifier.notify('title', str(i))
+    notifier.close()
+    assert notifier.shown == len(backend.notifications)
+    assert notifier.merged + notifier.shown == 3
+    assert '2' in backend.notifications[-1][1]
@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from OneBotTransport import HttpTransport, WebSocketTransport, failed_status, response_status
+
+
+class OneBotServer:
+    """
+    按预设的响应回复/send_msg及正向WebSocket调用
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.runner = None
+        self.url = None
+
+    def next_response(self):
+        return self.responses.pop(0) if self.responses else {'status': 'ok', 'retcode': 0}
+
+    async def send_msg(self, request):
+        self.calls.append(json.loads(await request.text()))
+        return web.json_response(self.next_response())
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            call = json.loads(msg.data)
+            self.calls.append(call['params'])
+            await ws.send_str(json.dumps(dict(self.next_response(), echo=call['echo'])))
+        return ws
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/send_msg', self.send_msg)
+        app.router.add_get('/', self.websocket)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = '127.0.0.1:%d' % site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        await self.runner.cleanup()
+
+
+@pytest.mark.parametrize('response,status', [
+    ({'status': 'ok', 'retcode': 0}, 200),
+    ({'status': 'async', 'retcode': 1}, 200),
+    ({'status': 'failed', 'retcode': 100}, failed_status),
+    ({'status': 'failed', 'retcode': 102}, failed_status),
+    ({'status': 'failed', 'retcode': 1403}, 403),
+    ({'status': 'failed', 'retcode': 1404}, 404),
+])
+def test_response_status(response, status):
+    assert response_status(response) == status
+
+
+@pytest.mark.parametrize('transport_type', ['http', 'websocket'])
+def test_failed_action_is_not_success(transport_type):
+    async def run():
+        async with OneBotServer([{'status': 'failed', 'retcode': 100}]) as server, aiohttp.ClientSession() as session:
+            if transport_type == 'http':
+                transport = HttpTransport(session, 'http://' + server.url, '')
+            else:
+                transport = WebSocketTransport(session, 'ws://' + server.url, '')
+            await transport.start()
+            statuses = [await transport.call('send_msg', {'message': str(i)}, timeout=5) for i in range(2)]
+            await transport.close()
+            return statuses, server.calls
+
+    statuses, calls = asyncio.run(run())
+    assert statuses == [failed_status, 200]
+    assert [call['message'] for call in calls] == ['0', '1']
+
+
+def test_written_call_not_resent_over_http():
+    class DroppingServer(OneBotServer):
+        def __init__(self):
+            super().__init__([])
+            self.http_calls = 0
+            self.echoes = []
+
+        async def send_msg(self, request):
+            self.http_calls += 1
+            return await super().send_msg(request)
+
+        async def websocket(self, request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            async for msg in ws:
+                call = json.loads(msg.data)
+                self.echoes.append(call['echo'])
+                if len(self.echoes) == 1:
+                    # 收到首个调用后不响应即断开连接
+                    await ws.close()
+                    break
+                await ws.send_str(json.dumps({'status': 'ok', 'retcode': 0, 'echo': call['echo']}))
+            return ws
+
+    async def run():
+        async with DroppingServer() as server, aiohttp.ClientSession() as session:
+            fallback = HttpTransport(session, 'http://' + server.url, '')
+            transport = WebSocketTransport(session, 'ws://' + server.url, '', fallback=fallback, reconnect_base=0.05)
+            await transport.start()
+            await asyncio.wait_for(transport.connected.wait(), 5)
+            status = await transport.call('send_msg', {'message': 'a'}, timeout=5)
+            await transport.close()
+            return status, server
+
+    status, server = asyncio.run(run())
+    assert status == 200
+    # 已写入连接的调用于重连后以相同的echo重新发送
+    assert server.http_calls == 0
+    assert len(server.echoes) == 2 and server.echoes[0] == server.echoes[1]
+
+
+def test_websocket_responses_matched_by_echo():
+    class ReorderingServer(OneBotServer):
+        async def websocket(self, request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            calls = []
+            async for msg in ws:
+                calls.append(json.loads(msg.data))
+                if len(calls) < 4:
+                    continue
+                # 事件上报及未知echo的响应被忽略，其余响应按与调用相反的顺序返回
+                await ws.send_str(json.dumps({'post_type': 'meta_event', 'meta_event_type': 'heartbeat'}))
+                await ws.send_str(json.dumps({'status': 'ok', 'retcode': 0, 'echo': 'unknown'}))
+                for call in reversed(calls):
+                    retcode = 0 if call['params']['message'].startswith('ok') else 100
+                    await ws.send_str(json.dumps({'status': 'ok' if retcode == 0 else 'failed',
+                                                  'retcode': retcode, 'echo': call['echo']}))
+            return ws
+
+    async def run():
+        async with ReorderingServer([]) as server, aiohttp.ClientSession() as session:
+            transport = WebSocketTransport(session, 'ws://' + server.url, '')
+            await transport.start()
+            await asyncio.wait_for(transport.connected.wait(), 5)
+            messages = ['ok 0', 'failed 1', 'ok 2', 'failed 3']
+            statuses = await asyncio.gather(*(transport.call('send_msg', {'message': message}, timeout=5)
+                                              for message in messages))
+            pending = len(transport.pending)
+            await transport.close()
+            return statuses, pending
+
+    statuses, pending = asyncio.run(run())
+    assert statuses == [200, failed_status, 200, failed_status]
+    assert pending == 0
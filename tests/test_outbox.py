@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from Outbox import Outbox
+
+
+async def open_outbox(tmp_path, max_messages=100, commit_interval=0.01) -> Outbox:
+    outbox = Outbox(str(tmp_path / 'outbox.db'), max_messages, commit_interval)
+    await outbox.open()
+    return outbox
+
+
+def test_add_after_close_rejected(tmp_path):
+    async def run():
+        outbox = await open_outbox(tmp_path)
+        await outbox.close()
+        with pytest.raises(RuntimeError):
+            await outbox.add([('user', 1, 'a')])
+
+    asyncio.run(run())
+
+
+def test_close_commits_pending_adds(tmp_path):
+    async def run():
+        outbox = await open_outbox(tmp_path)
+        # 模拟提交失败后等待重试的写入
+        outbox._schedule_flush = lambda: None
+        add = asyncio.ensure_future(outbox.add([('user', 1, 'a')]))
+        await asyncio.sleep(0)
+        await outbox.close()
+        assert len(await asyncio.wait_for(add, 1)) == 1
+        outbox = await open_outbox(tmp_path)
+        assert [row[1:] for row in await outbox.load()] == [('user', 1, 'a')]
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_add_ack_and_trim(tmp_path):
+    async def run():
+        outbox = await open_outbox(tmp_path, max_messages=3)
+        first, second = await asyncio.gather(outbox.add([('user', 1, 'a'), ('group', 2, 'a')]),
+                                             outbox.add([('user', 1, 'b')]))
+        assert first[0] < first[1] < second[0]
+        outbox.ack(first[:1])
+        # 确认尚未提交时已确认的消息仍在数据库中，定时重新推送时按acked_ids跳过
+        assert first[0] in outbox.acked_ids
+        await outbox.flush_task
+        assert not outbox.acked_ids
+        assert [row[3] for row in await outbox.load()] == ['a', 'b']
+        # 超出上限时删除最早的消息
+        await outbox.add([('user', 1, 'c'), ('user', 1, 'd')])
+        assert [row[3] for row in await outbox.load()] == ['b', 'c', 'd']
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_failed_commit_rolls_back_and_keeps_acks(tmp_path):
+    async def run():
+        outbox = await open_outbox(tmp_path)
+        row_ids = await outbox.add([('user', 1, 'a'), ('user', 1, 'b')])
+        # 重命名表使插入失败，同批次的删除一同回滚，确认保留至下次提交
+        outbox.conn.execute('ALTER TABLE outbox RENAME TO outbox_saved')
+        outbox.ack(row_ids[:1])
+        with pytest.raises(Exception):
+            await outbox.add([('user', 1, 'c')])
+        await outbox.flush_task
+        assert outbox.pending_acks == row_ids[:1]
+        assert row_ids[0] in outbox.acked_ids
+        outbox.conn.execute('ALTER TABLE outbox_saved RENAME TO outbox')
+        outbox.ack(row_ids[1:])
+        await outbox.flush_task
+        assert not outbox.pending_acks and not outbox.acked_ids
+        assert await outbox.load() == []
+        await outbox.close()
+
+    asyncio.run(run())
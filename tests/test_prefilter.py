@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from Prefilter import GatewayPrefilter
+
+
+def create_client():
+    parsed = []
+    parsers = {'PRESENCE_UPDATE': lambda data: parsed.append(('PRESENCE_UPDATE', data)),
+               'GUILD_MEMBER_UPDATE': lambda data: parsed.append(('GUILD_MEMBER_UPDATE', data)),
+               'MESSAGE_CREATE': lambda data: parsed.append(('MESSAGE_CREATE', data))}
+    client = SimpleNamespace(_connection=SimpleNamespace(parsers=parsers, self_id=1))
+    return client, parsed
+
+
+def member_update(user_id, guild_id=10):
+    return {'user': {'id': str(user_id)}, 'guild_id': str(guild_id)}
+
+
+def test_prefilter_drops_unmonitored_updates():
+    client, parsed = create_client()
+    prefilter = GatewayPrefilter(client, lambda user_id, guild_id: user_id == 2 and guild_id == 10)
+    prefilter.install()
+    prefilter.install()
+    parsers = client._connection.parsers
+    assert prefilter.installed and len(prefilter.originals) == 2
+    parsers['PRESENCE_UPDATE'](member_update(2))
+    parsers['PRESENCE_UPDATE'](member_update(2, 11))
+    parsers['GUILD_MEMBER_UPDATE'](member_update(3))
+    # 本账号的成员信息及无法判断的事件不丢弃，其他事件不经过预过滤
+    parsers['GUILD_MEMBER_UPDATE'](member_update(1))
+    parsers['PRESENCE_UPDATE']({'user': {}})
+    parsers['MESSAGE_CREATE']({'id': '5'})
+    assert parsed == [('PRESENCE_UPDATE', member_update(2)),
+                      ('GUILD_MEMBER_UPDATE', member_update(1)),
+                      ('PRESENCE_UPDATE', {'user': {}}),
+                      ('MESSAGE_CREATE', {'id': '5'})]
+
+
+def test_prefilter_uninstall():
+    client, parsed = create_client()
+    originals = dict(client._connection.parsers)
+    prefilter = GatewayPrefilter(client, lambda user_id, guild_id: False)
+    prefilter.install()
+    prefilter.uninstall()
+    assert not prefilter.installed
+    assert client._connection.parsers == originals
+    client._connection.parsers['PRESENCE_UPDATE'](member_update(3))
+    assert parsed == [('PRESENCE_UPDATE', member_update(3))]
@@ -0,0 +1,39 @@
+import asyncio
+
+from Accounts import SharedPipeline
+from Config import Config, config
+from DiscordMonitor import DiscordMonitor
+from LiteModels import LiteChannel, LiteGuild, LiteMessage, LiteUser
+from PushTextProcessor import PushTextProcessor
+
+
+def render_message(message_format: str, message: LiteMessage) -> str:
+    async def run():
+        shared = SharedPipeline(config)
+        monitor = DiscordMonitor(shared, loop=asyncio.get_event_loop())
+        pushes = []
+
+        async def push_message(message, permission, category=None):
+            pushes.append(message)
+
+        monitor.qq_push.push_message = push_message
+        monitor.push_text_processor = PushTextProcessor(Config.PushContent({
+            'message_format': message_format, 'user_dynamic_format': '', 'category': {}, 'replace': {},
+            'compile_cache': ''}))
+        await monitor.process_message(message, '发送消息')
+        await asyncio.sleep(0)
+        await monitor.close()
+        await shared.close()
+        return pushes
+
+    pushes = asyncio.run(run())
+    assert len(pushes) == 1
+    return pushes[0]
+
+
+def test_message_keywords():
+    channel = LiteChannel(1234567890, 'general', LiteGuild(42, 'Server'))
+    message = LiteMessage(7, 'hi [x]', LiteUser(123456789, 'John', '0001'), channel)
+    # 旧版以"channel_id:"为键，使用<channel_id>的推送模板渲染时出错，现渲染为频道ID
+    assert render_message('<channel_id> <server_id> #<channel_name> <user_id> <content>', message) == \
+        '1234567890 42 #general 123456789 hi &#91;x&#93;'
@@ -0,0 +1,172 @@
+import asyncio
+import random
+
+import pytest
+
+from Outbox import Outbox
+from QQPush import QQPush, TokenBucket
+
+
+class FakeTransport:
+    """
+    按预设的状态码回复send_msg调用，每次调用随机延迟
+    """
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def call(self, action, data, timeout):
+        self.calls.append(data)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(random.uniform(0, 0.005))
+        finally:
+            self.in_flight -= 1
+        return self.statuses.pop(0) if self.statuses else 200
+
+    async def close(self):
+        pass
+
+
+def create_push(transport: FakeTransport) -> QQPush:
+    push = QQPush()
+    push.transport = transport
+    push.target_rate = 0
+    push.global_bucket = TokenBucket(0, 1)
+    push.retry_base = 0
+    return push
+
+
+async def wait_for_calls(transport: FakeTransport, count: int):
+    for _ in range(500):
+        if len(transport.calls) >= count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('%d of %d calls made' % (len(transport.calls), count))
+
+
+def test_token_bucket():
+    async def run():
+        loop = asyncio.get_event_loop()
+        bucket = TokenBucket(rate=20, burst=3)
+        start = loop.time()
+        for _ in range(3):
+            await bucket.acquire()
+        burst = loop.time() - start
+        # 令牌用尽后每0.05秒产生一个令牌
+        for _ in range(4):
+            await bucket.acquire()
+        return burst, loop.time() - start
+
+    burst, total = asyncio.run(run())
+    assert burst < 0.03
+    assert 0.18 <= total < 0.4
+
+
+def test_per_target_order():
+    async def run():
+        transport = FakeTransport()
+        push = create_push(transport)
+        targets = [('group', 1), ('group', 2), ('user', 1)]
+        for i in range(20):
+            for id_type, qq_id in targets:
+                push.enqueue(str(i), qq_id, id_type)
+        await wait_for_calls(transport, 60)
+        await push.close()
+        return transport
+
+    transport = asyncio.run(run())
+    for key, qq_id in (('group_id', 1), ('group_id', 2), ('user_id', 1)):
+        messages = [call['message'] for call in transport.calls if call.get(key) == qq_id]
+        assert messages == [str(i) for i in range(20)]
+    # 不同推送对象并发推送
+    assert transport.max_in_flight > 1
+
+
+def test_retry_until_success():
+    async def run():
+        transport = FakeTransport([500, 500])
+        push = create_push(transport)
+        push.enqueue('a', 1, 'user')
+        await wait_for_calls(transport, 3)
+        await push.close()
+        return transport
+
+    transport = asyncio.run(run())
+    assert [call['message'] for call in transport.calls] == ['a'] * 3
+
+
+def create_coalescing_push(transport: FakeTransport, window: float) -> QQPush:
+    push = create_push(transport)
+    push.coalesce_window = window
+    push.coalesce_max_messages = 3
+    push.coalesce_max_length = 10
+    return push
+
+
+def test_coalesce_within_window():
+    async def run():
+        transport = FakeTransport()
+        push = create_coalescing_push(transport, 0.05)
+        for message in ('a', 'b', 'c', 'd', 'e'):
+            push.enqueue(message, 1, 'user')
+        await wait_for_calls(transport, 2)
+        # 超出长度上限的消息留待下次推送
+        push.enqueue('xyz', 1, 'user')
+        push.enqueue('0123456789', 1, 'user')
+        await wait_for_calls(transport, 4)
+        await push.close()
+        return transport
+
+    transport = asyncio.run(run())
+    assert [call['message'] for call in transport.calls] == ['a\n\nb\n\nc', 'd\n\ne', 'xyz', '0123456789']
+
+
+def test_urgent_message_flushes_batch():
+    async def run():
+        transport = FakeTransport()
+        push = create_coalescing_push(transport, 60)
+        push.enqueue('a', 1, 'user')
+        await asyncio.sleep(0.01)
+        push.enqueue('b', 1, 'user', urgent=True)
+        await wait_for_calls(transport, 1)
+        # 优先消息单独到达时不等待合并
+        push.enqueue('c', 1, 'user', urgent=True)
+        await wait_for_calls(transport, 2)
+        await push.close()
+        return transport
+
+    transport = asyncio.run(run())
+    assert [call['message'] for call in transport.calls] == ['a\n\nb', 'c']
+
+
+@pytest.mark.parametrize('status', [401, 403, 404])
+def test_config_errors_parked_in_outbox(tmp_path, status):
+    async def run():
+        transport = FakeTransport([status, 200])
+        push = create_push(transport)
+        push.outbox = Outbox(str(tmp_path / 'outbox.db'), 100, 0.01)
+        await push.outbox.open()
+        push.qq_group = []
+        push.qq_user = [[1, True, True]]
+        await push.push_message('a', 1)
+        await push.push_message('b', 1)
+        await wait_for_calls(transport, 2)
+        push.retry_interval = 0.01
+        push.sweep_task = asyncio.ensure_future(push._sweep())
+        await asyncio.sleep(0.05)
+        rows = await push.outbox.load()
+        parked, queued = set(push.parked_ids), set(push.queued_ids)
+        await push.close()
+        return transport, rows, parked, queued
+
+    transport, rows, parked, queued = asyncio.run(run())
+    # 配置错误时不重试，消息保留于发件箱且定时重新推送时跳过，推送成功的消息被删除
+    assert [call['message'] for call in transport.calls] == ['a', 'b']
+    assert [row[3] for row in rows] == ['a']
+    assert parked == {rows[0][0]}
+    assert not queued
@@ -0,0 +1,53 @@
+import random
+import re
+
+import pytest
+
+from TextMatcher import ReplaceEngine
+
+
+def legacy_sub(pattern_dict, content):
+    # 旧版逐条re.sub
+    for pattern, repl in pattern_dict.items():
+        content = re.sub(pattern, repl, content)
+    return content
+
+
+@pytest.mark.parametrize('pattern_dict,content', [
+    # 之后的表达式匹配之前表达式替换后的文本
+    ({'a': 'b', 'b': 'c'}, 'a'),
+    ({'cat': 'dog', 'dog': 'x'}, 'cat dog'),
+    # 之后的表达式的匹配与之前表达式的匹配重叠
+    ({'bc': 'X', 'ab': 'Y'}, 'abc'),
+    # 删除后两侧文本相接
+    ({'b': '', 'ac': 'Z'}, 'abc'),
+    # 替换改变了\b两侧字符的\w属性
+    ({'<x>': 'y', r'\by\b': 'Z'}, 'y<x>'),
+    ({r'<a?:(\w+):\d+>': r'[\1]', r'\bnick\b': 'N'}, '<:nick:1> nick'),
+])
+def test_sequential_semantics(pattern_dict, content):
+    assert ReplaceEngine(pattern_dict).sub(content) == legacy_sub(pattern_dict, content)
+
+
+def test_independent_patterns_merged():
+    pattern_dict = {r'<a?:Emote1:\d+>': '[表情1]', r'<a?:Emote2:\d+>': '[表情2]', r'\bnick1\b': '别名1'}
+    engine = ReplaceEngine(pattern_dict)
+    assert [stage[0] for stage in engine.plan] == ['merged']
+    content = '<a:Emote1:123> nick1 <:Emote2:4>nick1'
+    assert engine.sub(content) == legacy_sub(pattern_dict, content)
+
+
+def test_random_equivalence():
+    patterns = ['a', 'b', 'ab', 'ba', 'abc', 'a+b', 'b.c', '(a|b)c', '[ab]{2}', r'\bab', r'\bb\b', 'ca', 'cb+',
+                'a(?=b)', 'x[^a]', r'\d+', r'<(\w)>', '[a-c]x?', '(?:ab)+', r'c\B', 'a|bc', r'\w\d']
+    repls = ['a', 'b', 'c', '', 'z', 'bb', '<1>', r'[\1]', r'\g<0>x', '9', ' ', '_']
+    rand = random.Random(7)
+    for _ in range(5000):
+        pattern_dict = {pattern: rand.choice(repls) for pattern in rand.sample(patterns, rand.randint(1, 5))}
+        content = ''.join(rand.choice('abcx<>1 _') for _ in range(rand.randint(0, 10)))
+        try:
+            expected = legacy_sub(pattern_dict, content)
+        except re.error:
+            # 替换字符串引用了不存在的分组
+            continue
+        assert ReplaceEngine(pattern_dict).sub(content) == expected, (pattern_dict, content)
@@ -0,0 +1,31 @@
+import asyncio
+import signal
+
+import pytest
+
+from Sandbox import RegexSandbox
+
+evil = 'a' * 40 + 'b'
+
+pytestmark = pytest.mark.skipif(not hasattr(signal, 'setitimer'), reason='per-pattern budget needs setitimer')
+
+
+def evaluate(sandbox: RegexSandbox, op: str, content: str, arg):
+    async def run():
+        try:
+            return await sandbox.evaluate(op, content, arg)
+        finally:
+            sandbox.close()
+
+    return asyncio.run(run())
+
+
+def test_timeout_does_not_skip_later_replacements():
+    sandbox = RegexSandbox([], [[['(a|aa)+z', 'Z'], ['b', 'B']]], workers=1, budget=0.02, stats_interval=0)
+    # 超时的表达式不替换，同组其余表达式照常替换
+    assert evaluate(sandbox, 'replace', evil, 0) == 'a' * 40 + 'B'
+
+
+def test_timeout_does_not_skip_later_categories():
+    sandbox = RegexSandbox([(0, '(a+)+$'), (1, 'b')], [], workers=1, budget=0.02, stats_interval=0)
+    assert evaluate(sandbox, 'category', evil, 2) == 1
@@ -0,0 +1,44 @@
+import pytest
+
+from TextMatcher import is_safe
+
+# 已知会使事件循环长时间阻塞的表达式
+known_bad = [
+    r'(a+)+$',
+    r'(a|aa)+z',
+    r'(x+x+)+y',
+    r'.*a.*b.*c',
+    r'(a)\1',
+    # 有限重复包裹无上限重复，31个逗号约16秒
+    r'(.*?,){11}P',
+    r'(?:\w+\s?){2,}!',
+    # 未锚定开头、以无上限重复结尾，2万个空格约3秒
+    r'\s*$',
+    r'[ \t]+$',
+    r'(\s*)$',
+    r'\s+x',
+    # 无法分析的结构
+    r'(?=(a+)+)b',
+]
+
+known_good = [
+    'Pattern 1',
+    'As Long As You Love Me',
+    r'https?://\S+',
+    r'^\s+',
+    r'\A\s*$',
+    r'\d{3}-\d{4}',
+    'foo|bar',
+    r'\bcat\b',
+    '(ab){3}',
+]
+
+
+@pytest.mark.parametrize('pattern', known_bad)
+def test_known_bad_patterns_are_isolated(pattern):
+    assert not is_safe(pattern)
+
+
+@pytest.mark.parametrize('pattern', known_good)
+def test_simple_patterns_stay_inline(pattern):
+    assert is_safe(pattern)